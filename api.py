@@ -26,8 +26,14 @@
 # ]
 
 import os
+import json
+import time
+import atexit
+import weakref
 import threading
-import requests
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
 
 # API Documentation for self-evolving systems
 API_DOCS = """API.PY - Multi-Provider LLM Client Documentation
@@ -65,16 +71,76 @@ response = chat_complete(messages, model_name='claude-4-sonnet')
 # Returns: "3+3 equals 6."
 ```
 
+## Streaming:
+`stream=True` returns an iterator of text deltas; afterwards `.text` is the full response and
+`.stats` has 'ttft' (seconds to first token) and 'tokens_per_sec'.
+```python
+stream = chat_complete(messages, model_name='gemini-2.5-flash', stream=True)
+for delta in stream:
+    print(delta, end='', flush=True)
+response = stream.text
+```
+
+## Extracting Code:
+`extract_code_stream(stream)` reads a stream until the first complete ```python block and returns its
+code (None if there is none), closing the stream there so the model stops generating. Fences inside
+<think> sections are skipped. `extract_code(text)` does the same for a full response, and
+`CodeBlockParser` gives incremental access to every block.
+```python
+from api import chat_complete, extract_code_stream
+stream = chat_complete(messages, model_name='gemini-2.5-flash', stream=True)
+code = extract_code_stream(stream, on_text=lambda delta: print(delta, end=''))
+```
+
+## Async Usage:
+`achat_complete` takes the same arguments and returns the same value, for use inside asyncio code.
+`batch_chat_complete(list_of_messages, engine='async', concurrent_calls=200)` runs a whole batch on one event loop.
+```python
+import asyncio
+from api import achat_complete
+response = asyncio.run(achat_complete(messages, model_name='gpt-4o-mini'))
+```
+
 ## Supported Models:
 1. **Google**: 'gemini-2.5-pro', 'gemini-2.5-flash'
 2. **OpenAI**: 'gpt-4o', 'gpt-4o-mini', 'chatgpt-4o-latest', 'gpt-4.1'
 3. **Anthropic**: 'claude-4-sonnet', 'claude-4-opus'
 4. **Hyperbolic**: 'deepseek-v3', 'deepseek-r1', 'qwen3', 'llama3.3-70b'
 
+## Other Endpoints:
+Any OpenAI-compatible server (including a local one) can be added with one call:
+```python
+from api import register_openai_compatible
+register_openai_compatible('http://localhost:8000/v1', ['my-local-model'])
+response = chat_complete(messages, model_name='my-local-model')
+```
+
 ## Parameters:
 - message: List of message dicts with 'role' and 'content'
 - model_name: Model identifier (default: 'gemini-2.5-flash')
 - max_tokens: Max response length (default: 512)
+- cache_prompt: let the provider cache the leading system message(s) across calls (default: False); keep static content first and check api.get_last_usage()['cached_input_tokens']
+- coalesce: identical requests made at the same time share one call and one response; pass False for independent samples (default: True)
+- hedge: if a call runs past the model's p95 latency, race a duplicate (or a fallback model) and take the first answer; None follows configure_hedging / LLM_HEDGE_PERCENTILE (default: None)
+- return_result: return a ChatResult whose .metrics has latency, ttft, tokens, retries and finish_reason (default: False); str(result) is the text
+- timeout: seconds each request attempt may take (default: None, the SDK default)
+
+## Deadlines:
+Each generation has a time budget (EVOLVE_DEADLINE, set by evolve.py). Calls stay within it by themselves:
+request timeouts shrink to the time left, a stream ends at the deadline with the text so far,
+batch_chat_complete skips messages it has not sent yet, and a call that can no longer start raises
+deadline.DeadlineExceeded. Use `deadline.time_left()` (seconds, or None) to plan multi-step work, and
+`with deadline.deadline_scope(60):` to give a step its own, tighter budget.
+
+## Context Budget:
+```python
+from tokens import estimate_tokens, pack_prompt
+estimate_tokens(text, model_name)   # fast estimate, memoized by content
+packed = pack_prompt(messages, model_name, max_tokens=16384, min_output_tokens=4096, trimmable={'notes': notes})
+chat_complete(packed['messages'], model_name=model_name, max_tokens=packed['max_tokens'])
+```
+get_context_window(model_name) gives the window (CONTEXT_WINDOWS). pack_prompt lowers max_tokens to the room
+left, then shortens the trimmable texts in order, and raises tokens.PromptTooLong if it still can't fit.
 
 """
 
@@ -89,6 +155,10 @@ TOGETHER_MODEL_MAPPING = {
     'qwen2.5-7b': 'Qwen/Qwen2.5-7B-Instruct-Turbo'
 }
 
+# Endpoints for the OpenAI-compatible providers
+HYPERBOLIC_URL = "https://api.hyperbolic.xyz/v1/chat/completions"
+TOGETHER_BASE_URL = 'https://api.together.xyz/v1'
+
 # Hyperbolic model mappings (shortcuts to full HuggingFace names)
 HYPERBOLIC_MODEL_MAPPING = {
     'deepseek-v3': 'deepseek-ai/DeepSeek-V3-0324',
@@ -127,6 +197,52 @@ ANTHROPIC_MODEL_ALIASES = {
     'claude-3-opus': 'claude-3-opus-latest'
 }
 
+# Context window (prompt + response tokens) per model, by alias or resolved name. Dated and
+# preview names fall back to the longest entry they start with; see get_context_window.
+# Example: CONTEXT_WINDOWS['my-model'] = 65536
+CONTEXT_WINDOWS = {
+    'gemini-2.0-flash': 1048576,
+    'gemini-2.0-flash-lite': 1048576,
+    'gemini-2.5-pro': 1048576,
+    'gemini-2.5-flash': 1048576,
+    'gpt-4o': 128000,
+    'chatgpt-4o-latest': 128000,
+    'gpt-4o-mini': 128000,
+    'gpt-4.1': 1047576,
+    'gpt-4.1-mini': 1047576,
+    'gpt-4.1-nano': 1047576,
+    'claude-opus-4': 200000,
+    'claude-sonnet-4': 200000,
+    'claude-3-7-sonnet': 200000,
+    'claude-3-5-sonnet': 200000,
+    'claude-3-5-haiku': 200000,
+    'claude-3-opus': 200000,
+    'llama3.1-8b': 131072,
+    'llama3.1-70b': 131072,
+    'llama3.3-70b': 131072,
+    'gemma2-27b': 8192,
+    'gemma2-9b': 8192,
+    'qwen2-72b': 32768,
+    'qwen2.5-72b': 32768,
+    'qwen2.5-7b': 32768,
+    'qwen3': 40960,
+    'qwen3-235b': 40960,
+    'deepseek-v3': 131072,
+    'deepseek-r1': 163840,
+}
+DEFAULT_CONTEXT_WINDOW = 32768  # for models not in the table
+
+# Fallback used by hedged requests (see configure_hedging); models not listed hedge to themselves
+HEDGE_FALLBACK_MODELS = {
+    'gemini-2.5-pro': 'gemini-2.5-flash',
+    'gemini-2.5-flash': 'gemini-2.0-flash',
+    'claude-4-opus': 'claude-4-sonnet',
+    'claude-4-sonnet': 'claude-3-7-sonnet',
+    'deepseek-r1': 'deepseek-v3',
+    'qwen3': 'deepseek-v3',
+    'gpt-4.1': 'gpt-4o',
+}
+
 # Define locks for each API key provider
 google_api_key_lock = threading.Lock()
 openai_api_key_lock = threading.Lock()
@@ -134,87 +250,1428 @@ together_api_key_lock = threading.Lock()
 anthropic_api_key_lock = threading.Lock()
 hyperbolic_api_key_lock = threading.Lock()
 
+# Client pool limits: at most CLIENT_POOL_MAX_SIZE live clients, and clients
+# unused for CLIENT_POOL_IDLE_TIMEOUT seconds are closed on the next lookup.
+CLIENT_POOL_MAX_SIZE = 32
+CLIENT_POOL_IDLE_TIMEOUT = 300
+HYPERBOLIC_POOL_MAXSIZE = 64  # keep-alive connections per Hyperbolic session
+
+class ClientPool:
+    """
+    Thread-safe pool of long-lived provider clients.
+    Clients are keyed by (provider, base_url, api_key) and reused across calls so that
+    the TCP+TLS connection and SDK setup are paid once instead of on every request.
+    Least recently used and idle clients are evicted; a client that is still leased
+    by an in-flight request is never closed underneath it.
+    """
+    def __init__(self, max_size=CLIENT_POOL_MAX_SIZE, idle_timeout=CLIENT_POOL_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> {'client', 'last_used', 'leases'}
+
+    @contextmanager
+    def lease(self, key, factory):
+        """Yield the pooled client for key, creating it with factory() on first use"""
+        client = self._acquire(key, factory)
+        try:
+            yield client
+        finally:
+            self._release(key, client)
+
+    def _acquire(self, key, factory):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['leases'] += 1
+                entry['last_used'] = time.monotonic()
+                self._entries.move_to_end(key)
+                return entry['client']
+        # Build outside the lock so a slow SDK constructor doesn't block other providers
+        client = factory()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # Another thread won the race; use its client and drop ours
+                duplicate, client = client, entry['client']
+                entry['leases'] += 1
+                entry['last_used'] = time.monotonic()
+                self._entries.move_to_end(key)
+            else:
+                duplicate = None
+                self._entries[key] = {'client': client, 'last_used': time.monotonic(), 'leases': 1}
+            evicted = self._evict_locked()
+        for stale in evicted + ([duplicate] if duplicate is not None else []):
+            _close_client(stale)
+        return client
+
+    def _release(self, key, client):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['client'] is client:
+                entry['leases'] -= 1
+                entry['last_used'] = time.monotonic()
+            evicted = self._evict_locked()
+        for stale in evicted:
+            _close_client(stale)
+
+    def _evict_locked(self):
+        """Pop idle and over-limit entries (caller holds the lock); returns clients to close"""
+        evicted = []
+        now = time.monotonic()
+        for key in list(self._entries):
+            entry = self._entries[key]
+            if entry['leases'] > 0:
+                continue
+            over_limit = len(self._entries) > self.max_size
+            idle = self.idle_timeout is not None and now - entry['last_used'] > self.idle_timeout
+            if not (over_limit or idle):
+                break  # entries are in LRU order, so the rest are fresher
+            del self._entries[key]
+            evicted.append(entry['client'])
+        return evicted
+
+    def close(self):
+        """Close every pooled client; new clients are created on demand afterwards"""
+        with self._lock:
+            clients = [entry['client'] for entry in self._entries.values()]
+            self._entries.clear()
+        for client in clients:
+            _close_client(client)
+
+    def reset(self):
+        """Forget every pooled client without closing it (used after fork, where the sockets belong to the parent)"""
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'in_use': sum(1 for entry in self._entries.values() if entry['leases'] > 0),
+                'keys': [(key[0], key[1]) for key in self._entries],  # never expose api keys
+            }
+
+def _close_client(client):
+    close = getattr(client, 'aclose', None) or getattr(client, 'close', None)
+    if close is None:
+        return
+    try:
+        result = close()
+        if hasattr(result, '__await__'):
+            # Async clients can only be closed on their own loop; otherwise let GC reclaim them
+            import asyncio
+            try:
+                asyncio.get_running_loop().create_task(result)
+            except RuntimeError:
+                result.close()
+    except Exception:
+        pass
+
+_client_pool = ClientPool()
+atexit.register(_client_pool.close)
+
+def _reset_clients_after_fork():
+    # The parent's lock may have been held by another thread at fork time
+    _client_pool._lock = threading.Lock()
+    _client_pool.reset()
+    _async_client_pools.clear()
+    # SQLite connections must not cross a fork; the child reopens the cache lazily
+    global _cache_lock, _response_cache, _single_flight_lock, _single_flight
+    _cache_lock = threading.Lock()
+    _response_cache = None
+    # Flights led by the parent's threads will never finish in the child
+    _single_flight_lock = threading.Lock()
+    _single_flight = None
+    global _gemini_prompt_caches_lock, _hedge_lock
+    _gemini_prompt_caches_lock = threading.Lock()
+    # Keep the latency history (it is what makes hedging work) but not a lock another thread held
+    _hedge_lock = threading.Lock()
+    for policy in (_hedge_policy, _call_hedge_policy):
+        if policy is not None:
+            policy._lock = threading.Lock()
+    global _resilience_lock
+    _resilience_lock = threading.Lock()
+    if _resilience is not None:
+        _resilience.reset_locks()
+    # Each generation of a warm worker re-reads the cassette (recordings may have been appended since)
+    global _cassette_lock, _cassette
+    _cassette_lock = threading.Lock()
+    _cassette = None
+    # Keep each key's quarantine and budget, but not locks another thread held
+    global _key_pools_lock
+    _key_pools_lock = threading.Lock()
+    for pool in _key_pools.values():
+        if pool:
+            pool.reset_locks()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_clients_after_fork)
+
+def configure_client_pool(max_size=None, idle_timeout=None):
+    """Adjust the size limit and idle eviction timeout (seconds) of the shared client pool"""
+    if max_size is not None:
+        _client_pool.max_size = max_size
+    if idle_timeout is not None:
+        _client_pool.idle_timeout = idle_timeout
+
+def close_clients():
+    """Close all pooled provider clients and their keep-alive connections"""
+    _client_pool.close()
+
+def reset_clients():
+    """Drop all pooled provider clients without closing them"""
+    _client_pool.reset()
+
+def _traced_http_client(sdk, is_async=False):
+    """The SDK's default httpx client plus a request hook that times new connections (see telemetry)"""
+    from telemetry import trace_request_hook, atrace_request_hook
+    if is_async:
+        return sdk.DefaultAsyncHttpxClient(event_hooks={'request': [atrace_request_hook]})
+    return sdk.DefaultHttpxClient(event_hooks={'request': [trace_request_hook]})
+
+def _make_openai_client(api_key, base_url, is_async=False):
+    openai = _import_sdk('openai')
+    client_class = openai.AsyncOpenAI if is_async else openai.OpenAI
+    # max_retries=0: retries are done (and budgeted) by resilience.py, not inside the SDK
+    return client_class(api_key=api_key, base_url=base_url, http_client=_traced_http_client(openai, is_async), max_retries=0)
+
+def _make_anthropic_client(api_key, base_url, is_async=False):
+    anthropic = _import_sdk('anthropic')
+    client_class = anthropic.AsyncAnthropic if is_async else anthropic.Anthropic
+    return client_class(api_key=api_key, base_url=base_url, http_client=_traced_http_client(anthropic, is_async), max_retries=0)
+
+def _make_google_client(api_key, base_url):
+    genai = _import_sdk('google.genai')
+    if base_url is None:
+        return genai.Client(api_key=api_key)
+    types = _import_sdk('google.genai.types')
+    return genai.Client(api_key=api_key, http_options=types.HttpOptions(base_url=base_url))
+
+def _make_hyperbolic_session():
+    requests = _import_sdk('requests')
+    _import_sdk('requests.adapters')
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HYPERBOLIC_POOL_MAXSIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Models served directly by Google and OpenAI (aliases for Google are in GOOGLE_MODEL_ALIASES)
+GOOGLE_MODELS = [
+    'gemini-2.0-flash', 'gemini-2.0-flash-lite',
+    'gemini-2.5-pro', 'gemini-2.5-flash',
+    'gemini-2.5-pro-preview-05-06', 'gemini-2.5-flash-preview-05-20'
+]
+
+OPENAI_MODELS = [
+    'gpt-4o', 'chatgpt-4o-latest', 'gpt-4o-2024-08-06', 
+    'gpt-4o-mini', 'gpt-4o-mini-2024-07-18', 
+    'gpt-4.1', 'gpt-4.1-mini', 'gpt-4.1-nano'
+]
+
+# Extra endpoints added with register_provider / register_openai_compatible
+_registered_endpoints = []
+
+# Model registry: alias -> {'provider', 'name', 'endpoint'}, built once on first lookup.
+# 'provider' and 'name' are what get_model_provider returns; 'endpoint' (or None) says how
+# _resolve_route reaches a model that is not on the provider's default API.
+_model_index = None
+_model_index_lock = threading.Lock()
+
+def _build_model_index():
+    index = {}
+    for name in GOOGLE_MODELS:
+        index[name] = {'provider': 'google', 'name': name, 'endpoint': None}
+    for alias, name in GOOGLE_MODEL_ALIASES.items():
+        index[alias] = {'provider': 'google', 'name': name, 'endpoint': None}
+    for name in OPENAI_MODELS:
+        index[name] = {'provider': 'openai', 'name': name, 'endpoint': None}
+    # Together and Hyperbolic keep the alias as the name; _resolve_route maps it to the full name
+    together = {'route': 'openai', 'base_url': TOGETHER_BASE_URL, 'api_key': lambda: get_together_api_key()}
+    for alias, full_name in TOGETHER_MODEL_MAPPING.items():
+        index[alias] = {'provider': 'openai', 'name': alias, 'endpoint': dict(together, model=full_name)}
+    hyperbolic = {'route': 'hyperbolic', 'base_url': HYPERBOLIC_URL, 'api_key': lambda: get_hyperbolic_api_key()}
+    for alias, full_name in HYPERBOLIC_MODEL_MAPPING.items():
+        index[alias] = {'provider': 'openai', 'name': alias, 'endpoint': dict(hyperbolic, model=full_name)}
+    for alias, name in ANTHROPIC_MODEL_ALIASES.items():
+        index[alias] = {'provider': 'anthropic', 'name': name, 'endpoint': None}
+    for endpoint in _registered_endpoints:
+        for alias, full_name in endpoint['models'].items():
+            index[alias] = {'provider': endpoint['provider'], 'name': alias, 'endpoint': dict(endpoint['spec'], model=full_name)}
+    return index
+
+def _get_model_index():
+    global _model_index
+    index = _model_index
+    if index is None:
+        with _model_index_lock:
+            if _model_index is None:
+                _model_index = _build_model_index()
+            index = _model_index
+    return index
+
+def refresh_model_registry():
+    """Rebuild the model registry, e.g. after editing the model tables above at runtime"""
+    global _model_index
+    with _model_index_lock:
+        _model_index = None
+
+def register_provider(models, route='openai', base_url=None, api_key=None, api_key_env=None):
+    """
+    Register models served by an extra endpoint.
+    Args:
+        models: dict of alias -> model name sent to the endpoint, or a list of names used as both.
+        route: 'openai' for OpenAI-compatible chat completions APIs (via the OpenAI client),
+            'hyperbolic' for the raw HTTP path, or 'anthropic' / 'google' for those SDKs.
+        base_url: the endpoint's base URL (the full chat completions URL for route='hyperbolic').
+        api_key: a fixed key, or api_key_env: the environment variable holding it.
+    """
+    if not isinstance(models, dict):
+        models = {name: name for name in models}
+    if api_key is not None:
+        get_key = lambda: api_key
+    elif api_key_env is not None:
+        get_key = lambda: _get_env_api_key(api_key_env)
+    else:
+        get_key = lambda: 'not-needed'  # local servers usually ignore the key, but the SDKs require one
+    provider = 'openai' if route in ('openai', 'hyperbolic') else route
+    _registered_endpoints.append({
+        'provider': provider,
+        'models': {alias.strip().lower(): name for alias, name in models.items()},
+        'spec': {'route': route, 'base_url': base_url, 'api_key': get_key},
+    })
+    refresh_model_registry()
+
+def register_openai_compatible(base_url, models, api_key=None, api_key_env=None):
+    """
+    Add an OpenAI-compatible endpoint (vLLM, Ollama, LM Studio, a hosted proxy...) in one call:
+        register_openai_compatible('http://localhost:8000/v1', ['qwen2.5-coder'])
+        chat_complete(messages, model_name='qwen2.5-coder')
+    """
+    register_provider(models, route='openai', base_url=base_url, api_key=api_key, api_key_env=api_key_env)
+
+def _get_env_api_key(env_var):
+    pool = get_key_pool(env_var)
+    if pool is not None:
+        return pool.pick()
+    if env_var not in os.environ:
+        os.environ[env_var] = _prompt_api_key(env_var, f'Please enter your API key for {env_var}:')
+    return os.environ[env_var]
+
 def get_model_provider(model_name):
     """
     Determine the provider based on the model name.
     Returns a tuple of (provider, normalized_model_name)
     """
-    # Lists of valid models for each provider
-    google_models = [
-        'gemini-2.0-flash', 'gemini-2.0-flash-lite',
-        'gemini-2.5-pro', 'gemini-2.5-flash',
-        'gemini-2.5-pro-preview-05-06', 'gemini-2.5-flash-preview-05-20'
-    ]
-    
-    openai_models = [
-        'gpt-4o', 'chatgpt-4o-latest', 'gpt-4o-2024-08-06', 
-        'gpt-4o-mini', 'gpt-4o-mini-2024-07-18', 
-        'gpt-4.1', 'gpt-4.1-mini', 'gpt-4.1-nano'
-    ]
-    
     model_name = model_name.strip().lower()
-    
-    # Check if it's a Google model
-    if model_name in google_models or model_name in GOOGLE_MODEL_ALIASES:
-        provider = 'google'
-        # Apply alias if applicable
-        if model_name in GOOGLE_MODEL_ALIASES:
-            model_name = GOOGLE_MODEL_ALIASES[model_name]
-    # Check if it's an OpenAI model
-    elif model_name in openai_models:
-        provider = 'openai'
-    # Check if it's a Together model
-    elif model_name in TOGETHER_MODEL_MAPPING:
-        provider = 'openai'  # Together uses OpenAI client with different base_url
-    # Check if it's a Hyperbolic model
-    elif model_name in HYPERBOLIC_MODEL_MAPPING:
-        provider = 'openai'  # Hyperbolic uses OpenAI client with different base_url
-    # Check if it's an Anthropic model (all start with 'claude-')
-    elif model_name.startswith('claude-'):
-        provider = 'anthropic'
-        # Apply alias if applicable
-        if model_name in ANTHROPIC_MODEL_ALIASES:
-            model_name = ANTHROPIC_MODEL_ALIASES[model_name]
-    else:
-        return None, model_name
-    
-    return provider, model_name
+    entry = _get_model_index().get(model_name)
+    if entry is not None:
+        return entry['provider'], entry['name']
+    # Any other Anthropic model (all start with 'claude-') is passed through as-is
+    if model_name.startswith('claude-'):
+        return 'anthropic', model_name
+    return None, model_name
+
+def get_context_window(model_name):
+    """Context window of a model in tokens (CONTEXT_WINDOWS, else DEFAULT_CONTEXT_WINDOW)"""
+    key = model_name.strip().lower()
+    if key in CONTEXT_WINDOWS:
+        return CONTEXT_WINDOWS[key]
+    _, resolved = get_model_provider(key)
+    if resolved in CONTEXT_WINDOWS:
+        return CONTEXT_WINDOWS[resolved]
+    # Dated, preview and '-latest' names: 'gpt-4o-2024-08-06', 'claude-opus-4-0', ...
+    prefixes = [name for name in CONTEXT_WINDOWS if resolved.startswith(name) or key.startswith(name)]
+    if prefixes:
+        return CONTEXT_WINDOWS[max(prefixes, key=len)]
+    return DEFAULT_CONTEXT_WINDOW
+
+# Provider SDKs are imported on first use and cached, so `import api` stays cheap
+_sdk_modules = {}
+
+def _import_sdk(name):
+    module = _sdk_modules.get(name)
+    if module is None:
+        import importlib
+        module = importlib.import_module(name)
+        _sdk_modules[name] = module
+    return module
+
+# `import api` runs in every run_main.py subprocess, so module import must stay cheap:
+# no provider SDKs, requests or asyncio at module level. check_import_time() enforces it.
+IMPORT_TIME_BUDGET_MS = 25
+
+def measure_import_time(module='api', runs=5):
+    """Median wall time in milliseconds to import module in a fresh interpreter"""
+    import statistics
+    import subprocess
+    import sys
+    code = f"import time; start = time.perf_counter(); import {module}; print((time.perf_counter() - start) * 1000)"
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=here)
+        samples.append(float(result.stdout.strip()))
+    return statistics.median(samples)
+
+def check_import_time(budget_ms=IMPORT_TIME_BUDGET_MS):
+    """Return (within_budget, milliseconds) for `import api`"""
+    elapsed = measure_import_time()
+    return elapsed <= budget_ms, elapsed
+
+class MissingAPIKeyError(RuntimeError):
+    """An API key is not set and there is no terminal to ask for it"""
+
+def _prompt_api_key(env_var, prompt):
+    """Ask for a missing key on the terminal; without one (CI, batch jobs, LLM_NONINTERACTIVE=1) raise instead of blocking"""
+    import sys
+    if os.environ.get('LLM_NONINTERACTIVE') == '1' or not sys.stdin or not sys.stdin.isatty():
+        raise MissingAPIKeyError(f"{env_var} is not set (set it, or use LLM_CASSETTE / LLM_STANDIN_URL to run offline)")
+    return input(prompt)
 
 def get_openai_api_key():
+    pool = get_key_pool('OPENAI_API_KEY')
+    if pool is not None:
+        return pool.pick()
     with openai_api_key_lock:
         if 'OPENAI_API_KEY' not in os.environ:
-            api_key = input('Please enter your OpenAI API key:')
+            api_key = _prompt_api_key('OPENAI_API_KEY', 'Please enter your OpenAI API key:')
             os.environ['OPENAI_API_KEY'] = api_key
         return os.environ['OPENAI_API_KEY']
 
 def get_google_api_key():
+    pool = get_key_pool('GOOGLE_API_KEY')
+    if pool is not None:
+        return pool.pick()
     with google_api_key_lock:
         if 'GOOGLE_API_KEY' not in os.environ:
-            api_key = input('Please enter your Gemini API key:')
+            api_key = _prompt_api_key('GOOGLE_API_KEY', 'Please enter your Gemini API key:')
             os.environ["GOOGLE_API_KEY"] = api_key
         return os.environ["GOOGLE_API_KEY"]
 
 def get_together_api_key():
+    pool = get_key_pool('TOGETHER_API_KEY')
+    if pool is not None:
+        return pool.pick()
     with together_api_key_lock:
         if 'TOGETHER_API_KEY' not in os.environ:
-            api_key = input('Please enter your Together API key:')
+            api_key = _prompt_api_key('TOGETHER_API_KEY', 'Please enter your Together API key:')
             os.environ["TOGETHER_API_KEY"] = api_key
         return os.environ["TOGETHER_API_KEY"]
 
 def get_anthropic_api_key():
+    pool = get_key_pool('ANTHROPIC_API_KEY')
+    if pool is not None:
+        return pool.pick()
     with anthropic_api_key_lock:
         if 'ANTHROPIC_API_KEY' not in os.environ:
-            api_key = input('Please enter your Anthropic API key:')
+            api_key = _prompt_api_key('ANTHROPIC_API_KEY', 'Please enter your Anthropic API key:')
             os.environ["ANTHROPIC_API_KEY"] = api_key
         return os.environ["ANTHROPIC_API_KEY"]
 
 def get_hyperbolic_api_key():
+    pool = get_key_pool('HYPERBOLIC_API_KEY')
+    if pool is not None:
+        return pool.pick()
     with hyperbolic_api_key_lock:
         if 'HYPERBOLIC_API_KEY' not in os.environ:
-            api_key = input('Please enter your Hyperbolic API key:')
+            api_key = _prompt_api_key('HYPERBOLIC_API_KEY', 'Please enter your Hyperbolic API key:')
             os.environ["HYPERBOLIC_API_KEY"] = api_key
         return os.environ["HYPERBOLIC_API_KEY"]
 
+# Several keys per provider: a comma-separated key variable (OPENAI_API_KEY=sk-a,sk-b), a key file
+# named by <ENV_VAR>_FILE (one key per line, optionally "sk-... rpm=500 tpm=200000"), or
+# configure_key_pool(). Each request attempt then takes the key with the most headroom and keys
+# that get a 429 / 401 are quarantined for a while (see keypool.py).
+API_KEY_ENV_VARS = {
+    'openai': 'OPENAI_API_KEY',
+    'anthropic': 'ANTHROPIC_API_KEY',
+    'google': 'GOOGLE_API_KEY',
+    'together': 'TOGETHER_API_KEY',
+    'hyperbolic': 'HYPERBOLIC_API_KEY',
+}
+_key_pools_lock = threading.Lock()
+_key_pools = {}          # env var -> KeyPool, or False when it holds a single key
+_key_pool_settings = {}  # env var -> configure_key_pool arguments
+_pooled_keys = {}        # key -> the KeyPool it belongs to
+
+def configure_key_pool(env_var, keys=None, path=None, rpm=None, tpm=None, quarantine=None, auth_quarantine=None):
+    """
+    Pool several API keys for a provider.
+    Args:
+        env_var: the key's environment variable, or a provider name from API_KEY_ENV_VARS.
+        keys: a list of keys (or {'key', 'rpm', 'tpm'} dicts), or path: a key file. With neither,
+            the keys still come from the environment variable or <env_var>_FILE.
+        rpm, tpm: default requests and tokens per minute for each key.
+        quarantine: seconds a key sits out after a 429 without Retry-After.
+        auth_quarantine: seconds a key sits out after a 401 / 403.
+    """
+    env_var = API_KEY_ENV_VARS.get(env_var, env_var)
+    settings = {'rpm': rpm, 'tpm': tpm, 'quarantine': quarantine, 'auth_quarantine': auth_quarantine, 'keys': keys, 'path': path}
+    with _key_pools_lock:
+        _key_pool_settings[env_var] = {name: value for name, value in settings.items() if value is not None}
+        pool = _key_pools.pop(env_var, None)
+        for key in (pool.keys() if pool else []):
+            _pooled_keys.pop(key, None)
+
+def _build_key_pool(env_var):
+    from keypool import KeyPool, parse_keys, read_key_file
+    settings = dict(_key_pool_settings.get(env_var, {}))
+    keys = settings.pop('keys', None)
+    path = settings.pop('path', None) or os.environ.get(f'{env_var}_FILE')
+    if keys is None:
+        if path:
+            keys = read_key_file(path)
+        elif ',' in os.environ.get(env_var, ''):
+            keys = parse_keys(os.environ[env_var])
+        else:
+            return False
+    return KeyPool(env_var, keys, **settings)
+
+def get_key_pool(env_var):
+    """The KeyPool for an API key variable (or provider name), or None when it holds a single key"""
+    env_var = API_KEY_ENV_VARS.get(env_var, env_var)
+    with _key_pools_lock:
+        pool = _key_pools.get(env_var)
+        if pool is None:
+            pool = _build_key_pool(env_var)
+            _key_pools[env_var] = pool
+            for key in (pool.keys() if pool else []):
+                _pooled_keys[key] = pool
+    return pool or None
+
+def get_key_pool_state():
+    """Per-key health, quarantine and rpm/tpm headroom of every key pool in use (keys by fingerprint)"""
+    with _key_pools_lock:
+        pools = {env_var: pool for env_var, pool in _key_pools.items() if pool}
+    return {env_var: pool.state() for env_var, pool in pools.items()}
+
+def _key_pool_for(api_key):
+    return _pooled_keys.get(api_key) if _pooled_keys else None
+
+def _usage_tokens(usage):
+    # Real token count of a finished request, to settle its tpm reservation
+    if not usage or usage.get('input_tokens') is None:
+        return None
+    return (usage.get('input_tokens') or 0) + (usage.get('output_tokens') or 0)
+
+def _with_pooled_key(pool, tokens, send):
+    """
+    Call send(key) with the best key in pool. A key that gets a 429 or 401/403 is quarantined
+    and the request goes straight to another healthy key; when none is left the error is raised
+    for the usual retries and backoff.
+    """
+    for attempt in range(len(pool)):
+        key, delay = pool.acquire(tokens)
+        if delay:
+            time.sleep(delay)
+        try:
+            response = send(key)
+        except Exception as e:
+            if pool.release(key, _error_status(e), _retry_after_seconds(e), tokens, 0) and attempt + 1 < len(pool):
+                continue
+            raise
+        except BaseException:
+            pool.release(key, reserved_tokens=tokens, used_tokens=0)
+            raise
+        pool.release(key, reserved_tokens=tokens, used_tokens=_usage_tokens(_last_usage.get()))
+        return response
+
+async def _awith_pooled_key(pool, tokens, send):
+    """Async counterpart of _with_pooled_key; send(key) returns a coroutine"""
+    import asyncio
+    for attempt in range(len(pool)):
+        key, delay = pool.acquire(tokens)
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            response = await send(key)
+        except Exception as e:
+            if pool.release(key, _error_status(e), _retry_after_seconds(e), tokens, 0) and attempt + 1 < len(pool):
+                continue
+            raise
+        except BaseException:
+            pool.release(key, reserved_tokens=tokens, used_tokens=0)
+            raise
+        pool.release(key, reserved_tokens=tokens, used_tokens=_usage_tokens(_last_usage.get()))
+        return response
+
+def _pooled_chunks(pool, tokens, source):
+    """Chunk source that opens each stream attempt with the best key in pool; source(key) is the chunk source for one key"""
+    def chunks(usage):
+        for attempt in range(len(pool)):
+            key, delay = pool.acquire(tokens)
+            if delay:
+                time.sleep(delay)
+            started = False
+            try:
+                for chunk in source(key)(usage):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                # Only a stream that failed before its first chunk can move to another key
+                if pool.release(key, _error_status(e), _retry_after_seconds(e), tokens, 0) and not started and attempt + 1 < len(pool):
+                    continue
+                raise
+            except BaseException:
+                pool.release(key, reserved_tokens=tokens, used_tokens=_usage_tokens(usage))
+                raise
+            pool.release(key, reserved_tokens=tokens, used_tokens=_usage_tokens(usage))
+            return
+    return chunks
+
+def _reserved_tokens(message, model_name, max_tokens, n=1):
+    return _estimate_tokens(message, model_name) + min(max_tokens, 1024) * n
+
+_DEFAULT_API_KEY_GETTERS = {
+    'openai': get_openai_api_key,
+    'anthropic': get_anthropic_api_key,
+    'google': get_google_api_key,
+}
+
+# Opt-in response cache: call configure_cache() or set LLM_CACHE_PATH (inherited by run_main.py subprocesses).
+# LLM_CACHE_TTL sets a default time-to-live in seconds; LLM_CACHE_NONZERO_TEMPERATURE=0 only caches temperature 0.
+_cache_lock = threading.Lock()
+_cache_settings = None  # ResponseCache kwargs once configured, False when explicitly disabled
+_cache_nonzero_temperature = True
+_response_cache = None
+
+def configure_cache(path=None, max_entries=None, max_bytes=None, ttl=None, cache_nonzero_temperature=True):
+    """
+    Enable the on-disk response cache for chat_complete, achat_complete and batch_chat_complete.
+    Args:
+        path: SQLite file (default: .llm_cache.sqlite).
+        max_entries, max_bytes: LRU eviction limits.
+        ttl: default time-to-live for entries in seconds (None: never expire).
+        cache_nonzero_temperature: if False, only temperature 0 requests are cached by default.
+    """
+    global _cache_settings, _cache_nonzero_temperature, _response_cache
+    from response_cache import DEFAULT_CACHE_PATH, DEFAULT_MAX_ENTRIES, DEFAULT_MAX_BYTES
+    with _cache_lock:
+        if _response_cache is not None:
+            _response_cache.close()
+        _cache_settings = {
+            'path': path or DEFAULT_CACHE_PATH,
+            'max_entries': max_entries or DEFAULT_MAX_ENTRIES,
+            'max_bytes': max_bytes or DEFAULT_MAX_BYTES,
+            'ttl': ttl,
+        }
+        _cache_nonzero_temperature = cache_nonzero_temperature
+        _response_cache = None
+
+def disable_cache():
+    """Turn the response cache off for this process (overrides LLM_CACHE_PATH)"""
+    global _cache_settings, _response_cache
+    with _cache_lock:
+        if _response_cache is not None:
+            _response_cache.close()
+        _cache_settings = False
+        _response_cache = None
+
+def get_response_cache():
+    """Return the active ResponseCache, or None when caching is off"""
+    global _cache_settings, _cache_nonzero_temperature, _response_cache
+    with _cache_lock:
+        if _response_cache is None:
+            if _cache_settings is None and os.environ.get('LLM_CACHE_PATH'):
+                ttl = os.environ.get('LLM_CACHE_TTL')
+                _cache_settings = {'path': os.environ['LLM_CACHE_PATH'], 'ttl': float(ttl) if ttl else None}
+                _cache_nonzero_temperature = os.environ.get('LLM_CACHE_NONZERO_TEMPERATURE', '1') != '0'
+            if _cache_settings:
+                from response_cache import ResponseCache
+                _response_cache = ResponseCache(**_cache_settings)
+        return _response_cache
+
+def _cache_for_call(use_cache, temperature):
+    """Return the response cache if this call should use it, else None"""
+    if use_cache is False:
+        return None
+    cache = get_response_cache()
+    if cache is None:
+        return None
+    if use_cache is None and temperature and not _cache_nonzero_temperature:
+        return None
+    return cache
+
+def _request_key(message, model_name, base_url, max_tokens, temperature, n, thinking_budget, show_thinking):
+    """Content hash of a request: normalized messages, resolved model name, endpoint and sampling parameters"""
+    import hashlib
+    normalized = [
+        {'role': 'system' if msg['role'] == 'developer' else msg['role'], 'content': msg['content']}
+        for msg in message
+    ]
+    payload = {
+        'messages': normalized,
+        'model': model_name,
+        'base_url': base_url,
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+        'n': n,
+        'thinking_budget': thinking_budget,
+        'show_thinking': show_thinking,
+    }
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+# Identical requests in flight at the same time (same _request_key) share one upstream call
+_single_flight_lock = threading.Lock()
+_single_flight = None
+
+def _get_single_flight():
+    global _single_flight
+    with _single_flight_lock:
+        if _single_flight is None:
+            from singleflight import SingleFlight
+            _single_flight = SingleFlight()
+        return _single_flight
+
+def get_coalescing_stats():
+    """Counters for request coalescing: upstream_calls made, calls coalesced (saved) and flights in progress"""
+    return _get_single_flight().stats()
+
+# Record / replay (cassette.py): configure_cassette() or LLM_CASSETTE=path with LLM_CASSETTE_MODE=record
+# or replay (default) and LLM_CASSETTE_REALTIME=1 to replay recorded latencies. Replay needs no API keys.
+_cassette_lock = threading.Lock()
+_cassette_settings = None  # Cassette kwargs once configured, False when explicitly disabled
+_cassette = None
+
+def configure_cassette(path, mode='replay', realtime=False):
+    """
+    Record calls to, or replay them from, a cassette file.
+    Args:
+        path: the cassette (JSONL).
+        mode: 'record' appends every call that reaches a provider; 'replay' serves calls from the
+            file (no keys or network needed) and raises cassette.CassetteMiss for unrecorded requests.
+        realtime: in replay, wait each call's recorded latency.
+    """
+    global _cassette_settings, _cassette
+    with _cassette_lock:
+        _cassette_settings = {'path': path, 'mode': mode, 'realtime': realtime}
+        _cassette = None
+
+def disable_cassette():
+    """Stop recording / replaying (overrides LLM_CASSETTE)"""
+    global _cassette_settings, _cassette
+    with _cassette_lock:
+        _cassette_settings = False
+        _cassette = None
+
+def get_cassette():
+    """Return the active Cassette, or None"""
+    global _cassette_settings, _cassette
+    with _cassette_lock:
+        if _cassette is None:
+            if _cassette_settings is None and os.environ.get('LLM_CASSETTE'):
+                _cassette_settings = {
+                    'path': os.environ['LLM_CASSETTE'],
+                    'mode': os.environ.get('LLM_CASSETTE_MODE', 'replay'),
+                    'realtime': os.environ.get('LLM_CASSETTE_REALTIME') == '1',
+                }
+            if _cassette_settings:
+                from cassette import Cassette
+                _cassette = Cassette(**_cassette_settings)
+        return _cassette
+
+def _replaying():
+    cassette = get_cassette()
+    return cassette is not None and cassette.mode == 'replay'
+
+def _recording_cassette():
+    cassette = get_cassette()
+    return cassette if cassette is not None and cassette.mode == 'record' else None
+
+def _record_call(cassette, key, route, model_name, message, base_url, max_tokens, temperature, n, thinking_budget, show_thinking, response, latency, ttft=None, stream=False):
+    params = {
+        'route': route, 'base_url': base_url, 'max_tokens': max_tokens, 'temperature': temperature,
+        'n': n, 'thinking_budget': thinking_budget, 'show_thinking': show_thinking,
+    }
+    response = list(response) if isinstance(response, list) else response
+    cassette.record(key, model_name, _plain_messages(message), params, response, _last_usage.get(), latency, ttft, stream)
+
+def _replay_response(entry):
+    _last_usage.set(dict(entry['usage']) if entry.get('usage') else None)
+    response = entry['response']
+    return Samples(response, timings=[entry.get('latency') or 0.0] * len(response)) if isinstance(response, list) else response
+
+# Stand-in server (standin_server.py): use_standin_server() or LLM_STANDIN_URL sends every provider's
+# requests, in its own wire format, to that server instead
+_standin_url = None
+
+def use_standin_server(url):
+    """Send all calls to a local stand-in server (python standin_server.py), or pass None to stop"""
+    global _standin_url
+    _standin_url = url.rstrip('/') if url else False
+
+def get_standin_url():
+    if _standin_url is None:
+        url = os.environ.get('LLM_STANDIN_URL')
+        return url.rstrip('/') if url else None
+    return _standin_url or None
+
+def _standin_base_url(url, route):
+    """The base_url a route uses to reach the stand-in server"""
+    if route == 'hyperbolic':
+        return f"{url}/v1/chat/completions"
+    if route == 'openai':
+        return f"{url}/v1"
+    return url
+
+def _transport_base_url(route, base_url):
+    """The base_url a request on a resolved route is actually sent to: the stand-in server's when one is in use"""
+    standin_url = get_standin_url()
+    if standin_url is None or route == 'replay':
+        return base_url
+    return _standin_base_url(standin_url, route)
+
+# Hedged requests (hedge.py): off unless configure_hedging() is called or LLM_HEDGE_PERCENTILE is set
+# (inherited by run_main.py subprocesses). LLM_HEDGE_MAX_RATE caps the fraction of calls that hedge and
+# LLM_HEDGE_FALLBACKS overrides the fallback table, e.g. "gemini-2.5-flash=gpt-4.1-mini,qwen3=deepseek-v3".
+_hedge_lock = threading.Lock()
+_hedge_settings = None  # HedgePolicy kwargs once configured, False when explicitly disabled
+_hedge_policy = None
+_call_hedge_policy = None  # default policy for hedge=True calls while hedging is off; never becomes the global one
+
+def configure_hedging(percentile=95, max_rate=0.1, min_samples=20, min_delay=2.0, fallbacks=None):
+    """
+    Hedge slow calls: once a call has taken longer than the given percentile of the model's
+    recent latencies, send a duplicate (to the model's fallback if it has one) and use whichever
+    answer arrives first. Streams are hedged on time to first token.
+    Args:
+        percentile: latency percentile that triggers the hedge (default: p95).
+        max_rate: largest fraction of calls that may send a hedge.
+        min_samples: calls a model needs to have made before it is hedged.
+        min_delay: never hedge sooner than this many seconds.
+        fallbacks: dict of model -> fallback model (default: HEDGE_FALLBACK_MODELS).
+    """
+    global _hedge_settings, _hedge_policy
+    with _hedge_lock:
+        _hedge_settings = {
+            'percentile': percentile,
+            'max_rate': max_rate,
+            'min_samples': min_samples,
+            'min_delay': min_delay,
+            'fallbacks': HEDGE_FALLBACK_MODELS if fallbacks is None else fallbacks,
+        }
+        _hedge_policy = None
+
+def disable_hedging():
+    """Turn hedging off for this process (overrides LLM_HEDGE_PERCENTILE)"""
+    global _hedge_settings, _hedge_policy
+    with _hedge_lock:
+        _hedge_settings = False
+        _hedge_policy = None
+
+def _parse_fallbacks(spec):
+    pairs = [item.split('=', 1) for item in spec.split(',') if '=' in item]
+    return {alias.strip(): model.strip() for alias, model in pairs}
+
+def get_hedge_policy():
+    """Return the active HedgePolicy, or None when hedging is off"""
+    global _hedge_settings, _hedge_policy
+    with _hedge_lock:
+        if _hedge_policy is None:
+            if _hedge_settings is None and os.environ.get('LLM_HEDGE_PERCENTILE'):
+                fallbacks = os.environ.get('LLM_HEDGE_FALLBACKS')
+                _hedge_settings = {
+                    'percentile': float(os.environ['LLM_HEDGE_PERCENTILE']),
+                    'max_rate': float(os.environ.get('LLM_HEDGE_MAX_RATE', 0.1)),
+                    'fallbacks': _parse_fallbacks(fallbacks) if fallbacks is not None else HEDGE_FALLBACK_MODELS,
+                }
+            if _hedge_settings:
+                from hedge import HedgePolicy
+                _hedge_policy = HedgePolicy(**_hedge_settings)
+        return _hedge_policy
+
+def get_hedging_stats():
+    """Counters for hedged requests: requests, hedged, hedge_wins, primary_wins, failovers, capped and the current hedge delays"""
+    policy = get_hedge_policy()
+    return policy.stats() if policy is not None else None
+
+def _hedge_policy_for_call(hedge, n=1):
+    """The HedgePolicy for this call, or None when it should not be hedged"""
+    global _call_hedge_policy
+    if hedge is False or n != 1:
+        return None
+    policy = get_hedge_policy()
+    if policy is None and hedge:
+        # Opting one call in leaves the process-wide setting (and any disable_hedging) as it was
+        with _hedge_lock:
+            if _call_hedge_policy is None:
+                from hedge import HedgePolicy
+                _call_hedge_policy = HedgePolicy(fallbacks=HEDGE_FALLBACK_MODELS)
+            policy = _call_hedge_policy
+    return policy
+
+def _hedge_target(policy, requested_model, route, model_name, base_url, api_key):
+    """The (route, model_name, base_url, api_key) the hedge copy of a call goes to"""
+    fallback = policy.fallback_for(requested_model, model_name)
+    if fallback is not None:
+        try:
+            return _resolve_route(fallback, None, None, None)
+        except Exception as e:
+            print (f"Hedge fallback {fallback} unavailable ({e}), hedging to {model_name}")
+    return route, model_name, base_url, api_key
+
+def _hedged_call(policy, hedge_target, route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto=0, max_retries=None, timeout=None):
+    """
+    _call_provider through the hedge policy; the winner's usage becomes this call's usage.
+    Returns (response, the (route, model_name) that answered).
+    """
+    def attempt(route, model_name, base_url, api_key):
+        def call():
+            response = _resilient_call(route, base_url, max_retries, lambda: _call_provider(route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto, timeout))
+            return response, _last_usage.get(), (route, model_name)
+        return call
+    response, usage, answered_by = policy.run(model_name, attempt(route, model_name, base_url, api_key), attempt(*hedge_target), hedge_key=hedge_target[1])
+    _last_usage.set(usage)
+    return response, answered_by
+
+async def _ahedged_call(policy, hedge_target, route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto=0, max_retries=None, timeout=None):
+    """Async counterpart of _hedged_call; the losing request is cancelled"""
+    def attempt(route, model_name, base_url, api_key):
+        async def call():
+            response = await _aresilient_call(route, base_url, max_retries, lambda: _acall_provider(route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto, timeout))
+            return response, _last_usage.get(), (route, model_name)
+        return call
+    response, usage, answered_by = await policy.arun(model_name, attempt(route, model_name, base_url, api_key), attempt(*hedge_target), hedge_key=hedge_target[1])
+    _last_usage.set(usage)
+    return response, answered_by
+
+# Retries, retry budget and per-provider circuit breakers for every call (resilience.py)
+_resilience_lock = threading.Lock()
+_resilience_settings = {}
+_resilience = None
+
+def configure_resilience(max_retries=3, base_delay=1.0, max_delay=30.0, retry_budget_ratio=0.2,
+                         failure_rate=0.5, consecutive_failures=5, reset_timeout=30.0):
+    """
+    Tune the retry and circuit breaker policy shared by all calls.
+    Args:
+        max_retries: retries per call for transient errors (429, 5xx, timeouts, connection errors).
+        base_delay, max_delay: jittered exponential backoff bounds in seconds. A Retry-After
+            longer than max_delay makes the call give up instead of waiting.
+        retry_budget_ratio: retries may add at most this fraction of extra calls (over 10 seconds).
+        failure_rate, consecutive_failures: when a provider's breaker opens.
+        reset_timeout: seconds an open breaker rejects calls before letting a probe through.
+    """
+    global _resilience_settings, _resilience
+    with _resilience_lock:
+        _resilience_settings = {
+            'max_retries': max_retries,
+            'base_delay': base_delay,
+            'max_delay': max_delay,
+            'budget_ratio': retry_budget_ratio,
+            'breaker_options': {
+                'failure_rate': failure_rate,
+                'consecutive_failures': consecutive_failures,
+                'reset_timeout': reset_timeout,
+            },
+        }
+        _resilience = None
+
+def get_resilience():
+    """Return the shared Resilience (retry policy, retry budget and circuit breakers)"""
+    global _resilience
+    with _resilience_lock:
+        if _resilience is None:
+            from resilience import Resilience
+            _resilience = Resilience(_should_retry_specific_errors, _is_provider_failure, _retry_after_seconds, time_left=_time_left,
+                                     on_retry=_count_call_retry, **_resilience_settings)
+        return _resilience
+
+def get_resilience_state():
+    """Circuit breaker state per provider endpoint, the retry budget and retry counters"""
+    return get_resilience().state()
+
+def _count_call_retry():
+    """Count a retry in the metrics of the call making it"""
+    from telemetry import current_call
+    metrics = current_call.get()
+    if metrics is not None:
+        metrics.add_retry()
+
+def _provider_label(route, base_url):
+    """Name of the endpoint a circuit breaker guards: the route for default APIs, else the host"""
+    if base_url is None:
+        return route
+    from urllib.parse import urlparse
+    return urlparse(base_url).netloc or base_url
+
+def _resilient_call(route, base_url, max_retries, fn):
+    return get_resilience().call(_provider_label(route, base_url), fn, max_retries)
+
+async def _aresilient_call(route, base_url, max_retries, coro_fn):
+    return await get_resilience().acall(_provider_label(route, base_url), coro_fn, max_retries)
+
+def _resilient_chunks(route, base_url, max_retries, chunks):
+    """Wrap a stream chunk source so failures before the first chunk are retried"""
+    def resilient(usage):
+        return get_resilience().chunks(_provider_label(route, base_url), lambda: chunks(usage), max_retries)
+    return resilient
+
+# Deadlines (deadline.py): EVOLVE_DEADLINE set by evolve.py, or deadline_scope() in code, bounds each
+# request's timeout, retries and streams; batches skip the messages they have not started by then
+def _time_left():
+    from deadline import time_left
+    return time_left()
+
+def _deadline_passed():
+    remaining = _time_left()
+    return remaining is not None and remaining <= 0
+
+def _request_timeout(cap=None):
+    """
+    Timeout in seconds for the next provider request: the call's timeout (cap) limited to the time
+    left before the current deadline, or None for the SDK default. Raises DeadlineExceeded once
+    the deadline has passed, so nothing is sent that could not finish in time.
+    """
+    from deadline import current_deadline
+    deadline = current_deadline()
+    return deadline.timeout(cap) if deadline is not None else cap
+
+def _timeout_args(timeout):
+    # The SDKs read timeout=None as "never time out", so leave it out to keep their defaults
+    return {'timeout': timeout} if timeout is not None else {}
+
+def _gemini_timeout(config, timeout, types):
+    if timeout is not None:
+        config.http_options = types.HttpOptions(timeout=int(timeout * 1000))
+    return config
+
+class ProviderHTTPError(Exception):
+    """HTTP error from a provider called without an SDK (Hyperbolic); keeps the status code and headers"""
+    def __init__(self, message, status_code=None, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = dict(headers or {})
+
+
+# Models whose thinking budget can be configured (gemini-2.5-flash defaults to no thinking)
+GEMINI_THINKING_MODELS = ['gemini-2.5-pro-preview-05-06', 'gemini-2.5-flash-preview-05-20']
+
+def _resolve_route(model_name, provider, base_url, api_key):
+    """
+    Resolve where a request goes.
+    Returns a tuple of (route, model_name, base_url, api_key), where route is one of
+    'openai' (also Together and other OpenAI-compatible endpoints), 'hyperbolic', 'anthropic'
+    or 'google' ('replay' when replaying a cassette) and model_name is the full name the provider expects.
+    """
+    # Determine provider if not specified
+    if provider is None:
+        provider, model_name = get_model_provider(model_name)
+        if provider is None:
+            raise ValueError('Please specify a valid provider or model name')
+
+    if provider not in ('openai', 'anthropic', 'google'):
+        raise NotImplementedError(f'Provider {provider} is not supported. Supported providers: openai, google, anthropic')
+
+    # Together, Hyperbolic and registered endpoints carry their own URL, key and full model name
+    entry = _get_model_index().get(model_name)
+    endpoint = entry['endpoint'] if entry is not None and entry['provider'] == provider else None
+    if endpoint is not None:
+        route, model_name, get_api_key = endpoint['route'], endpoint['model'], endpoint['api_key']
+        if base_url is None:
+            base_url = endpoint['base_url']
+    else:
+        route, get_api_key = provider, _DEFAULT_API_KEY_GETTERS[provider]
+
+    # Offline runs need no keys: replay from a cassette, or send everything to a stand-in server
+    if _replaying():
+        return 'replay', model_name, base_url, api_key or 'offline'
+    # The stand-in's URL is swapped in when the request is sent (_transport_base_url), so cache and
+    # cassette keys stay those of the real endpoint rather than the stand-in's port
+    if get_standin_url() is not None:
+        return route, model_name, base_url, api_key or 'offline'
+
+    if api_key is None:
+        api_key = get_api_key()
+    return route, model_name, base_url, api_key
+
+def _hyperbolic_request(message, model_name, api_key, max_tokens, temperature, n):
+    """Build the (headers, json body) pair for a Hyperbolic chat completion"""
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+    # Convert messages to ensure compatibility
+    formatted_messages = [{"role": msg['role'], "content": msg['content']} for msg in message]
+    data = {
+        "messages": formatted_messages,
+        "model": model_name,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "top_p": 0.9,
+        "n": n
+    }
+    return headers, data
+
+def _strip_thinking(text):
+    """Remove the <think> {thoughts} </think> sections from a response"""
+    import re
+    return re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
+
+def _parse_hyperbolic_response(response_json, n, show_thinking):
+    message_strs = [choice['message']['content'] for choice in response_json['choices']]
+    if not show_thinking:
+        message_strs = [_strip_thinking(message_str) for message_str in message_strs]
+    return message_strs[0] if n == 1 else message_strs
+
+def _anthropic_request(message, model_name, max_tokens, temperature, cache_upto=0):
+    """
+    Convert openai-format messages into kwargs for Anthropic's messages.create.
+    The first cache_upto messages are the cacheable prefix: cache_control breakpoints are put on the
+    system prompt and on the last prefix turn.
+    """
+    system_prompt = None
+    system_cached = False
+    anthropic_messages = []
+    
+    for index, msg in enumerate(message):
+        if msg['role'] in ['system', 'developer']:
+            system_prompt = msg['content']
+            system_cached = index < cache_upto
+        elif msg['role'] in ['user', 'assistant']:
+            content = msg['content']
+            if index == cache_upto - 1:
+                content = [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]
+            anthropic_messages.append({"role": msg['role'], "content": content})
+    
+    kwargs = {
+        "model": model_name,
+        "messages": anthropic_messages,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+    }
+    
+    if system_prompt:
+        if system_cached:
+            kwargs["system"] = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+        else:
+            kwargs["system"] = system_prompt
+    return kwargs
+
+def _gemini_contents(message):
+    """Split openai-format messages into (system_prompt, contents) in Gemini's format"""
+    gemini_message = []
+    system_prompt = None # Initialize system_prompt
+
+    # Handle potential system prompt first
+    if message and (message[0]['role'] == 'system' or message[0]['role'] == 'developer'):
+        system_prompt = message[0]['content']
+        message_turns = message[1:] # Process the rest of the messages
+    else:
+        message_turns = message # Process all messages if no system prompt
+
+    for turn in message_turns:
+        # Each item in the 'parts' list should be a 'Part' object (e.g., {"text": "..."})
+        part = {"text": turn['content']} 
+        if turn['role'] == 'user':
+            gemini_message.append({"role": "user", "parts": [part]}) # Wrap Part object in list
+        elif turn['role'] == 'assistant':
+            gemini_message.append({"role": "model", "parts": [part]}) # Wrap Part object in list
+    return system_prompt, gemini_message
+
+def _gemini_request(message, model_name, n, thinking_budget, types, cached_content=None):
+    """
+    Convert openai-format messages into (contents, config) for Gemini's generate_content.
+    With cached_content (the name of an explicit cache holding the prefix), message is only the
+    part after the cached prefix.
+    """
+    system_prompt, gemini_message = _gemini_contents(message)
+
+    # Simplified API call logic
+    config = types.GenerateContentConfig(
+        safety_settings=[
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+                threshold=types.HarmBlockThreshold.BLOCK_NONE,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+                threshold=types.HarmBlockThreshold.BLOCK_NONE,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                threshold=types.HarmBlockThreshold.BLOCK_NONE,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+                threshold=types.HarmBlockThreshold.BLOCK_NONE,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_CIVIC_INTEGRITY,
+                threshold=types.HarmBlockThreshold.BLOCK_NONE,
+            ),
+        ],
+    )
+
+    # Add system instruction to config if it exists
+    if system_prompt:
+        config.system_instruction = system_prompt
+    if cached_content:
+        config.cached_content = cached_content
+    
+    if n > 1:
+        config.candidate_count = n
+    
+    # Configure thinking budget for models that support it
+    if model_name in GEMINI_THINKING_MODELS:
+        # Use provided thinking_budget or default to 0 for 2.5 flash preview
+        budget = thinking_budget if thinking_budget is not None else (0 if model_name == 'gemini-2.5-flash-preview-05-20' else None)
+        if budget is not None:
+            config.thinking_config = types.ThinkingConfig(thinking_budget=budget)
+    return gemini_message, config
+
+def _parse_gemini_response(response, n):
+    if n == 1:
+        return response.text
+    return [candidate.content.parts[0].text for candidate in response.candidates]
+
+# Prompt-prefix caching (cache_prompt=True). The cacheable prefix is the leading system/developer
+# messages, or everything up to and including the last message marked {'cache': True}.
+# Anthropic gets cache_control breakpoints, Gemini an explicit cached content created once per
+# prefix, and OpenAI (which caches prefixes automatically) a prompt_cache_key for routing.
+GEMINI_PROMPT_CACHE_TTL = 3600  # seconds an explicit Gemini cache lives
+_gemini_prompt_caches = {}  # prefix hash -> (cache name or None if creation failed, expiry timestamp)
+_gemini_prompt_caches_lock = threading.Lock()
+
+# Token usage of the last provider call made in the current thread / async task
+_last_usage = contextvars.ContextVar('last_usage', default=None)
+
+def _cached_prefix_length(message):
+    """Number of leading messages that form the cacheable prefix"""
+    marked = [index for index, msg in enumerate(message) if msg.get('cache')]
+    if marked:
+        return marked[-1] + 1
+    count = 0
+    while count < len(message) and message[count]['role'] in ('system', 'developer'):
+        count += 1
+    return count
+
+def _plain_messages(message):
+    """Drop the 'cache' markers before sending messages to OpenAI-compatible APIs"""
+    if any('cache' in msg for msg in message):
+        return [{key: value for key, value in msg.items() if key != 'cache'} for msg in message]
+    return message
+
+def _prefix_hash(message, cache_upto, model_name):
+    import hashlib
+    prefix = [{'role': msg['role'], 'content': msg['content']} for msg in message[:cache_upto]]
+    encoded = json.dumps({'model': model_name, 'prefix': prefix}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+def _openai_cache_args(message, model_name, base_url, cache_upto):
+    # prompt_cache_key keeps requests sharing a prefix on the same cache; only api.openai.com knows it
+    if cache_upto and base_url is None:
+        return {'prompt_cache_key': _prefix_hash(message, cache_upto, model_name)[:32]}
+    return {}
+
+def _gemini_cache_lookup(message, cache_upto, model_name, api_key=None):
+    """Return (key, found, name) for the explicit Gemini cache of this prefix"""
+    key = _prefix_hash(message, cache_upto, model_name)
+    if _key_pool_for(api_key) is not None:
+        # Caches belong to the key's project, so pooled keys each keep their own
+        import hashlib
+        key += ':' + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    with _gemini_prompt_caches_lock:
+        entry = _gemini_prompt_caches.get(key)
+    if entry is not None and entry[1] > time.time():
+        return key, True, entry[0]
+    return key, False, None
+
+def _gemini_cache_store(key, name):
+    # Stop using a cache a minute before the server expires it
+    with _gemini_prompt_caches_lock:
+        _gemini_prompt_caches[key] = (name, time.time() + GEMINI_PROMPT_CACHE_TTL - 60)
+
+def _gemini_cache_config(prefix, types):
+    system_prompt, contents = _gemini_contents(prefix)
+    return types.CreateCachedContentConfig(
+        system_instruction=system_prompt,
+        contents=contents or None,
+        ttl=f'{GEMINI_PROMPT_CACHE_TTL}s',
+    )
+
+def _gemini_cached_content(client, model_name, message, cache_upto, types, api_key=None):
+    """Name of the explicit cache holding message[:cache_upto], created on first use; None if unavailable"""
+    key, found, name = _gemini_cache_lookup(message, cache_upto, model_name, api_key)
+    if found:
+        return name
+    try:
+        name = client.caches.create(model=model_name, config=_gemini_cache_config(message[:cache_upto], types)).name
+    except Exception as e:
+        # Too short a prefix or an unsupported model; Gemini's implicit caching still applies
+        print (f"Gemini prompt cache unavailable for {model_name}: {e}")
+        name = None
+    _gemini_cache_store(key, name)
+    return name
+
+async def _agemini_cached_content(client, model_name, message, cache_upto, types, api_key=None):
+    """Async counterpart of _gemini_cached_content for client.aio"""
+    key, found, name = _gemini_cache_lookup(message, cache_upto, model_name, api_key)
+    if found:
+        return name
+    try:
+        cached = await client.caches.create(model=model_name, config=_gemini_cache_config(message[:cache_upto], types))
+        name = cached.name
+    except Exception as e:
+        print (f"Gemini prompt cache unavailable for {model_name}: {e}")
+        name = None
+    _gemini_cache_store(key, name)
+    return name
+
+def _gemini_prepare(client, model_name, message, n, thinking_budget, types, cache_upto, api_key=None):
+    """(contents, config) for generate_content, using an explicit prompt cache when cache_upto is set"""
+    cached_content = _gemini_cached_content(client, model_name, message, cache_upto, types, api_key) if cache_upto else None
+    if cached_content:
+        return _gemini_request(message[cache_upto:], model_name, n, thinking_budget, types, cached_content)
+    return _gemini_request(message, model_name, n, thinking_budget, types)
+
+def _field(obj, name):
+    if obj is None:
+        return None
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+def _openai_usage(usage):
+    """Token counts from an OpenAI-format usage object (SDK object or Hyperbolic JSON)"""
+    if usage is None:
+        return None
+    return {
+        'input_tokens': _field(usage, 'prompt_tokens'),
+        'cached_input_tokens': _field(_field(usage, 'prompt_tokens_details'), 'cached_tokens') or 0,
+        'cache_write_tokens': 0,
+        'output_tokens': _field(usage, 'completion_tokens'),
+    }
+
+def _anthropic_usage(usage):
+    # Anthropic's input_tokens only counts the uncached part of the prompt
+    cached = getattr(usage, 'cache_read_input_tokens', None) or 0
+    written = getattr(usage, 'cache_creation_input_tokens', None) or 0
+    return {
+        'input_tokens': usage.input_tokens + cached + written,
+        'cached_input_tokens': cached,
+        'cache_write_tokens': written,
+        'output_tokens': usage.output_tokens,
+    }
+
+def _gemini_usage(metadata):
+    if metadata is None:
+        return None
+    return {
+        'input_tokens': metadata.prompt_token_count,
+        'cached_input_tokens': metadata.cached_content_token_count or 0,
+        'cache_write_tokens': 0,
+        'output_tokens': metadata.candidates_token_count,
+    }
+
+def _finish_reason(value):
+    # Gemini reports an enum, the others a string
+    return getattr(value, 'name', value)
+
+def _record_usage(route, model_name, counts, finish_reason=None):
+    if not counts and finish_reason is None:
+        return None
+    usage = {'provider': route, 'model': model_name}
+    usage.update(counts or {})
+    if finish_reason is not None:
+        usage['finish_reason'] = _finish_reason(finish_reason)
+    if usage.get('input_tokens') is not None:
+        usage['uncached_input_tokens'] = usage['input_tokens'] - (usage.get('cached_input_tokens') or 0)
+    _last_usage.set(usage)
+    return usage
+
+def _record_samples_usage(route, model_name, responses):
+    """Record the summed usage of fanned-out Anthropic samples (the answered ones)"""
+    counts = {}
+    for response in responses:
+        for key, value in _anthropic_usage(response.usage).items():
+            counts[key] = counts.get(key, 0) + value
+    reasons = [response.stop_reason for response in responses]
+    # One truncated sample is worth reporting over the others' end_turn
+    finish_reason = 'max_tokens' if 'max_tokens' in reasons else (reasons[0] if reasons else None)
+    return _record_usage(route, model_name, counts, finish_reason)
+
+def get_last_usage():
+    """
+    Token usage of the last request this thread (or async task) sent to a provider:
+    input_tokens, cached_input_tokens (served from the provider's prompt cache),
+    uncached_input_tokens, cache_write_tokens (Anthropic cache writes), output_tokens and finish_reason.
+    None if the last call made no request (response cache hit, coalesced, or no usage reported).
+    """
+    return _last_usage.get()
+
+class ChatResult:
+    """
+    Returned by chat_complete(..., return_result=True).
+    .text is the response (Samples when n > 1) and .metrics its telemetry.CallMetrics.
+    """
+    def __init__(self, text, metrics):
+        self.text = text
+        self.metrics = metrics
+
+    @property
+    def finish_reason(self):
+        return self.metrics.finish_reason
+
+    @property
+    def usage(self):
+        return self.metrics.as_dict()
+
+    def __str__(self):
+        return str(self.text)
+
+    def __repr__(self):
+        return f"ChatResult(text={self.text!r}, metrics={self.metrics!r})"
+
+def _set_current_call(metrics):
+    from telemetry import current_call
+    return current_call.set(metrics)
+
+def _reset_current_call(token):
+    from telemetry import current_call
+    try:
+        current_call.reset(token)
+    except ValueError:
+        # A stream closed from a different context than the one it started in
+        pass
+
+def _finish_metrics(metrics, start, on_metrics, outcome=None):
+    """Complete a CallMetrics, add it to the registry and hand it to the per-call callback"""
+    from telemetry import registry
+    if outcome is not None:
+        metrics.outcome = outcome
+    if start is not None:
+        metrics.latency = time.perf_counter() - start
+    registry.record(metrics)
+    if on_metrics is not None:
+        try:
+            on_metrics(metrics)
+        except Exception as e:
+            print (f"on_metrics callback failed: {e}")
+
+def get_metrics_registry():
+    """The telemetry.MetricsRegistry aggregating every call in this process"""
+    from telemetry import registry
+    return registry
+
+def add_metrics_hook(hook):
+    """Call hook(metrics) with the telemetry.CallMetrics of every finished call"""
+    get_metrics_registry().add_hook(hook)
+
+def write_metrics(path):
+    """Export aggregated metrics: a JSON snapshot for *.json paths, else Prometheus text format"""
+    registry = get_metrics_registry()
+    if path.endswith('.json'):
+        registry.write_json(path)
+    else:
+        registry.write_prometheus(path)
+
+# LLM_METRICS_FILE exports the metrics when the process exits (also set for run_main.py subprocesses)
+if os.environ.get('LLM_METRICS_FILE'):
+    atexit.register(lambda: write_metrics(os.environ['LLM_METRICS_FILE']))
+
 def chat_complete(message, 
                   model_name='gemini-2.0-flash', # openai format
                   provider=None,
@@ -225,6 +1682,15 @@ def chat_complete(message,
                   api_key=None,
                   thinking_budget=None,  # None means use default behavior
                   show_thinking=False,
+                  stream=False,
+                  use_cache=None,
+                  coalesce=True,
+                  cache_prompt=False,
+                  return_result=False,
+                  on_metrics=None,
+                  hedge=None,
+                  max_retries=None,
+                  timeout=None,
                   ):
     """
     A wrapper function to call chat completion from different providers
@@ -234,257 +1700,963 @@ def chat_complete(message,
         provider: the provider to use for chat completion. If None, it will be inferred based on the model_name.
         max_tokens: the maximum number of tokens to generate.
         temperature: the temperature for sampling.
+        stream: if True, return a ChatStream that yields text deltas as they arrive (n must be 1).
+        use_cache: None follows the response cache policy (see configure_cache), False bypasses
+            the cache for this call, True uses it even when the temperature policy would not.
+        coalesce: if True, a request identical to one already in flight (from any thread or async
+            task) waits for and shares that call's result instead of calling the provider again.
+            Pass False when you want independent samples. Streams are never coalesced.
+        cache_prompt: if True, ask the provider to cache the stable prompt prefix: the leading
+            system messages, or every message up to the last one marked {'cache': True}. Put
+            static content first. get_last_usage() reports how many input tokens were cached.
+        return_result: if True, return a ChatResult (the response plus its CallMetrics) instead
+            of the bare response. Streams carry their metrics as ChatStream.metrics.
+        on_metrics: callable receiving the telemetry.CallMetrics of this call once it finishes
+            (see also add_metrics_hook for every call).
+        hedge: None follows the hedging policy (see configure_hedging), False never hedges this
+            call, True hedges it even if hedging was not configured (with the default settings,
+            leaving later calls unaffected). Only n=1 calls are hedged.
+        max_retries: retries for transient errors (None: the configure_resilience default).
+            Streams are only retried before the first chunk arrives.
+        timeout: seconds each request attempt may take (None: the SDK default). Under a deadline
+            (EVOLVE_DEADLINE or deadline.deadline_scope) it is cut to the time left: retries stop
+            once they would overrun it, a call that can no longer start raises
+            deadline.DeadlineExceeded, and a stream ends at the deadline with the text received so
+            far and finish_reason 'deadline'.
     """
-    # Determine provider if not specified
-    if provider is None:
-        provider, model_name = get_model_provider(model_name)
-        if provider is None:
-            raise ValueError('Please specify a valid provider or model name')
-    
-    if provider == 'openai':
-        # Handle Together models with their full names
-        together_to_full_name = TOGETHER_MODEL_MAPPING
-        
-        # Check if it's a Together model
-        is_together = model_name in together_to_full_name
-        if is_together:
-            model_name = together_to_full_name[model_name]
-            if base_url is None:
-                base_url = 'https://api.together.xyz/v1'
-            # Use Together API key
-            if api_key is None:
-                api_key = get_together_api_key()
-        # Check if it's a Hyperbolic model
-        elif model_name in HYPERBOLIC_MODEL_MAPPING:
-            model_name = HYPERBOLIC_MODEL_MAPPING[model_name]
-            # Use Hyperbolic API directly with requests
-            
-            if api_key is None:
-                api_key = get_hyperbolic_api_key()
-            
-            url = base_url or "https://api.hyperbolic.xyz/v1/chat/completions"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-            
-            # Convert messages to ensure compatibility
-            formatted_messages = []
-            for msg in message:
-                formatted_messages.append({
-                    "role": msg['role'],
-                    "content": msg['content']
-                })
-            
-            data = {
-                "messages": formatted_messages,
-                "model": model_name,
-                "max_tokens": max_tokens,
-                "temperature": temperature,
-                "top_p": 0.9,
-                "n": n
-            }
-            
-            response = requests.post(url, headers=headers, json=data)
-            response_json = response.json()
-            
-            if response.status_code != 200:
-                raise Exception(f"Hyperbolic API error: {response_json}")
-            
-            import re
-            
-            if n == 1:
-                message_str = response_json['choices'][0]['message']['content']
-                if not show_thinking:
-                    # remove the <think> {thoughts} </think> from the response, and only return the content
-                    message_str = re.sub(r'<think>.*?</think>', '', message_str, flags=re.DOTALL)
-                return message_str
-            else:
-                message_strs = [choice['message']['content'] for choice in response_json['choices']]
-                if not show_thinking:
-                    # remove the <think> {thoughts} </think> from the response, and only return the content
-                    message_strs = [re.sub(r'<think>.*?</think>', '', message_str, flags=re.DOTALL) for message_str in message_strs]
-                return message_strs
+    from telemetry import CallMetrics
+    requested_model = model_name
+    route, model_name, base_url, api_key = _resolve_route(model_name, provider, base_url, api_key)
+    if stream and n != 1:
+        raise ValueError('stream=True only supports n=1')
+    _last_usage.set(None)
+    cache_upto = _cached_prefix_length(message) if cache_prompt else 0
+    metrics = CallMetrics(route, model_name, stream=stream)
+
+    cache = _cache_for_call(use_cache, temperature)
+    recorder = _recording_cassette()
+    if cache is not None or recorder is not None or (coalesce and not stream):
+        cache_key = _request_key(message, model_name, base_url, max_tokens, temperature, n, thinking_budget, show_thinking)
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            _finish_metrics(metrics, None, on_metrics, outcome='cache_hit')
+            if stream:
+                response = ChatStream(lambda usage: iter([cached]), route, model_name, show_thinking=True)
+                response.metrics = metrics
+                return response
+            return ChatResult(cached, metrics) if return_result else cached
+
+    policy = _hedge_policy_for_call(hedge, n)
+    hedge_target = _hedge_target(policy, requested_model, route, model_name, base_url, api_key) if policy is not None else None
+
+    if stream:
+        response = _stream_chat_complete(route, message, model_name, base_url, api_key, max_tokens, temperature, thinking_budget, show_thinking, cache_upto, metrics, on_metrics, policy, hedge_target, max_retries, timeout)
+        def on_complete(text):
+            if cache is not None and response.stats['model'] == model_name:
+                cache.set(cache_key, text)
+            if recorder is not None:
+                _record_call(recorder, cache_key, route, model_name, message, base_url, max_tokens, temperature, n, thinking_budget, show_thinking, text, response.stats['total_time'], response.stats['ttft'], stream=True)
+        if cache is not None or recorder is not None:
+            response.on_complete = on_complete
+        return response
+
+    led = []
+    def call():
+        led.append(True)
+        call_start = time.perf_counter()
+        answered_by = (route, model_name)
+        if policy is not None:
+            response, answered_by = _hedged_call(policy, hedge_target, route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto, max_retries, timeout)
         else:
-            # Use OpenAI API key
-            if api_key is None:
-                api_key = get_openai_api_key()
-            
-        # Initialize the client with the determined key
-        from openai import OpenAI
-        client = OpenAI(
-            api_key=api_key,
-            base_url=base_url
-        )
+            response = _resilient_call(route, base_url, max_retries, lambda: _call_provider(route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto, timeout))
+        fallback_won = answered_by[1] != model_name
+        if fallback_won:
+            metrics.provider, metrics.model = answered_by
+        # Partial fan-out results are returned but not cached, nor is a fallback model's answer under this model's key
+        if response is not None and not getattr(response, 'errors', None):
+            if cache is not None and not fallback_won:
+                cache.set(cache_key, response)
+            if recorder is not None:
+                _record_call(recorder, cache_key, route, model_name, message, base_url, max_tokens, temperature, n, thinking_budget, show_thinking, response, time.perf_counter() - call_start)
+        return response
 
-        chat_completion = client.chat.completions.create(
-            model=model_name,
-            messages=message,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            n=n,
-        )
+    token = _set_current_call(metrics)
+    start = time.perf_counter()
+    try:
+        response = _get_single_flight().do(cache_key, call) if coalesce else call()
+    except Exception as e:
+        metrics.error = f"{type(e).__name__}: {e}"
+        _finish_metrics(metrics, start, on_metrics, outcome='error')
+        raise
+    finally:
+        _reset_current_call(token)
+    metrics.set_usage(_last_usage.get())
+    _finish_metrics(metrics, start, on_metrics, outcome='ok' if led else 'coalesced')
+    return ChatResult(response, metrics) if return_result else response
+
+# Upper bound on concurrent requests when n > 1 is emulated by fanning out single-sample calls
+FANOUT_MAX_CONCURRENCY = 8
+
+class Samples(list):
+    """
+    The list of completions returned when n > 1.
+    timings[i] is the latency in seconds of the request that produced self[i]; candidates
+    generated together by a provider's native n / candidate_count share one timing.
+    errors lists (sample_index, exception) for fanned-out samples that failed, so callers get
+    what succeeded instead of losing the whole call.
+    """
+    def __init__(self, texts=(), timings=None, errors=None):
+        super().__init__(texts)
+        self.timings = list(timings) if timings is not None else []
+        self.errors = list(errors) if errors is not None else []
+
+def _native_samples(texts, elapsed):
+    return Samples(texts, timings=[elapsed] * len(texts))
+
+def _report_failed_samples(errors, n):
+    if errors:
+        print (f"Warning: {len(errors)} of {n} samples failed: {errors[0][1]}")
+
+def _fan_out(call_one, n, max_concurrency=None):
+    """Run call_one() n times on up to max_concurrency threads and collect a Samples list"""
+    import concurrent.futures
+
+    def timed():
+        start = time.perf_counter()
+        text = call_one()
+        return text, time.perf_counter() - start
+
+    texts, timings, errors = [], [], []
+    workers = min(n, max_concurrency or FANOUT_MAX_CONCURRENCY)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(timed) for _ in range(n)]
+        for index, future in enumerate(futures):
+            try:
+                text, elapsed = future.result()
+            except Exception as e:
+                errors.append((index, e))
+                continue
+            texts.append(text)
+            timings.append(elapsed)
+    if not texts:
+        raise errors[0][1]
+    _report_failed_samples(errors, n)
+    return Samples(texts, timings, errors)
+
+async def _afan_out(call_one, n, max_concurrency=None):
+    """Async counterpart of _fan_out; call_one() returns a coroutine"""
+    import asyncio
+    semaphore = asyncio.Semaphore(max_concurrency or FANOUT_MAX_CONCURRENCY)
+
+    async def timed():
+        async with semaphore:
+            start = time.perf_counter()
+            text = await call_one()
+            return text, time.perf_counter() - start
+
+    results = await asyncio.gather(*[timed() for _ in range(n)], return_exceptions=True)
+    texts, timings, errors = [], [], []
+    for index, result in enumerate(results):
+        if isinstance(result, Exception):
+            errors.append((index, result))
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            texts.append(result[0])
+            timings.append(result[1])
+    if not texts:
+        raise errors[0][1]
+    _report_failed_samples(errors, n)
+    return Samples(texts, timings, errors)
+
+def _call_provider(route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto=0, timeout=None):
+    """Send one request (see _send_request), taking the key from its pool when api_key belongs to one"""
+    pool = _key_pool_for(api_key)
+    if pool is None:
+        return _send_request(route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto, timeout)
+    return _with_pooled_key(pool, _reserved_tokens(message, model_name, max_tokens, n), lambda key: _send_request(route, message, model_name, base_url, key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto, timeout))
+
+def _send_request(route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto=0, timeout=None):
+    """
+    Send one request to the resolved route and return the response text (Samples when n > 1).
+    cache_upto is the length of the cacheable prompt prefix (0: no prompt caching); timeout caps
+    the request, which is further limited by the current deadline.
+    """
+    timeout = _request_timeout(timeout)
+    if route == 'replay':
+        key = _request_key(message, model_name, base_url, max_tokens, temperature, n, thinking_budget, show_thinking)
+        return _replay_response(get_cassette().play(key, model_name))
+    base_url = _transport_base_url(route, base_url)
+
+    if route == 'hyperbolic':
+        # Use Hyperbolic API directly over a pooled keep-alive session
+        headers, data = _hyperbolic_request(message, model_name, api_key, max_tokens, temperature, n)
+        start = time.perf_counter()
+        with _client_pool.lease(('hyperbolic', base_url, api_key), _make_hyperbolic_session) as session:
+            response = session.post(base_url, headers=headers, json=data, **_timeout_args(timeout))
+            response_json = response.json()
+        
+        if response.status_code != 200:
+            raise ProviderHTTPError(f"Hyperbolic API error: {response_json}", response.status_code, response.headers)
+        _record_usage(route, model_name, _openai_usage(response_json.get('usage')), response_json['choices'][0].get('finish_reason'))
+        result = _parse_hyperbolic_response(response_json, n, show_thinking)
+        return result if n == 1 else _native_samples(result, time.perf_counter() - start)
+
+    elif route == 'openai':
+        # Reuse a pooled client for the determined key and endpoint
+        start = time.perf_counter()
+        with _client_pool.lease(('openai', base_url, api_key), lambda: _make_openai_client(api_key, base_url)) as client:
+            chat_completion = client.chat.completions.create(
+                model=model_name,
+                messages=_plain_messages(message),
+                max_tokens=max_tokens,
+                temperature=temperature,
+                n=n,
+                **_openai_cache_args(message, model_name, base_url, cache_upto),
+                **_timeout_args(timeout),
+            )
+        _record_usage(route, model_name, _openai_usage(chat_completion.usage), chat_completion.choices[0].finish_reason)
 
         if n == 1:
             return chat_completion.choices[0].message.content
         else:
-            return [choice.message.content for choice in chat_completion.choices]
-        
-                
+            return _native_samples([choice.message.content for choice in chat_completion.choices], time.perf_counter() - start)
 
-    elif provider == 'anthropic':
+    elif route == 'anthropic':
         try:
-            import anthropic
+            anthropic = _import_sdk('anthropic')
         except:
             print ("Please install anthropic with: ")
             print ("pip install anthropic")
             return None
             
-        # Use provided API key or get from environment
-        if api_key is None:
-            api_key = get_anthropic_api_key()
-            
-        # client = anthropic.Anthropic(api_key=api_key)
-        client = anthropic.Anthropic()
-        
-        # Convert messages to Anthropic format
-        system_prompt = None
-        anthropic_messages = []
-        
-        for msg in message:
-            if msg['role'] in ['system', 'developer']:
-                system_prompt = msg['content']
-            elif msg['role'] == 'user':
-                anthropic_messages.append({"role": "user", "content": msg['content']})
-            elif msg['role'] == 'assistant':
-                anthropic_messages.append({"role": "assistant", "content": msg['content']})
-        
-        # Create message with Anthropic API
-        kwargs = {
-            "model": model_name,
-            "messages": anthropic_messages,
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-        }
-        
-        if system_prompt:
-            kwargs["system"] = system_prompt
-            
-        response = client.messages.create(**kwargs)
-        
-        # Handle n > 1 by making multiple calls (Anthropic doesn't support n parameter)
-        if n == 1:
-            return response.content[0].text
-        else:
-            responses = [response.content[0].text]
-            for _ in range(n - 1):
+        kwargs = _anthropic_request(message, model_name, max_tokens, temperature, cache_upto)
+        kwargs.update(_timeout_args(timeout))
+        with _client_pool.lease(('anthropic', base_url, api_key), lambda: _make_anthropic_client(api_key, base_url)) as client:
+            if n == 1:
                 response = client.messages.create(**kwargs)
-                responses.append(response.content[0].text)
-            return responses
+                _record_usage(route, model_name, _anthropic_usage(response.usage), response.stop_reason)
+                return response.content[0].text
+            # Anthropic doesn't support n, so fan the samples out concurrently
+            responses = []
+            def call_one():
+                response = client.messages.create(**kwargs)
+                responses.append(response)
+                return response.content[0].text
+            try:
+                return _fan_out(call_one, n)
+            finally:
+                _record_samples_usage(route, model_name, responses)
 
-    elif provider == 'google':
+    elif route == 'google':
         try:
-            from google import genai
-            from google.genai import types
+            genai = _import_sdk('google.genai')
+            types = _import_sdk('google.genai.types')
         except:
             print ("Please install google-genai with: ")
             print ("pip install -q -U google-genai")
             return None
 
-        # Use provided API key or get from environment
-        if api_key is None:
-            api_key = get_google_api_key()
-            
-        client = genai.Client(api_key=api_key)
+        start = time.perf_counter()
+        with _client_pool.lease(('google', base_url, api_key), lambda: _make_google_client(api_key, base_url)) as client:
+            contents, config = _gemini_prepare(client, model_name, message, n, thinking_budget, types, cache_upto, api_key)
+            response = client.models.generate_content(
+                model=model_name,
+                config=_gemini_timeout(config, timeout, types),
+                contents=contents
+            )
+        _record_usage(route, model_name, _gemini_usage(response.usage_metadata), response.candidates[0].finish_reason if response.candidates else None)
+        result = _parse_gemini_response(response, n)
+        return result if n == 1 else _native_samples(result, time.perf_counter() - start)
+
+class ThinkStripper:
+    """
+    Incrementally removes <think>...</think> sections from streamed text.
+    Tags split across chunks are handled by holding back a possible partial tag.
+    Matches the non-streaming behavior: an unterminated <think> section is kept as-is.
+    """
+    OPEN = '<think>'
+    CLOSE = '</think>'
+
+    def __init__(self):
+        self._buffer = ''
+        self._thinking = None  # text of the open <think> section, None when outside one
 
-        gemini_message = []
-        system_prompt = None # Initialize system_prompt
+    def feed(self, text):
+        """Add a chunk of text and return the part that can be emitted now"""
+        self._buffer += text
+        out = []
+        while self._buffer:
+            if self._thinking is None:
+                idx = self._buffer.find(self.OPEN)
+                if idx >= 0:
+                    out.append(self._buffer[:idx])
+                    self._buffer = self._buffer[idx + len(self.OPEN):]
+                    self._thinking = ''
+                    continue
+                keep = _partial_suffix(self._buffer, self.OPEN)
+                out.append(self._buffer[:len(self._buffer) - keep])
+                self._buffer = self._buffer[len(self._buffer) - keep:]
+            else:
+                idx = self._buffer.find(self.CLOSE)
+                if idx >= 0:
+                    self._buffer = self._buffer[idx + len(self.CLOSE):]
+                    self._thinking = None
+                    continue
+                keep = _partial_suffix(self._buffer, self.CLOSE)
+                self._thinking += self._buffer[:len(self._buffer) - keep]
+                self._buffer = self._buffer[len(self._buffer) - keep:]
+            break
+        return ''.join(out)
 
-        # Handle potential system prompt first
-        if message and (message[0]['role'] == 'system' or message[0]['role'] == 'developer'):
-            system_prompt = message[0]['content']
-            message_turns = message[1:] # Process the rest of the messages
+    def flush(self):
+        """Return whatever is still held back once the stream has ended"""
+        if self._thinking is None:
+            tail = self._buffer
         else:
-            message_turns = message # Process all messages if no system prompt
-
-        for turn in message_turns:
-            # Each item in the 'parts' list should be a 'Part' object (e.g., {"text": "..."})
-            part = {"text": turn['content']} 
-            if turn['role'] == 'user':
-                gemini_message.append({"role": "user", "parts": [part]}) # Wrap Part object in list
-            elif turn['role'] == 'assistant':
-                gemini_message.append({"role": "model", "parts": [part]}) # Wrap Part object in list
-
-        # Simplified API call logic
-        config = types.GenerateContentConfig(
-            safety_settings=[
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
-                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_CIVIC_INTEGRITY,
-                    threshold=types.HarmBlockThreshold.BLOCK_NONE,
-                ),
-            ],
-        )
+            tail = self.OPEN + self._thinking + self._buffer
+        self._buffer = ''
+        self._thinking = None
+        return tail
 
-        # Add system instruction to config if it exists
-        if system_prompt:
-            config.system_instruction = system_prompt
-        
-        if n > 1:
-            config.candidate_count = n
-        
-        # Configure thinking budget for models that support it
-        thinking_models = ['gemini-2.5-pro-preview-05-06', 'gemini-2.5-flash-preview-05-20']
-        if model_name in thinking_models:
-            # Use provided thinking_budget or default to 0 for 2.5 flash preview
-            budget = thinking_budget if thinking_budget is not None else (0 if model_name == 'gemini-2.5-flash-preview-05-20' else None)
-            if budget is not None:
-                config.thinking_config = types.ThinkingConfig(thinking_budget=budget)
-
-        response = client.models.generate_content(
-            model=model_name,
-            config=config,
-            contents=gemini_message
+def _partial_suffix(text, tag):
+    """Length of the longest suffix of text that is a proper prefix of tag"""
+    for size in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:size]):
+            return size
+    return 0
+
+# Opening fence: up to 3 spaces of indent, 3+ backticks or tildes, then an optional info string.
+# Models sometimes open a block at the end of a line of prose ("Here it is: ```python"), which is
+# accepted when the fence names a language.
+_fence_patterns = None
+PYTHON_LANGUAGES = ('python', 'py', 'python3')
+
+def _fence_re():
+    global _fence_patterns
+    if _fence_patterns is None:
+        import re
+        _fence_patterns = (
+            re.compile(r'^( {0,3})(`{3,}|~{3,})[ \t]*([^\s`]*)[^`]*$'),
+            re.compile(r'()(`{3,}|~{3,})([A-Za-z][\w+-]*)[ \t]*$'),
         )
-        if n == 1:
-            return response.text
+    return _fence_patterns
+
+def _compiles(code):
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            compile(code, '<code block>', 'exec', dont_inherit=True)
+        except (SyntaxError, ValueError):
+            return False
+    return True
+
+class CodeBlockParser:
+    """
+    Incrementally extracts fenced code blocks from streamed text.
+    feed() takes chunks as they arrive; .target is set as soon as the first closed block in
+    `language` (None: any language) is complete, so the caller can stop the generation there.
+    Fences inside <think> sections are ignored. Each block in .blocks is a dict with
+    'language' and 'code'.
+
+    Python blocks often contain fences themselves (e.g. a prompt string holding ```python),
+    so a bare ``` line only closes a Python block if the code before it compiles; if none does,
+    finish() closes the block at its last bare fence. A block the
+    stream ended inside of is never the target; .truncated says that happened.
+    """
+    def __init__(self, language='python'):
+        self.language = language
+        self.blocks = []
+        self.target = None
+        self._line = ''
+        self._thinking = False
+        self._open = None  # the block being read: dict plus its fence and indent
+        self.truncated = False
+
+    @property
+    def done(self):
+        return self.target is not None
+
+    def _wanted(self, language):
+        if self.language is None:
+            return True
+        wanted = PYTHON_LANGUAGES if self.language in PYTHON_LANGUAGES else (self.language,)
+        return language in wanted
+
+    def feed(self, text):
+        """Add a chunk of text; returns True once the target block is complete"""
+        self._line += text
+        while '\n' in self._line and not self.done:
+            line, self._line = self._line.split('\n', 1)
+            self._feed_line(line)
+        return self.done
+
+    def finish(self):
+        """Process the last (unterminated) line at the end of the stream; returns the target code or None"""
+        if self._line and not self.done:
+            line, self._line = self._line, ''
+            self._feed_line(line)
+        if self._open is not None:
+            block = self._open
+            if block['candidates']:
+                # No bare fence made the code compile: fall back to the last one
+                self._close(block, block['candidates'][-1])
+            else:
+                self.truncated = True
+            self._open = None
+        return self.code
+
+    @property
+    def code(self):
+        return self.target['code'] if self.target is not None else None
+
+    def _feed_line(self, line):
+        if self._open is not None:
+            self._code_line(line)
+            return
+        # Outside code blocks: skip <think> sections, then look for an opening fence
+        while True:
+            if self._thinking:
+                idx = line.find(ThinkStripper.CLOSE)
+                if idx < 0:
+                    return
+                line = line[idx + len(ThinkStripper.CLOSE):]
+                self._thinking = False
+            idx = line.find(ThinkStripper.OPEN)
+            if idx < 0:
+                break
+            line = line[idx + len(ThinkStripper.OPEN):]
+            self._thinking = True
+        line_start, inline = _fence_re()
+        match = line_start.match(line) or inline.search(line)
+        if match is not None:
+            indent, fence, language = match.groups()
+            self._open = {
+                'language': language.lower(), 'fence': fence, 'indent': len(indent),
+                'lines': [], 'candidates': [],
+            }
+
+    def _code_line(self, line):
+        block = self._open
+        stripped = line.strip()
+        fence = block['fence']
+        is_fence = (len(line) - len(line.lstrip(' ')) <= 3 and stripped
+                    and set(stripped) == {fence[0]} and len(stripped) >= len(fence))
+        if is_fence:
+            if block['language'] not in PYTHON_LANGUAGES or _compiles('\n'.join(block['lines'])):
+                self._close(block, len(block['lines']))
+                self._open = None
+                return
+            block['candidates'].append(len(block['lines']))
+        # Content lines lose up to the opening fence's indentation
+        indent = min(block['indent'], len(line) - len(line.lstrip(' ')))
+        block['lines'].append(line[indent:])
+
+    def _close(self, block, end):
+        result = {'language': block['language'], 'code': '\n'.join(block['lines'][:end]).strip()}
+        self.blocks.append(result)
+        if self.target is None and self._wanted(result['language']):
+            self.target = result
+
+def extract_code(text, language='python'):
+    """Return the first complete fenced code block in `language` from a full response, or None"""
+    parser = CodeBlockParser(language)
+    parser.feed(text)
+    return parser.finish()
+
+def extract_code_stream(stream, language='python', on_text=None, stop_early=True):
+    """
+    Read a stream (e.g. chat_complete(..., stream=True)) until the first complete code block in
+    `language` and return its code, or None if the response has no complete block.
+    on_text is called with each delta as it arrives. With stop_early, the stream is closed as
+    soon as the block's closing fence arrives, which cancels the rest of the generation.
+    """
+    parser = CodeBlockParser(language)
+    for delta in stream:
+        if on_text is not None:
+            on_text(delta)
+        if parser.feed(delta) and stop_early:
+            if hasattr(stream, 'close'):
+                stream.close()
+            break
+    return parser.finish()
+
+class ChatStream:
+    """
+    Iterator of text deltas returned by chat_complete(..., stream=True).
+    The request is sent on the first next(). Once the stream is exhausted, .text holds the
+    full response and .stats the timing of the call:
+        ttft: seconds from sending the request to the first token
+        total_time: seconds from sending the request to the end of the stream
+        output_tokens: tokens generated (provider-reported, else estimated at 4 chars/token)
+        tokens_per_sec: output_tokens over the time spent generating after the first token
+        input_tokens / cached_input_tokens: prompt size and the part served from the provider's
+            prompt cache, when the provider reports them
+    .metrics is the call's telemetry.CallMetrics, recorded when the stream ends (or is closed).
+    Under a deadline the stream ends quietly once it passes, keeping the text received so far;
+    get_last_usage() then reports finish_reason 'deadline'.
+    """
+    def __init__(self, chunks, provider, model_name, show_thinking=False, metrics=None, on_metrics=None):
+        self._chunks = chunks
+        self._usage = {}
+        self._stripper = None if show_thinking else ThinkStripper()
+        self._gen = self._run()
+        self._track = metrics is not None  # record metrics at the end of the stream
+        self.metrics = metrics
+        self.on_metrics = on_metrics
+        self.on_complete = None  # called with the full text once the stream ends normally (stats are final by then)
+        from deadline import current_deadline
+        self._deadline = current_deadline()
+        self.text = ''
+        self.stats = {
+            'provider': provider,
+            'model': model_name,
+            'ttft': None,
+            'total_time': None,
+            'output_tokens': None,
+            'tokens_per_sec': None,
+            'input_tokens': None,
+            'cached_input_tokens': None,
+        }
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._gen)
+
+    def close(self):
+        """Stop the stream early and release the underlying connection"""
+        self._gen.close()
+
+    def _run(self):
+        start = time.perf_counter()
+        raw_chars = 0
+        outcome = 'ok'
+        completed = False
+        # Lets the connection trace hooks find this call while the request is being sent
+        token = _set_current_call(self.metrics) if self._track else None
+        try:
+            if self._deadline is None:
+                chunks = self._chunks(self._usage)
+            else:
+                from deadline import iterate_until
+                chunks = iterate_until(lambda: self._chunks(self._usage), self._deadline)
+            try:
+                for raw in chunks:
+                    if not raw:
+                        continue
+                    if self.stats['ttft'] is None:
+                        self.stats['ttft'] = time.perf_counter() - start
+                    raw_chars += len(raw)
+                    delta = self._stripper.feed(raw) if self._stripper else raw
+                    if delta:
+                        self.text += delta
+                        yield delta
+                completed = True
+            except Exception:
+                if self._deadline is None or not self._deadline.expired():
+                    raise
+                # Out of time (a timeout error or the deadline itself): end with what arrived
+                self._usage['finish_reason'] = 'deadline'
+            if self._stripper:
+                tail = self._stripper.flush()
+                if tail:
+                    self.text += tail
+                    yield tail
+        except GeneratorExit:
+            outcome = 'cancelled'
+            raise
+        except Exception as e:
+            outcome = e
+            raise
+        finally:
+            total = time.perf_counter() - start
+            output_tokens = self._usage.get('output_tokens') or max(1, raw_chars // 4)
+            generating = total - (self.stats['ttft'] or 0)
+            self.stats['total_time'] = total
+            self.stats['output_tokens'] = output_tokens
+            self.stats['tokens_per_sec'] = output_tokens / generating if generating > 0 else None
+            self.stats['input_tokens'] = self._usage.get('input_tokens')
+            self.stats['cached_input_tokens'] = self._usage.get('cached_input_tokens')
+            usage = _record_usage(self.stats['provider'], self.stats['model'], self._usage)
+            if completed and self.on_complete is not None:
+                self.on_complete(self.text)
+            if self._track:
+                _reset_current_call(token)
+                self.metrics.ttft = self.stats['ttft']
+                self.metrics.latency = total
+                self.metrics.set_usage(usage)
+                self.metrics.output_tokens = output_tokens
+                if outcome == 'cancelled':
+                    self.metrics.finish_reason = 'cancelled'
+                elif outcome != 'ok':
+                    self.metrics.error = f"{type(outcome).__name__}: {outcome}"
+                    self.metrics.outcome = 'error'
+                _finish_metrics(self.metrics, None, self.on_metrics)
+
+def _stream_chat_complete(route, message, model_name, base_url, api_key, max_tokens, temperature, thinking_budget, show_thinking, cache_upto=0, metrics=None, on_metrics=None, hedge_policy=None, hedge_target=None, max_retries=None, timeout=None):
+    """Build a ChatStream for the resolved route, hedged on time to first token when hedge_policy is given"""
+    chunks = _resilient_chunks(route, base_url, max_retries, _stream_chunks(route, message, model_name, base_url, api_key, max_tokens, temperature, thinking_budget, cache_upto, show_thinking, timeout))
+    if hedge_policy is not None:
+        hedge_route, hedge_model, hedge_base_url, hedge_api_key = hedge_target
+        hedge_chunks = _resilient_chunks(hedge_route, hedge_base_url, max_retries, _stream_chunks(hedge_route, message, hedge_model, hedge_base_url, hedge_api_key, max_tokens, temperature, thinking_budget, cache_upto, show_thinking, timeout))
+
+        def on_fallback():
+            # The fallback model is answering: report it as the model (chat_complete then doesn't cache the text)
+            stream.stats['provider'], stream.stats['model'] = hedge_route, hedge_model
+            if metrics is not None:
+                metrics.provider, metrics.model = hedge_route, hedge_model
+        chunks = _hedged_chunks(hedge_policy, model_name, chunks, hedge_model, hedge_chunks, on_fallback)
+    # Only Hyperbolic responses get <think> sections stripped, as in the non-streaming path
+    stream = ChatStream(chunks, route, model_name, show_thinking=show_thinking or route != 'hyperbolic', metrics=metrics, on_metrics=on_metrics)
+    return stream
+
+def _hedged_chunks(policy, model_name, primary_chunks, hedge_model, hedge_chunks, on_fallback=None):
+    """
+    Chunk source racing primary_chunks against hedge_chunks; usage comes from whichever streamed.
+    on_fallback() is called before the first chunk if the hedge won and went to another model.
+    """
+    def chunks(usage):
+        primary_usage, hedge_usage = {}, {}
+        from_hedge = started = False
+        for from_hedge, chunk in policy.stream(model_name, lambda: primary_chunks(primary_usage), lambda: hedge_chunks(hedge_usage), hedge_key=hedge_model):
+            if not started:
+                started = True
+                if from_hedge and hedge_model != model_name and on_fallback is not None:
+                    on_fallback()
+            yield chunk
+        usage.update(hedge_usage if from_hedge else primary_usage)
+    return chunks
+
+def _stream_chunks(route, message, model_name, base_url, api_key, max_tokens, temperature, thinking_budget, cache_upto=0, show_thinking=False, timeout=None):
+    """Chunk source for a stream (see _provider_chunks); each attempt takes a key from api_key's pool if it belongs to one"""
+    pool = _key_pool_for(api_key)
+    if pool is None:
+        return _provider_chunks(route, message, model_name, base_url, api_key, max_tokens, temperature, thinking_budget, cache_upto, show_thinking, timeout)
+    return _pooled_chunks(pool, _reserved_tokens(message, model_name, max_tokens), lambda key: _provider_chunks(route, message, model_name, base_url, key, max_tokens, temperature, thinking_budget, cache_upto, show_thinking, timeout))
+
+def _provider_chunks(route, message, model_name, base_url, api_key, max_tokens, temperature, thinking_budget, cache_upto=0, show_thinking=False, timeout=None):
+    """
+    Return the chunk source for a stream on the resolved route; it fills usage with the provider's
+    token counts and finish reason if it reports them. Each attempt's timeout (which bounds the
+    connection and every read) is worked out when it starts, from timeout and the current deadline.
+    """
+    if route != 'replay':
+        base_url = _transport_base_url(route, base_url)
+    if route == 'replay':
+        key = _request_key(message, model_name, base_url, max_tokens, temperature, 1, thinking_budget, show_thinking)
+
+        def chunks(usage):
+            entry, pieces = get_cassette().chunks(key, model_name)
+            yield from pieces
+            usage.update({name: value for name, value in (entry.get('usage') or {}).items() if name not in ('provider', 'model')})
+
+    elif route == 'hyperbolic':
+        headers, data = _hyperbolic_request(message, model_name, api_key, max_tokens, temperature, 1)
+        data['stream'] = True
+
+        def chunks(usage):
+            with _client_pool.lease(('hyperbolic', base_url, api_key), _make_hyperbolic_session) as session:
+                with session.post(base_url, headers=headers, json=data, stream=True, **_timeout_args(_request_timeout(timeout))) as response:
+                    if response.status_code != 200:
+                        raise ProviderHTTPError(f"Hyperbolic API error: {response.text}", response.status_code, response.headers)
+                    response.encoding = 'utf-8'
+                    for line in response.iter_lines(decode_unicode=True):
+                        if not line or not line.startswith('data:'):
+                            continue
+                        payload = line[len('data:'):].strip()
+                        if payload == '[DONE]':
+                            break
+                        chunk = json.loads(payload)
+                        if chunk.get('usage'):
+                            usage.update(_openai_usage(chunk['usage']))
+                        for choice in chunk.get('choices') or []:
+                            if choice.get('finish_reason'):
+                                usage['finish_reason'] = choice['finish_reason']
+                            yield (choice.get('delta') or {}).get('content')
+
+    elif route == 'openai':
+        # Only api.openai.com is known to accept stream_options; Together and others may reject it
+        extra = {'stream_options': {'include_usage': True}} if base_url is None else {}
+        extra.update(_openai_cache_args(message, model_name, base_url, cache_upto))
+
+        def chunks(usage):
+            with _client_pool.lease(('openai', base_url, api_key), lambda: _make_openai_client(api_key, base_url)) as client:
+                response = client.chat.completions.create(
+                    model=model_name,
+                    messages=_plain_messages(message),
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    stream=True,
+                    **extra,
+                    **_timeout_args(_request_timeout(timeout)),
+                )
+                try:
+                    for chunk in response:
+                        if getattr(chunk, 'usage', None):
+                            usage.update(_openai_usage(chunk.usage))
+                        if chunk.choices:
+                            if chunk.choices[0].finish_reason:
+                                usage['finish_reason'] = chunk.choices[0].finish_reason
+                            yield chunk.choices[0].delta.content
+                finally:
+                    response.close()
+
+    elif route == 'anthropic':
+        anthropic = _import_sdk('anthropic')
+        kwargs = _anthropic_request(message, model_name, max_tokens, temperature, cache_upto)
+
+        def chunks(usage):
+            with _client_pool.lease(('anthropic', base_url, api_key), lambda: _make_anthropic_client(api_key, base_url)) as client:
+                with client.messages.stream(**kwargs, **_timeout_args(_request_timeout(timeout))) as response:
+                    for text in response.text_stream:
+                        yield text
+                    final = response.get_final_message()
+                    usage.update(_anthropic_usage(final.usage))
+                    usage['finish_reason'] = final.stop_reason
+
+    elif route == 'google':
+        genai = _import_sdk('google.genai')
+        types = _import_sdk('google.genai.types')
+
+        def chunks(usage):
+            with _client_pool.lease(('google', base_url, api_key), lambda: _make_google_client(api_key, base_url)) as client:
+                contents, config = _gemini_prepare(client, model_name, message, 1, thinking_budget, types, cache_upto, api_key)
+                config = _gemini_timeout(config, _request_timeout(timeout), types)
+                for chunk in client.models.generate_content_stream(model=model_name, config=config, contents=contents):
+                    metadata = getattr(chunk, 'usage_metadata', None)
+                    if metadata is not None and metadata.candidates_token_count:
+                        usage.update(_gemini_usage(metadata))
+                    if chunk.candidates and chunk.candidates[0].finish_reason:
+                        usage['finish_reason'] = _finish_reason(chunk.candidates[0].finish_reason)
+                    yield chunk.text
+
+    return chunks
+
+# Async clients are bound to the event loop that created them, so each loop gets its own pool
+_async_client_pools = weakref.WeakKeyDictionary()
+_async_client_pools_lock = threading.Lock()
+
+def _get_async_client_pool():
+    import asyncio
+    loop = asyncio.get_running_loop()
+    with _async_client_pools_lock:
+        pool = _async_client_pools.get(loop)
+        if pool is None:
+            pool = ClientPool()
+            _async_client_pools[loop] = pool
+        return pool
+
+async def aclose_clients():
+    """Close the pooled async clients that belong to the running event loop"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    with _async_client_pools_lock:
+        pool = _async_client_pools.pop(loop, None)
+    if pool is None:
+        return
+    with pool._lock:
+        clients = [entry['client'] for entry in pool._entries.values()]
+        pool._entries.clear()
+    for client in clients:
+        close = getattr(client, 'aclose', None) or getattr(client, 'close', None)
+        try:
+            result = close()
+            if hasattr(result, '__await__'):
+                await result
+        except Exception:
+            pass
+
+def _make_async_http_client():
+    httpx = _import_sdk('httpx')
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=HYPERBOLIC_POOL_MAXSIZE)
+    from telemetry import atrace_request_hook
+    return httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(600.0, connect=10.0), event_hooks={'request': [atrace_request_hook]})
+
+async def achat_complete(message, 
+                         model_name='gemini-2.0-flash', # openai format
+                         provider=None,
+                         base_url=None,
+                         max_tokens=512,
+                         temperature=0.5,
+                         n=1, # number of completions to generate
+                         api_key=None,
+                         thinking_budget=None,  # None means use default behavior
+                         show_thinking=False,
+                         use_cache=None,
+                         coalesce=True,
+                         cache_prompt=False,
+                         return_result=False,
+                         on_metrics=None,
+                         hedge=None,
+                         max_retries=None,
+                         timeout=None,
+                         ):
+    """
+    Async version of chat_complete with the same arguments and return value.
+    Uses each provider's native async client, so many requests can be in flight on one event loop.
+    Coalescing is shared with chat_complete: an async task can wait on a call a thread started.
+    A hedged call cancels whichever request loses.
+    """
+    from telemetry import CallMetrics
+    requested_model = model_name
+    route, model_name, base_url, api_key = _resolve_route(model_name, provider, base_url, api_key)
+    _last_usage.set(None)
+    cache_upto = _cached_prefix_length(message) if cache_prompt else 0
+    metrics = CallMetrics(route, model_name)
+
+    cache = _cache_for_call(use_cache, temperature)
+    recorder = _recording_cassette()
+    if cache is not None or recorder is not None or coalesce:
+        cache_key = _request_key(message, model_name, base_url, max_tokens, temperature, n, thinking_budget, show_thinking)
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            _finish_metrics(metrics, None, on_metrics, outcome='cache_hit')
+            return ChatResult(cached, metrics) if return_result else cached
+
+    policy = _hedge_policy_for_call(hedge, n)
+    hedge_target = _hedge_target(policy, requested_model, route, model_name, base_url, api_key) if policy is not None else None
+
+    led = []
+    async def call():
+        led.append(True)
+        call_start = time.perf_counter()
+        answered_by = (route, model_name)
+        if policy is not None:
+            response, answered_by = await _ahedged_call(policy, hedge_target, route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto, max_retries, timeout)
         else:
-            return [candidate.content.parts[0].text for candidate in response.candidates]
+            response = await _aresilient_call(route, base_url, max_retries, lambda: _acall_provider(route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto, timeout))
+        fallback_won = answered_by[1] != model_name
+        if fallback_won:
+            metrics.provider, metrics.model = answered_by
+        if response is not None and not getattr(response, 'errors', None):
+            if cache is not None and not fallback_won:
+                cache.set(cache_key, response)
+            if recorder is not None:
+                _record_call(recorder, cache_key, route, model_name, message, base_url, max_tokens, temperature, n, thinking_budget, show_thinking, response, time.perf_counter() - call_start)
+        return response
+
+    token = _set_current_call(metrics)
+    start = time.perf_counter()
+    try:
+        response = await (_get_single_flight().do_async(cache_key, call) if coalesce else call())
+    except Exception as e:
+        metrics.error = f"{type(e).__name__}: {e}"
+        _finish_metrics(metrics, start, on_metrics, outcome='error')
+        raise
+    finally:
+        _reset_current_call(token)
+    metrics.set_usage(_last_usage.get())
+    _finish_metrics(metrics, start, on_metrics, outcome='ok' if led else 'coalesced')
+    return ChatResult(response, metrics) if return_result else response
+
+async def _acall_provider(route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto=0, timeout=None):
+    """Async counterpart of _call_provider"""
+    pool = _key_pool_for(api_key)
+    if pool is None:
+        return await _asend_request(route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto, timeout)
+    return await _awith_pooled_key(pool, _reserved_tokens(message, model_name, max_tokens, n), lambda key: _asend_request(route, message, model_name, base_url, key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto, timeout))
+
+async def _asend_request(route, message, model_name, base_url, api_key, max_tokens, temperature, n, thinking_budget, show_thinking, cache_upto=0, timeout=None):
+    """Async counterpart of _send_request"""
+    timeout = _request_timeout(timeout)
+    if route == 'replay':
+        key = _request_key(message, model_name, base_url, max_tokens, temperature, n, thinking_budget, show_thinking)
+        return _replay_response(await get_cassette().aplay(key, model_name))
+    base_url = _transport_base_url(route, base_url)
+
+    pool = _get_async_client_pool()
     
-    else:  
-        raise NotImplementedError(f'Provider {provider} is not supported. Supported providers: openai, google, anthropic')
+    if route == 'hyperbolic':
+        headers, data = _hyperbolic_request(message, model_name, api_key, max_tokens, temperature, n)
+        start = time.perf_counter()
+        with pool.lease(('hyperbolic', None, None), _make_async_http_client) as http_client:
+            response = await http_client.post(base_url, headers=headers, json=data, **_timeout_args(timeout))
+        response_json = response.json()
         
-def batch_chat_complete(messages, # openai format
-                        model_name='gemini-2.0-flash', 
-                        provider=None,
-                        base_url=None,
-                        max_tokens=8192,
-                        temperature=0.5,
-                        concurrent_calls=10,
-                        n=1,
-                        api_key=None):
+        if response.status_code != 200:
+            raise ProviderHTTPError(f"Hyperbolic API error: {response_json}", response.status_code, response.headers)
+        _record_usage(route, model_name, _openai_usage(response_json.get('usage')), response_json['choices'][0].get('finish_reason'))
+        result = _parse_hyperbolic_response(response_json, n, show_thinking)
+        return result if n == 1 else _native_samples(result, time.perf_counter() - start)
 
-    # import exponential backoff decorator 
-    from tenacity import retry, stop_after_attempt, wait_exponential, RetryError, retry_if_exception_type, retry_if_exception
-    import requests.exceptions
-    import openai  # For openai.APIStatusError
-    from google.genai.errors import ClientError # Corrected import for Google GenAI errors
+    elif route == 'openai':
+        start = time.perf_counter()
+        with pool.lease(('openai', base_url, api_key), lambda: _make_openai_client(api_key, base_url, is_async=True)) as client:
+            chat_completion = await client.chat.completions.create(
+                model=model_name,
+                messages=_plain_messages(message),
+                max_tokens=max_tokens,
+                temperature=temperature,
+                n=n,
+                **_openai_cache_args(message, model_name, base_url, cache_upto),
+                **_timeout_args(timeout),
+            )
+        _record_usage(route, model_name, _openai_usage(chat_completion.usage), chat_completion.choices[0].finish_reason)
+
+        if n == 1:
+            return chat_completion.choices[0].message.content
+        else:
+            return _native_samples([choice.message.content for choice in chat_completion.choices], time.perf_counter() - start)
 
+    elif route == 'anthropic':
+        try:
+            anthropic = _import_sdk('anthropic')
+        except:
+            print ("Please install anthropic with: ")
+            print ("pip install anthropic")
+            return None
+            
+        kwargs = _anthropic_request(message, model_name, max_tokens, temperature, cache_upto)
+        kwargs.update(_timeout_args(timeout))
+        with pool.lease(('anthropic', base_url, api_key), lambda: _make_anthropic_client(api_key, base_url, is_async=True)) as client:
+            if n == 1:
+                response = await client.messages.create(**kwargs)
+                _record_usage(route, model_name, _anthropic_usage(response.usage), response.stop_reason)
+                return response.content[0].text
+
+            # Anthropic doesn't support n, so fan the samples out concurrently
+            responses = []
+            async def call_one():
+                response = await client.messages.create(**kwargs)
+                responses.append(response)
+                return response.content[0].text
+            try:
+                return await _afan_out(call_one, n)
+            finally:
+                _record_samples_usage(route, model_name, responses)
+
+    elif route == 'google':
+        try:
+            genai = _import_sdk('google.genai')
+            types = _import_sdk('google.genai.types')
+        except:
+            print ("Please install google-genai with: ")
+            print ("pip install -q -U google-genai")
+            return None
+
+        start = time.perf_counter()
+        with pool.lease(('google', base_url, api_key), lambda: _make_google_client(api_key, base_url).aio) as client:
+            cached_content = await _agemini_cached_content(client, model_name, message, cache_upto, types, api_key) if cache_upto else None
+            if cached_content:
+                contents, config = _gemini_request(message[cache_upto:], model_name, n, thinking_budget, types, cached_content)
+            else:
+                contents, config = _gemini_request(message, model_name, n, thinking_budget, types)
+            response = await client.models.generate_content(
+                model=model_name,
+                config=_gemini_timeout(config, timeout, types),
+                contents=contents
+            )
+        _record_usage(route, model_name, _gemini_usage(response.usage_metadata), response.candidates[0].finish_reason if response.candidates else None)
+        result = _parse_gemini_response(response, n)
+        return result if n == 1 else _native_samples(result, time.perf_counter() - start)
+
+def _resolve_batch_api_key(model_name, provider, api_key):
+    """Resolve the provider and API key once, before a batch fans out"""
     # Determine provider if not specified to handle API key checks upfront
     if provider is None:
         provider, model_name = get_model_provider(model_name)
@@ -493,74 +2665,528 @@ def batch_chat_complete(messages, # openai format
     
     # Pre-check for API keys before starting batch processing
     if api_key is None:
-        if provider == 'openai':
-            # Check if it's a Together model
-            if model_name in TOGETHER_MODEL_MAPPING:
-                api_key = get_together_api_key()
-            # Check if it's a Hyperbolic model
-            elif model_name in HYPERBOLIC_MODEL_MAPPING:
-                api_key = get_hyperbolic_api_key()
-            else:
-                api_key = get_openai_api_key()
-        elif provider == 'google':
-            api_key = get_google_api_key()
-        elif provider == 'together':
-            api_key = get_together_api_key()
-        elif provider == 'anthropic':
-            api_key = get_anthropic_api_key()
-
-    def _should_retry_specific_errors(e):
-        # Retry on general network issues
-        if isinstance(e, requests.exceptions.RequestException):
-            print (f"RequestException: {e}")
-            return True
-        # For OpenAI errors, retry only on 429 status code
-        if isinstance(e, openai.APIStatusError):
-            print (f"OpenAI APIStatusError: {e}")
-            return getattr(e, 'status_code', None) == 429
-        # For Google GenAI errors, retry only on ClientError with code 429
-        if isinstance(e, ClientError): # ClientError from google.genai.errors
-            print (f"Google GenAI ClientError: {e}")
-            return getattr(e, 'code', None) == 429
-        # For Anthropic errors, retry on rate limit errors
-        try:
-            import anthropic
-            if isinstance(e, anthropic.RateLimitError):
-                print (f"Anthropic RateLimitError: {e}")
-                return True
-        except ImportError:
-            pass
+        api_key = _resolve_route(model_name, provider, None, None)[3]
+    return model_name, provider, api_key
+
+def _should_retry_specific_errors(e):
+    """Retry predicate for every call: network errors, timeouts, 429s and 5xx responses"""
+    # An error can only come from an SDK that is already imported, so check sys.modules
+    # instead of importing every provider's SDK here
+    import sys
+    requests_exceptions = sys.modules.get('requests.exceptions')
+    httpx = sys.modules.get('httpx')
+    openai = sys.modules.get('openai')
+    genai_errors = sys.modules.get('google.genai.errors')
+    anthropic = sys.modules.get('anthropic')
+    # Retry on general network issues
+    if requests_exceptions is not None and isinstance(e, requests_exceptions.RequestException):
+        print (f"RequestException: {e}")
+        return True
+    if httpx is not None and isinstance(e, httpx.TransportError):
+        print (f"httpx TransportError: {e}")
+        return True
+    # SDK-wrapped connection errors and timeouts
+    if openai is not None and isinstance(e, openai.APIConnectionError):
+        print (f"OpenAI APIConnectionError: {e}")
+        return True
+    if anthropic is not None and isinstance(e, anthropic.APIConnectionError):
+        print (f"Anthropic APIConnectionError: {e}")
+        return True
+    # For HTTP errors, retry on 429 and server errors
+    if isinstance(e, ProviderHTTPError):
+        print (f"ProviderHTTPError: {e}")
+        return _is_retryable_status(e.status_code)
+    if openai is not None and isinstance(e, openai.APIStatusError):
+        print (f"OpenAI APIStatusError: {e}")
+        return _is_retryable_status(e.status_code)
+    if genai_errors is not None and isinstance(e, genai_errors.APIError):
+        print (f"Google GenAI APIError: {e}")
+        return _is_retryable_status(getattr(e, 'code', None))
+    if anthropic is not None and isinstance(e, anthropic.APIStatusError):
+        print (f"Anthropic APIStatusError: {e}")
+        return _is_retryable_status(e.status_code)
+    return False
+
+def _is_retryable_status(status_code):
+    # 529 is Anthropic's "overloaded"
+    return status_code == 429 or status_code in (500, 502, 503, 504, 529)
+
+def _error_status(e):
+    if isinstance(e, ProviderHTTPError):
+        return e.status_code
+    status_code = getattr(e, 'status_code', None)
+    if status_code is None and isinstance(getattr(e, 'code', None), int):
+        status_code = e.code
+    return status_code
+
+def _is_provider_failure(e):
+    """True if e means the provider itself is failing (counts toward its circuit breaker): 5xx, timeouts, connection errors"""
+    # A timeout we cut short to meet our own deadline says nothing about the provider
+    if _deadline_passed():
         return False
+    status_code = _error_status(e)
+    if status_code is not None:
+        return status_code >= 500
+    import sys
+    requests_exceptions = sys.modules.get('requests.exceptions')
+    httpx = sys.modules.get('httpx')
+    openai = sys.modules.get('openai')
+    anthropic = sys.modules.get('anthropic')
+    if requests_exceptions is not None and isinstance(e, (requests_exceptions.ConnectionError, requests_exceptions.Timeout)):
+        return True
+    if httpx is not None and isinstance(e, httpx.TransportError):
+        return True
+    if openai is not None and isinstance(e, openai.APIConnectionError):
+        return True
+    if anthropic is not None and isinstance(e, anthropic.APIConnectionError):
+        return True
+    return False
 
-    @retry(
-        stop=stop_after_attempt(4),
-        wait=wait_exponential(multiplier=1, exp_base=4, min=1, max=60),
-        retry=retry_if_exception(_should_retry_specific_errors) # Use custom predicate
-    )
-    def call_chat_complete(message):
-        return chat_complete(message, model_name=model_name, provider=provider, base_url=base_url, max_tokens=max_tokens, temperature=temperature, n=n, api_key=api_key)
+def _retry_after_seconds(e):
+    """The delay a provider asked for in its retry-after-ms / Retry-After headers, or None"""
+    headers = getattr(e, 'headers', None)
+    if not headers:
+        response = getattr(e, 'response', None)
+        headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    headers = {str(key).lower(): value for key, value in dict(headers).items()}
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000.0
+        if 'retry-after' in headers:
+            value = headers['retry-after']
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                from email.utils import parsedate_to_datetime
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def _is_rate_limit_error(e):
+    """True if e is a 429 / rate-limit error from any provider"""
+    if isinstance(e, ProviderHTTPError):
+        return e.status_code == 429
+    if getattr(e, 'status_code', None) == 429 or getattr(e, 'code', None) == 429:
+        return True
+    return type(e).__name__ == 'RateLimitError'
+
+# Per-model rate limits for the batch engines, configurable per model alias.
+# rpm / tpm: requests and tokens per minute (None = no client-side budget).
+# max_concurrency: ceiling for the AIMD concurrency limit, which starts at the batch's concurrent_calls.
+# Example: RATE_LIMITS['gpt-4o-mini'] = {'rpm': 5000, 'tpm': 2000000, 'max_concurrency': 128}
+RATE_LIMITS = {}
+DEFAULT_MAX_CONCURRENCY = 64
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def _canonical_model_name(model_name):
+    provider, resolved = get_model_provider(model_name)
+    return resolved if provider is not None else model_name.strip().lower()
+
+def set_rate_limit(model_name, rpm=None, tpm=None, max_concurrency=None):
+    """Configure the rate limits for a model alias (replaces any live limiter for that model)"""
+    RATE_LIMITS[model_name.strip().lower()] = {'rpm': rpm, 'tpm': tpm, 'max_concurrency': max_concurrency}
+    with _rate_limiters_lock:
+        _rate_limiters.pop(_canonical_model_name(model_name), None)
+
+def _rate_limit_config(model_name):
+    """Find the RATE_LIMITS entry for a model, whichever of its aliases it was configured under"""
+    key = model_name.strip().lower()
+    if key in RATE_LIMITS:
+        return RATE_LIMITS[key]
+    canonical = _canonical_model_name(model_name)
+    for alias, config in RATE_LIMITS.items():
+        if _canonical_model_name(alias) == canonical:
+            return config
+    return {}
+
+def get_rate_limiter(model_name, initial_concurrency=10):
+    """
+    Return the shared RateLimiter for a model; aliases of the same model share one limiter.
+    A later call asking for more concurrency than the limiter was made with widens it to match.
+    """
+    from ratelimit import RateLimiter
+    canonical = _canonical_model_name(model_name)
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(canonical)
+        config = _rate_limit_config(model_name)
+        max_concurrency = config.get('max_concurrency') or max(DEFAULT_MAX_CONCURRENCY, initial_concurrency)
+        if limiter is not None:
+            limiter.concurrency.widen(min(initial_concurrency, max_concurrency), max_concurrency)
+        else:
+            limiter = RateLimiter(
+                canonical,
+                rpm=config.get('rpm'),
+                tpm=config.get('tpm'),
+                initial_concurrency=min(initial_concurrency, max_concurrency),
+                max_concurrency=max_concurrency,
+            )
+            _rate_limiters[canonical] = limiter
+        return limiter
+
+def get_rate_limiter_state():
+    """Snapshot of every live rate limiter, keyed by resolved model name, for monitoring"""
+    with _rate_limiters_lock:
+        limiters = dict(_rate_limiters)
+    return {name: limiter.state() for name, limiter in limiters.items()}
+
+def _estimate_tokens(message, model_name=None):
+    """Prompt size in tokens (tokens.count_message_tokens, memoized) used for tpm budgeting"""
+    from tokens import count_message_tokens
+    return count_message_tokens(message, model_name)
+
+def _estimate_response_tokens(response, model_name=None):
+    from tokens import estimate_tokens
+    if response is None:
+        return 0
+    texts = response if isinstance(response, list) else [response]
+    return sum(estimate_tokens(text or '', model_name) for text in texts)
+
+_last_batch_metrics = None
+
+def _start_batch_metrics(model_name, messages):
+    from telemetry import BatchMetrics
+    return BatchMetrics(model_name, messages)
+
+def _finish_batch_metrics(batch_metrics, report=True):
+    global _last_batch_metrics
+    batch_metrics.finish()
+    get_metrics_registry().record_batch(batch_metrics)
+    _last_batch_metrics = batch_metrics
+    if report:
+        print (batch_metrics.summary_line())
+
+def get_last_batch_metrics():
+    """
+    Throughput figures of the most recent batch in this process: messages, completed, failed,
+    retries, wall_time, requests_per_sec, output_tokens_per_sec, token totals, latency p50/p95
+    """
+    return _last_batch_metrics.as_dict() if _last_batch_metrics is not None else None
+
+def _scale_to_healthy_keys(limiter, api_key):
+    """
+    With a key pool behind api_key, let the model's concurrency limit apply once per healthy key
+    (re-checked as keys go in and out of quarantine). Returns the number of keys in the pool (1 without one).
+    """
+    pool = _key_pool_for(api_key)
+    if pool is None:
+        return 1
+    limiter.concurrency.set_scale(pool.healthy_count())
+    return len(pool)
+
+def _make_batch_caller(limiter, model_name, provider, base_url, max_tokens, temperature, n, api_key, use_cache, return_exceptions=False, coalesce=True, batch_metrics=None):
+    """
+    Build the per-message function the threaded batch engines run: rate limited, retried on
+    transient errors, and returning the error string (or the exception itself, with
+    return_exceptions) instead of raising. Each attempt's metrics (with its queue wait and retry
+    count) are folded into batch_metrics. Worker threads run under the caller's deadline, and a
+    message still waiting when it passes is skipped with a DeadlineExceeded error.
+    """
+    from telemetry import call_context
+    from deadline import current_deadline, deadline_scope, DeadlineExceeded
+    on_metrics = batch_metrics.add if batch_metrics is not None else None
+    resilience = get_resilience()
+    deadline = current_deadline()
+
+    # Coalesce before the limiter so duplicate prompts don't take a slot or rpm/tpm budget
+    _, resolved_model, resolved_base_url, _ = _resolve_route(model_name, provider, base_url, api_key)
+
+    def call_chat_complete(message, retries):
+        reserved = _reserved_tokens(message, model_name, max_tokens, n)
+        queued = time.monotonic()
+        _scale_to_healthy_keys(limiter, api_key)
+        limiter.acquire(reserved)
+        start = time.monotonic()
+        try:
+            # Retries happen below, so every attempt goes back through the limiter
+            with call_context(queue_wait=start - queued, retries=retries):
+                response = chat_complete(message, model_name=model_name, provider=provider, base_url=base_url, max_tokens=max_tokens, temperature=temperature, n=n, api_key=api_key, use_cache=use_cache, coalesce=False, on_metrics=on_metrics, max_retries=0)
+        except Exception as e:
+            limiter.release(rate_limited=_is_rate_limit_error(e), failed=True, reserved_tokens=reserved, used_tokens=_estimate_tokens(message, model_name))
+            raise
+        used = _estimate_tokens(message, model_name) + _estimate_response_tokens(response, model_name)
+        limiter.release(latency=time.monotonic() - start, reserved_tokens=reserved, used_tokens=used)
+        return response
+
+    def call_with_retries(message):
+        attempt = waits = 0
+        while True:
+            try:
+                return call_chat_complete(message, attempt)
+            except Exception as e:
+                # An open breaker holds the message until its next probe rather than failing it
+                delay = resilience.breaker_wait(e, waits)
+                if delay is not None:
+                    waits += 1 if e.retry_in > 0 else 0
+                    time.sleep(delay)
+                    continue
+                delay = resilience.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    def run(message):
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded('Deadline passed before this message was sent')
+        if coalesce:
+            key = _request_key(message, resolved_model, resolved_base_url, max_tokens, temperature, n, None, False)
+            return _get_single_flight().do(key, lambda: call_with_retries(message))
+        return call_with_retries(message)
 
     def func(message):
         try:
-            response = call_chat_complete(message)
+            with deadline_scope(deadline=deadline):
+                response = run(message)
             # print (f"Got response for message: {message}, response: {response}")
+            if batch_metrics is not None:
+                batch_metrics.result(True)
             return response
-        except RetryError as e:
-            print(f"Failed to get response for RetryError for message: {message}")
-            return str(e)
         except Exception as e:
-            print(f"Failed to get response for message: {message}")
-            print(e)
+            # DeadlineExceeded is only raised before a request goes out
+            skipped = isinstance(e, DeadlineExceeded)
+            if batch_metrics is not None:
+                batch_metrics.result(False, skipped=skipped)
+            if return_exceptions:
+                return e
+            if not skipped:
+                print(f"Failed to get response for message: {message}")
+                print(e)
             return str(e)
+    return func
+
+def batch_chat_complete(messages, # openai format
+                        model_name='gemini-2.0-flash', 
+                        provider=None,
+                        base_url=None,
+                        max_tokens=8192,
+                        temperature=0.5,
+                        concurrent_calls=10,
+                        n=1,
+                        api_key=None,
+                        engine='threads',
+                        use_cache=None,
+                        coalesce=True):
+    """
+    Run chat_complete over a list of messages concurrently.
+    Returns a list of (message, response) pairs; failed messages get the error string as response.
+    engine='threads' uses a thread pool; engine='async' runs abatch_chat_complete on a single event
+    loop, which scales to hundreds of in-flight requests.
+    Concurrency is adaptive: concurrent_calls is the starting limit, which grows additively while
+    calls succeed and halves on 429s or latency spikes, up to the model's max_concurrency, with
+    optional rpm/tpm token buckets (see RATE_LIMITS, set_rate_limit and get_rate_limiter_state).
+    With a pool of API keys (see configure_key_pool) the limit applies per healthy key.
+    Identical messages in flight together are sent once and share the response unless coalesce=False.
+    Under a deadline (EVOLVE_DEADLINE or deadline.deadline_scope) requests in flight are cut off by
+    their timeouts and messages not yet sent are skipped, so the batch returns its partial results
+    in time; skipped messages get a "Deadline passed" error string.
+    For large or lazily generated batches use iter_batch_chat_complete, which yields results as
+    they complete instead of holding every prompt and response until the end.
+    """
+    if engine == 'async':
+        import asyncio
+
+        async def run_batch():
+            try:
+                return await abatch_chat_complete(messages, model_name=model_name, provider=provider, base_url=base_url, max_tokens=max_tokens, temperature=temperature, concurrent_calls=concurrent_calls, n=n, api_key=api_key, use_cache=use_cache, coalesce=coalesce)
+            finally:
+                await aclose_clients()
+        return asyncio.run(run_batch())
+    elif engine != 'threads':
+        raise ValueError(f"Unknown batch engine '{engine}', expected 'threads' or 'async'")
+
+    limiter = get_rate_limiter(model_name, initial_concurrency=concurrent_calls)
+    model_name, provider, api_key = _resolve_batch_api_key(model_name, provider, api_key)
+    batch_metrics = _start_batch_metrics(model_name, len(messages))
+    func = _make_batch_caller(limiter, model_name, provider, base_url, max_tokens, temperature, n, api_key, use_cache, coalesce=coalesce, batch_metrics=batch_metrics)
     import concurrent.futures 
     from tqdm import tqdm
-    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrent_calls) as executor:
+    # The limiter decides how many of these workers may have a request in flight at once
+    max_workers = limiter.concurrency.max_limit * _scale_to_healthy_keys(limiter, api_key)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         results = list(tqdm(executor.map(func, messages), total=len(messages), desc="Processing messages"))
+    _finish_batch_metrics(batch_metrics)
     
     pairs = list(zip(messages, results))
     return pairs
 
+def _batch_item(item, index):
+    """Split a batch input into (message_id, message); plain message lists use their index as id"""
+    if isinstance(item, dict):
+        return item.get('id', index), item['messages']
+    return index, item
+
+def iter_batch_chat_complete(messages, # iterable of openai-format messages or {"id": ..., "messages": [...]}
+                             model_name='gemini-2.0-flash', 
+                             provider=None,
+                             base_url=None,
+                             max_tokens=8192,
+                             temperature=0.5,
+                             concurrent_calls=10,
+                             n=1,
+                             api_key=None,
+                             use_cache=None,
+                             max_in_flight=None,
+                             cancel_event=None,
+                             return_exceptions=False,
+                             coalesce=True):
+    """
+    Streaming variant of batch_chat_complete: yields (index, message_id, response) in completion order.
+    Under a deadline, reading and starting messages stops once it passes (like cancel_event).
+    Args:
+        messages: any iterable (a generator is fine); it is consumed lazily, only max_in_flight
+            messages ahead of the results the caller has taken.
+        max_in_flight: most messages submitted but not yet yielded (default: the model's max_concurrency).
+        cancel_event: a threading.Event; once set, no further messages are read or started.
+        return_exceptions: yield the exception object for failed messages instead of its string.
+    Same rate limiting, retries and error strings as batch_chat_complete; throughput figures are
+    available from get_last_batch_metrics() once the generator finishes. Closing the generator
+    (or breaking out of the loop) also cancels: queued messages are dropped and requests already
+    in flight finish in the background without being yielded.
+    """
+    import concurrent.futures
+
+    limiter = get_rate_limiter(model_name, initial_concurrency=concurrent_calls)
+    model_name, provider, api_key = _resolve_batch_api_key(model_name, provider, api_key)
+    batch_metrics = _start_batch_metrics(model_name, 0)
+    func = _make_batch_caller(limiter, model_name, provider, base_url, max_tokens, temperature, n, api_key, use_cache, return_exceptions, coalesce, batch_metrics)
+    max_workers = limiter.concurrency.max_limit * _scale_to_healthy_keys(limiter, api_key)
+    max_in_flight = max_in_flight or max_workers
+
+    items = enumerate(messages)
+    exhausted = False
+    pending = {}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while True:
+            while not exhausted and len(pending) < max_in_flight and not (cancel_event and cancel_event.is_set()) and not _deadline_passed():
+                try:
+                    index, item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                message_id, message = _batch_item(item, index)
+                pending[executor.submit(func, message)] = (index, message_id)
+                batch_metrics.messages += 1
+            if not pending or (cancel_event and cancel_event.is_set()):
+                return
+            done, _ = concurrent.futures.wait(pending, timeout=0.5, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                index, message_id = pending.pop(future)
+                yield index, message_id, future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+        _finish_batch_metrics(batch_metrics, report=False)
+
+async def abatch_chat_complete(messages, # openai format
+                               model_name='gemini-2.0-flash', 
+                               provider=None,
+                               base_url=None,
+                               max_tokens=8192,
+                               temperature=0.5,
+                               concurrent_calls=100,
+                               n=1,
+                               api_key=None,
+                               use_cache=None,
+                               coalesce=True):
+    """
+    Async batch engine: runs achat_complete over all messages on the current event loop.
+    Concurrency and rpm/tpm budgets are governed by the model's shared RateLimiter, exactly as in
+    batch_chat_complete. Same retries, coalescing, deadline handling and return value as
+    batch_chat_complete.
+    """
+    import asyncio
+    from tqdm import tqdm
+    from telemetry import call_context
+    from deadline import current_deadline, DeadlineExceeded
+
+    limiter = get_rate_limiter(model_name, initial_concurrency=concurrent_calls)
+    model_name, provider, api_key = _resolve_batch_api_key(model_name, provider, api_key)
+    _, resolved_model, resolved_base_url, _ = _resolve_route(model_name, provider, base_url, api_key)
+    batch_metrics = _start_batch_metrics(model_name, len(messages))
+    resilience = get_resilience()
+    progress = tqdm(total=len(messages), desc="Processing messages")
+
+    async def call_achat_complete(message, retries):
+        reserved = _reserved_tokens(message, model_name, max_tokens, n)
+        queued = time.monotonic()
+        _scale_to_healthy_keys(limiter, api_key)
+        await limiter.acquire_async(reserved)
+        start = time.monotonic()
+        try:
+            with call_context(queue_wait=start - queued, retries=retries):
+                response = await achat_complete(message, model_name=model_name, provider=provider, base_url=base_url, max_tokens=max_tokens, temperature=temperature, n=n, api_key=api_key, use_cache=use_cache, coalesce=False, on_metrics=batch_metrics.add, max_retries=0)
+        except asyncio.CancelledError:
+            # Cancelled calls tell us nothing about capacity; just give the slot back
+            limiter.release(failed=True, reserved_tokens=reserved, used_tokens=_estimate_tokens(message, model_name))
+            raise
+        except Exception as e:
+            limiter.release(rate_limited=_is_rate_limit_error(e), failed=True, reserved_tokens=reserved, used_tokens=_estimate_tokens(message, model_name))
+            raise
+        used = _estimate_tokens(message, model_name) + _estimate_response_tokens(response, model_name)
+        limiter.release(latency=time.monotonic() - start, reserved_tokens=reserved, used_tokens=used)
+        return response
+
+    async def call_with_retries(message):
+        attempt = waits = 0
+        while True:
+            try:
+                return await call_achat_complete(message, attempt)
+            except Exception as e:
+                delay = resilience.breaker_wait(e, waits)
+                if delay is not None:
+                    waits += 1 if e.retry_in > 0 else 0
+                    await asyncio.sleep(delay)
+                    continue
+                delay = resilience.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    deadline = current_deadline()
+
+    async def func(message):
+        try:
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded('Deadline passed before this message was sent')
+            if coalesce:
+                key = _request_key(message, resolved_model, resolved_base_url, max_tokens, temperature, n, None, False)
+                response = await _get_single_flight().do_async(key, lambda: call_with_retries(message))
+            else:
+                response = await call_with_retries(message)
+            batch_metrics.result(True)
+            return response
+        except Exception as e:
+            skipped = isinstance(e, DeadlineExceeded)
+            batch_metrics.result(False, skipped=skipped)
+            if not skipped:
+                print(f"Failed to get response for message: {message}")
+                print(e)
+            return str(e)
+        finally:
+            progress.update(1)
+
+    try:
+        results = await asyncio.gather(*[func(message) for message in messages])
+    finally:
+        progress.close()
+    _finish_batch_metrics(batch_metrics)
+    return list(zip(messages, results))
+
 if __name__ == '__main__':
+    import sys
+    if '--check-import-time' in sys.argv:
+        within_budget, elapsed = check_import_time()
+        print (f"import api: {elapsed:.1f} ms (budget {IMPORT_TIME_BUDGET_MS} ms)")
+        sys.exit(0 if within_budget else 1)
+
     print ("Testing chat_complete")
     # model_names = ['gemini-2.0-flash', 'gpt-4o-mini', 'claude-3-5-haiku', 'deepseek-v3']
     # model_names = ['claude-3-5-haiku']
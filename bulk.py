@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Resumable bulk runner for large offline prompt sets.
+
+Reads prompts from a JSONL file one line at a time and runs them through
+api.iter_batch_chat_complete. Each result is appended to the output JSONL as soon as it finishes,
+and failures go to a separate errors JSONL as structured records. A small journal next to the
+output records progress, so rerunning the same command after a crash resumes where it stopped.
+
+Input lines:
+    {"id": "q1", "messages": [{"role": "user", "content": "..."}]}
+    {"id": "q2", "prompt": "..."}            # shorthand for a single user message
+Output lines:
+    {"id": "q1", "line": 0, "model": "gpt-4o-mini", "response": "..."}
+Error lines:
+    {"id": "q2", "line": 1, "model": "gpt-4o-mini", "error": "...", "error_type": "RateLimitError", "status_code": 429}
+
+The journal holds a watermark (every input line before it is done), the byte offset of that
+line in the input, and the few lines past the watermark that finished out of order. It also
+records the sizes of the output files at that moment. On resume, the input is read from the
+offset and both outputs are truncated back to the journaled sizes. That drops any record written
+after the last journal save, so every line ends up in the outputs exactly once. Memory use
+depends only on max_in_flight, never on the input size.
+
+Usage:
+    python bulk.py prompts.jsonl results.jsonl --model gpt-4o-mini
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from api import iter_batch_chat_complete
+
+class BulkJournal:
+    """
+    Progress journal for one bulk job, saved atomically (write to a temp file, then rename).
+    Args:
+        path: journal file.
+        input_path: the input JSONL; a journal for a different input is rejected.
+    """
+    def __init__(self, path, input_path):
+        self.path = path
+        self.input_path = os.path.abspath(input_path)
+        self.watermark = 0
+        self.offset = 0
+        self.done = set()
+        self.output_bytes = 0
+        self.errors_bytes = 0
+        self.completed = 0
+        self.failed = 0
+        self._line_ends = {}
+
+    @classmethod
+    def load(cls, path, input_path):
+        journal = cls(path, input_path)
+        if not os.path.exists(path):
+            return journal
+        with open(path) as f:
+            state = json.load(f)
+        if state['input'] != journal.input_path:
+            raise ValueError(f"Journal {path} belongs to {state['input']}, not {journal.input_path}")
+        journal.watermark = state['watermark']
+        journal.offset = state['offset']
+        journal.done = set(state['done'])
+        journal.output_bytes = state['output_bytes']
+        journal.errors_bytes = state['errors_bytes']
+        journal.completed = state['completed']
+        journal.failed = state['failed']
+        return journal
+
+    def line_read(self, line_no, end_offset):
+        """Remember where input line line_no ends, so the watermark can move past it later"""
+        self._line_ends[line_no] = end_offset
+
+    def mark_done(self, line_no):
+        self.done.add(line_no)
+        while self.watermark in self.done:
+            self.done.remove(self.watermark)
+            self.offset = self._line_ends.pop(self.watermark)
+            self.watermark += 1
+
+    def save(self, output_bytes, errors_bytes):
+        self.output_bytes = output_bytes
+        self.errors_bytes = errors_bytes
+        state = {
+            'input': self.input_path,
+            'watermark': self.watermark,
+            'offset': self.offset,
+            'done': sorted(self.done),
+            'output_bytes': output_bytes,
+            'errors_bytes': errors_bytes,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+def _open_for_append(path, size):
+    """Open path for appending after truncating it to size (the journaled length)"""
+    f = open(path, 'ab')
+    f.truncate(size)
+    f.seek(size)
+    return f
+
+def _write_record(f, record):
+    f.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+    return f.tell()
+
+def _parse_line(raw):
+    """Return (id, messages) for one input line; raises ValueError on a malformed line"""
+    try:
+        item = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON: {e}")
+    if not isinstance(item, dict):
+        raise ValueError('Each line must be a JSON object')
+    if 'messages' in item:
+        return item.get('id'), item['messages']
+    if 'prompt' in item:
+        return item.get('id'), [{"role": "user", "content": item['prompt']}]
+    raise ValueError('Line has neither "messages" nor "prompt"')
+
+def _error_record(record_id, line_no, model_name, error):
+    return {
+        'id': record_id,
+        'line': line_no,
+        'model': model_name,
+        'error': str(error),
+        'error_type': type(error).__name__,
+        'status_code': getattr(error, 'status_code', None) or getattr(error, 'code', None),
+    }
+
+def run_bulk_job(input_path,
+                 output_path,
+                 model_name='gemini-2.0-flash',
+                 errors_path=None,
+                 journal_path=None,
+                 max_tokens=8192,
+                 temperature=0.5,
+                 concurrent_calls=10,
+                 max_in_flight=None,
+                 n=1,
+                 use_cache=None,
+                 checkpoint_every=100,
+                 checkpoint_seconds=5.0,
+                 restart=False,
+                 verbose=True):
+    """
+    Run every prompt in input_path and append results to output_path, resuming from the journal.
+    Args:
+        errors_path: JSONL for failures (default: <output>.errors.jsonl).
+        journal_path: progress journal (default: <output>.journal.json).
+        checkpoint_every / checkpoint_seconds: save the journal after this many results or seconds.
+        restart: ignore any existing journal and outputs and start from the first line.
+    Returns a dict with completed, failed and skipped counts for this run.
+    """
+    errors_path = errors_path or output_path + '.errors.jsonl'
+    journal_path = journal_path or output_path + '.journal.json'
+    if restart:
+        for path in (output_path, errors_path, journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+    journal = BulkJournal.load(journal_path, input_path)
+    resumed_from = journal.watermark
+    out = _open_for_append(output_path, journal.output_bytes)
+    err = _open_for_append(errors_path, journal.errors_bytes)
+    record_ids = {}
+    stats = {'completed': 0, 'failed': 0, 'skipped': 0}
+
+    def read_items(f):
+        """Stream input lines from the journal offset, yielding only work that is not done yet"""
+        line_no = journal.watermark
+        offset = journal.offset
+        f.seek(offset)
+        for raw in iter(f.readline, b''):
+            offset += len(raw)
+            journal.line_read(line_no, offset)
+            if line_no in journal.done:
+                stats['skipped'] += 1
+            elif not raw.strip():
+                journal.mark_done(line_no)
+            else:
+                try:
+                    record_id, messages = _parse_line(raw)
+                except ValueError as e:
+                    _write_record(err, _error_record(None, line_no, model_name, e))
+                    journal.failed += 1
+                    stats['failed'] += 1
+                    journal.mark_done(line_no)
+                else:
+                    record_ids[line_no] = line_no if record_id is None else record_id
+                    yield {'id': line_no, 'messages': messages}
+            line_no += 1
+
+    if verbose and resumed_from:
+        print(f"Resuming {input_path} at line {resumed_from} ({journal.completed} done, {journal.failed} failed so far)")
+
+    start = time.monotonic()
+    last_save = start
+    since_save = 0
+    try:
+        with open(input_path, 'rb') as f:
+            results = iter_batch_chat_complete(
+                read_items(f), model_name=model_name, max_tokens=max_tokens, temperature=temperature,
+                concurrent_calls=concurrent_calls, n=n, use_cache=use_cache,
+                max_in_flight=max_in_flight, return_exceptions=True
+            )
+            for _, line_no, response in results:
+                record_id = record_ids.pop(line_no)
+                if isinstance(response, BaseException):
+                    _write_record(err, _error_record(record_id, line_no, model_name, response))
+                    journal.failed += 1
+                    stats['failed'] += 1
+                else:
+                    _write_record(out, {'id': record_id, 'line': line_no, 'model': model_name, 'response': response})
+                    journal.completed += 1
+                    stats['completed'] += 1
+                journal.mark_done(line_no)
+                since_save += 1
+                if since_save >= checkpoint_every or time.monotonic() - last_save >= checkpoint_seconds:
+                    _checkpoint(journal, out, err)
+                    since_save, last_save = 0, time.monotonic()
+                    if verbose:
+                        rate = (stats['completed'] + stats['failed']) / max(last_save - start, 1e-9)
+                        print(f"[bulk] line {journal.watermark}: {journal.completed} done, {journal.failed} failed ({rate:.1f}/s)")
+    finally:
+        _checkpoint(journal, out, err)
+        out.close()
+        err.close()
+    return stats
+
+def _checkpoint(journal, out, err):
+    """Make the outputs durable, then record how far they go"""
+    for f in (out, err):
+        f.flush()
+        os.fsync(f.fileno())
+    journal.save(out.tell(), err.tell())
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a JSONL prompt set through an LLM, resumably')
+    parser.add_argument('input', help='Input JSONL: one {"id", "messages"} or {"id", "prompt"} object per line')
+    parser.add_argument('output', help='Output JSONL (appended to; created if missing)')
+    parser.add_argument('--model', '-m', type=str, default='gemini-2.0-flash', help='Model to use (default: gemini-2.0-flash)')
+    parser.add_argument('--errors', type=str, default=None, help='Errors JSONL (default: <output>.errors.jsonl)')
+    parser.add_argument('--journal', type=str, default=None, help='Progress journal (default: <output>.journal.json)')
+    parser.add_argument('--max-tokens', type=int, default=8192)
+    parser.add_argument('--temperature', type=float, default=0.5)
+    parser.add_argument('--concurrent-calls', type=int, default=10, help='Starting concurrency (adapts per model)')
+    parser.add_argument('--max-in-flight', type=int, default=None, help='Most prompts read ahead of finished results')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the response cache')
+    parser.add_argument('--restart', action='store_true', help='Discard the journal and outputs and start over')
+    args = parser.parse_args()
+
+    stats = run_bulk_job(
+        args.input, args.output, model_name=args.model, errors_path=args.errors, journal_path=args.journal,
+        max_tokens=args.max_tokens, temperature=args.temperature, concurrent_calls=args.concurrent_calls,
+        max_in_flight=args.max_in_flight, use_cache=False if args.no_cache else None, restart=args.restart,
+    )
+    print(f"Done: {stats['completed']} completed, {stats['failed']} failed, {stats['skipped']} already done")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
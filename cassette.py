@@ -0,0 +1,139 @@
+"""
+Record / replay of LLM calls for offline runs and repeatable benchmarks.
+
+In record mode every call that reaches a provider is appended to a cassette: a JSONL file with
+one line per call holding the request key (api._request_key), the request, the response, its
+token usage and timing. In replay mode api routes calls to the cassette instead of a provider.
+No API keys or network are needed, and everything above the provider (cache, coalescing,
+hedging, retries, batching, telemetry) runs as usual.
+
+A key recorded several times (e.g. sampling at temperature > 0) is replayed round-robin. With
+realtime=True, replay waits the recorded latency (and streams pace their chunks over it), so
+load tests see realistic timing. Otherwise responses come back immediately, which is what you
+want when measuring the overhead of the api layer itself.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+
+class CassetteMiss(KeyError):
+    """Replay found no recording for a request"""
+    def __str__(self):
+        return self.args[0] if self.args else 'No recording for this request'
+
+class Cassette:
+    """
+    Args:
+        path: the cassette file (JSONL).
+        mode: 'record' (append calls to path) or 'replay' (serve calls from path).
+        realtime: in replay, wait each call's recorded latency before answering.
+    """
+    def __init__(self, path, mode='replay', realtime=False):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Cassette mode must be 'record' or 'replay', not {mode!r}")
+        self.path = path
+        self.mode = mode
+        self.realtime = realtime
+        self._lock = threading.Lock()
+        self._entries = None
+        self._next = {}
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+
+    def record(self, key, model, message, params, response, usage=None, latency=None, ttft=None, stream=False):
+        """Append one call to the cassette file"""
+        entry = {
+            'key': key,
+            'model': model,
+            'messages': message,
+            'params': params,
+            'response': response,
+            'usage': usage,
+            'latency': latency,
+            'ttft': ttft,
+            'stream': stream,
+            'recorded_at': time.time(),
+        }
+        line = json.dumps(entry, ensure_ascii=False, default=str) + '\n'
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # One write per line in append mode, so run_main.py subprocesses can record to the same file
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+            self.recorded += 1
+
+    def _load_locked(self):
+        if self._entries is None:
+            self._entries = {}
+            if os.path.exists(self.path):
+                with open(self.path, encoding='utf-8') as f:
+                    for line in f:
+                        line = line.strip()
+                        if line:
+                            entry = json.loads(line)
+                            self._entries.setdefault(entry['key'], []).append(entry)
+        return self._entries
+
+    def lookup(self, key, model=None):
+        """The recorded entry for key (cycling through repeated recordings); raises CassetteMiss"""
+        with self._lock:
+            entries = self._load_locked().get(key)
+            if not entries:
+                self.misses += 1
+                raise CassetteMiss(f"No recording in {self.path} for this request (model {model}); record it with LLM_CASSETTE_MODE=record")
+            index = self._next.get(key, 0)
+            self._next[key] = index + 1
+            self.replayed += 1
+            return entries[index % len(entries)]
+
+    def delay(self, entry):
+        return (entry.get('latency') or 0.0) if self.realtime else 0.0
+
+    def play(self, key, model=None):
+        entry = self.lookup(key, model)
+        delay = self.delay(entry)
+        if delay:
+            time.sleep(delay)
+        return entry
+
+    async def aplay(self, key, model=None):
+        entry = self.lookup(key, model)
+        delay = self.delay(entry)
+        if delay:
+            await asyncio.sleep(delay)
+        return entry
+
+    def chunks(self, key, model=None, chunk_chars=16):
+        """Replay a call as a stream: (entry, iterator of text chunks), paced over the recorded timing if realtime"""
+        entry = self.lookup(key, model)
+        text = entry['response'] if isinstance(entry['response'], str) else (entry['response'] or [''])[0]
+        pieces = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)] or ['']
+
+        def generate():
+            if self.realtime:
+                latency = entry.get('latency') or 0.0
+                ttft = entry.get('ttft') if entry.get('ttft') is not None else latency
+                time.sleep(ttft)
+                gap = max(0.0, latency - ttft) / max(1, len(pieces) - 1)
+            for i, piece in enumerate(pieces):
+                if self.realtime and i:
+                    time.sleep(gap)
+                yield piece
+        return entry, generate()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'path': self.path,
+                'mode': self.mode,
+                'recorded': self.recorded,
+                'replayed': self.replayed,
+                'misses': self.misses,
+                'keys': len(self._entries) if self._entries is not None else None,
+            }
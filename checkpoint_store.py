@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Content-addressed checkpoint store for main.py versions.
+
+A long run used to leave a full copy of main.py in checkpoints/ for every generation. Most of
+those copies were identical or nearly so, and their one-second file names could collide. Now
+every checkpoint goes into one store under checkpoints/:
+- pack.dat holds each distinct version once, keyed by its sha256. A version is compressed with
+  its parent (the version checkpointed before it) as the dictionary, so it costs about as much
+  as its diff. Codecs are zstd when the `zstandard` package is installed, else zlib. zlib only
+  uses the last 32 KB of the parent, which covers main.py in practice. A version that would sit
+  more than MAX_DELTA_CHAIN deltas from a full copy is stored whole, so reading one never
+  unpacks more than that.
+- index.jsonl records the objects (their offset in the pack and what they are deltas against)
+  and the checkpoints (generation number, hash and timestamp). It is read into dicts once, so a
+  checkpoint is found by generation, full hash or timestamp in O(1).
+
+Both files are only ever appended to. An object is written and flushed before its index line,
+so a crash can leave unused bytes at the end of the pack but never an index line without its data.
+
+Usage:
+    python checkpoint_store.py list
+    python checkpoint_store.py export 12 main_12.py     # by generation, hash (or a prefix) or timestamp
+    python checkpoint_store.py import checkpoints/main_*.py
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import zlib
+from datetime import datetime
+
+CHECKPOINT_DIR = 'checkpoints'
+PACK_FILE = 'pack.dat'
+INDEX_FILE = 'index.jsonl'
+MAX_DELTA_CHAIN = 32
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 19
+DECODED_CACHE_SIZE = 8
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def _zstd():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+def _compress(data, parent):
+    """(codec, payload) for data, as a delta against parent's bytes when there is a parent"""
+    zstd = _zstd()
+    if zstd is not None:
+        if parent is None:
+            return 'zstd', zstd.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+        dictionary = zstd.ZstdCompressionDict(parent, dict_type=zstd.DICT_TYPE_RAWCONTENT)
+        return 'zstd-delta', zstd.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary).compress(data)
+    if parent is None:
+        return 'zlib', zlib.compress(data, ZLIB_LEVEL)
+    compressor = zlib.compressobj(ZLIB_LEVEL, zdict=parent)
+    return 'zlib-delta', compressor.compress(data) + compressor.flush()
+
+def _decompress(codec, payload, parent):
+    if codec == 'zlib':
+        return zlib.decompress(payload)
+    if codec == 'zlib-delta':
+        decompressor = zlib.decompressobj(zdict=parent)
+        return decompressor.decompress(payload) + decompressor.flush()
+    zstd = _zstd()
+    if zstd is None:
+        raise RuntimeError(f"This checkpoint was stored with {codec}; install the zstandard package to read it")
+    if codec == 'zstd':
+        return zstd.ZstdDecompressor().decompress(payload)
+    dictionary = zstd.ZstdCompressionDict(parent, dict_type=zstd.DICT_TYPE_RAWCONTENT)
+    return zstd.ZstdDecompressor(dict_data=dictionary).decompress(payload)
+
+class CheckpointStore:
+    """
+    Versions of a file, each stored once and packed as a delta against its parent.
+    Args:
+        root: the directory holding pack.dat and index.jsonl (created on first write).
+    """
+    def __init__(self, root=CHECKPOINT_DIR):
+        self.root = root
+        self.pack_path = os.path.join(root, PACK_FILE)
+        self.index_path = os.path.join(root, INDEX_FILE)
+        self._lock = threading.Lock()
+        self._objects = {}          # hash -> object entry
+        self._checkpoints = []      # checkpoint entries, oldest first
+        self._by_generation = {}    # generation -> checkpoint entry
+        self._by_hash = {}          # hash -> latest checkpoint entry of that version
+        self._by_timestamp = {}     # timestamp -> checkpoint entry
+        self._next_generation = 1   # above every generation in the index, including dropped ones
+        self._decoded = {}          # hash -> bytes, the last few versions read or written
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by a crash
+            if entry.get('type') == 'object':
+                # Objects follow their parents in the index; one whose parent is gone can't be unpacked
+                if entry['parent'] is None or entry['parent'] in self._objects:
+                    self._objects[entry['hash']] = entry
+            elif entry.get('type') == 'checkpoint':
+                self._next_generation = max(self._next_generation, entry['generation'] + 1)
+                if entry['hash'] in self._objects:
+                    self._index_checkpoint(entry)
+
+    def _index_checkpoint(self, entry):
+        self._next_generation = max(self._next_generation, entry['generation'] + 1)
+        self._checkpoints.append(entry)
+        self._by_generation[entry['generation']] = entry
+        self._by_hash[entry['hash']] = entry
+        self._by_timestamp.setdefault(entry['timestamp'], entry)
+
+    def __len__(self):
+        return len(self._checkpoints)
+
+    def _remember(self, digest, data):
+        self._decoded[digest] = data
+        while len(self._decoded) > DECODED_CACHE_SIZE:
+            self._decoded.pop(next(iter(self._decoded)))
+
+    def _read(self, digest):
+        """The bytes of a stored version, unpacking its delta chain"""
+        data = self._decoded.get(digest)
+        if data is not None:
+            return data
+        chain = []
+        while digest is not None and digest not in self._decoded:
+            chain.append(self._objects[digest])
+            digest = self._objects[digest]['parent']
+        data = self._decoded.get(digest) if digest is not None else None
+        with open(self.pack_path, 'rb') as pack:
+            for entry in reversed(chain):
+                pack.seek(entry['offset'])
+                data = _decompress(entry['codec'], pack.read(entry['length']), data)
+                if hashlib.sha256(data).hexdigest() != entry['hash']:
+                    raise ValueError(f"Checkpoint object {entry['hash'][:12]} is corrupt")
+                self._remember(entry['hash'], data)
+        return data
+
+    def _append_index(self, entry):
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def add(self, content, label='main.py', timestamp=None):
+        """
+        Record a checkpoint of content (str or bytes). The version is stored only if it is new.
+        Returns the checkpoint entry: 'generation', 'hash', 'timestamp', 'label' and 'new'
+        (False when the version was already stored).
+        """
+        data = content.encode('utf-8') if isinstance(content, str) else content
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            new = digest not in self._objects
+            if new:
+                parent = self._checkpoints[-1]['hash'] if self._checkpoints else None
+                depth = self._objects[parent]['depth'] + 1 if parent is not None else 0
+                if depth > MAX_DELTA_CHAIN:
+                    parent, depth = None, 0
+                codec, payload = _compress(data, self._read(parent) if parent is not None else None)
+                with open(self.pack_path, 'ab') as pack:
+                    offset = pack.tell()
+                    pack.write(payload)
+                    pack.flush()
+                    os.fsync(pack.fileno())
+                entry = {'type': 'object', 'hash': digest, 'parent': parent, 'depth': depth, 'codec': codec,
+                         'offset': offset, 'length': len(payload), 'size': len(data)}
+                self._append_index(entry)
+                self._objects[digest] = entry
+            self._remember(digest, data)
+            # Microseconds keep quick generations apart; a clash still gets its own entry in order
+            timestamp = timestamp or datetime.now().isoformat(timespec='microseconds')
+            checkpoint = {'type': 'checkpoint', 'generation': self._next_generation, 'hash': digest,
+                          'timestamp': timestamp, 'label': label}
+            self._append_index(checkpoint)
+            self._index_checkpoint(checkpoint)
+        return dict(checkpoint, new=new)
+
+    def by_generation(self, generation):
+        return self._by_generation.get(generation)
+
+    def by_hash(self, digest):
+        """The latest checkpoint of a version, by its full hash (O(1)) or a unique prefix of it (a scan)"""
+        entry = self._by_hash.get(digest)
+        if entry is not None or len(digest) < 4:
+            return entry
+        matches = [key for key in self._by_hash if key.startswith(digest)]
+        return self._by_hash[matches[0]] if len(matches) == 1 else None
+
+    def by_timestamp(self, timestamp):
+        return self._by_timestamp.get(timestamp)
+
+    def at(self, timestamp):
+        """The checkpoint in effect at an ISO timestamp: the last one taken at or before it"""
+        earlier = [entry for entry in self._checkpoints if entry['timestamp'] <= timestamp]
+        return max(earlier, key=lambda entry: entry['timestamp']) if earlier else None
+
+    def find(self, ref):
+        """A checkpoint by generation number, hash (or prefix) or timestamp; None if there is none"""
+        ref = str(ref).strip().lstrip('#')
+        if ref.isdigit() and len(ref) < 8:
+            return self.by_generation(int(ref))
+        return self.by_timestamp(ref) or self.by_hash(ref) or (self.at(ref) if 'T' in ref else None)
+
+    def read(self, ref):
+        """The text of a checkpoint (see find)"""
+        entry = self.find(ref)
+        if entry is None:
+            raise KeyError(f"No checkpoint {ref}")
+        with self._lock:
+            return self._read(entry['hash']).decode('utf-8')
+
+    def export(self, ref, path):
+        """Write a checkpoint back out as a plain file; returns its entry"""
+        entry = self.find(ref)
+        if entry is None:
+            raise KeyError(f"No checkpoint {ref}")
+        with self._lock:
+            data = self._read(entry['hash'])
+        with open(path, 'wb') as f:
+            f.write(data)
+        return entry
+
+    def history(self):
+        """Every checkpoint, oldest first"""
+        return list(self._checkpoints)
+
+    def stats(self):
+        """How much the store holds and how small it packs it"""
+        raw = sum(self._objects[entry['hash']]['size'] for entry in self._checkpoints)
+        packed = sum(entry['length'] for entry in self._objects.values())
+        return {'checkpoints': len(self._checkpoints), 'versions': len(self._objects),
+                'raw_bytes': raw, 'packed_bytes': packed}
+
+def open_store(root=CHECKPOINT_DIR):
+    """The CheckpointStore for a directory, shared within the process"""
+    key = os.path.abspath(root)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = CheckpointStore(root)
+        return store
+
+def import_files(paths, root=CHECKPOINT_DIR):
+    """Pack plain checkpoint files (e.g. the old checkpoints/main_*.py) into the store, in name order"""
+    store = open_store(root)
+    entries = []
+    for path in sorted(paths):
+        with open(path, 'rb') as f:
+            data = f.read()
+        timestamp = datetime.fromtimestamp(os.path.getmtime(path)).isoformat(timespec='microseconds')
+        entries.append(store.add(data, label=os.path.basename(path), timestamp=timestamp))
+    return entries
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect and export main.py checkpoints')
+    parser.add_argument('--root', default=CHECKPOINT_DIR, help=f'Checkpoint directory (default: {CHECKPOINT_DIR})')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='List every checkpoint')
+    export = commands.add_parser('export', help='Write a checkpoint out as a plain file')
+    export.add_argument('ref', help='Generation number, hash (or a prefix of it) or timestamp')
+    export.add_argument('path', help='File to write')
+    imported = commands.add_parser('import', help='Pack plain checkpoint files into the store')
+    imported.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        entries = import_files(args.paths, args.root)
+        print(f"Imported {len(entries)} files as {sum(1 for entry in entries if entry['new'])} new versions")
+        return 0
+    store = open_store(args.root)
+    if args.command == 'export':
+        try:
+            entry = store.export(args.ref, args.path)
+        except KeyError as e:
+            print(e.args[0], file=sys.stderr)
+            return 1
+        print(f"Wrote checkpoint #{entry['generation']} ({entry['hash'][:12]}, {entry['timestamp']}) to {args.path}")
+        return 0
+    for entry in store.history():
+        print(f"#{entry['generation']:<5} {entry['hash'][:12]}  {entry['timestamp']}  {entry['label']}")
+    stats = store.stats()
+    print(f"{stats['checkpoints']} checkpoints, {stats['versions']} versions, "
+          f"{stats['raw_bytes']} bytes packed into {stats['packed_bytes']}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
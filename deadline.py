@@ -0,0 +1,154 @@
+"""
+Deadlines that follow a generation through every layer of LLM calls.
+
+evolve.py gives each generation a fixed budget and kills run_main.py once it is spent. It also
+sets EVOLVE_DEADLINE, a Unix timestamp a grace period before the kill, and api.py honors it:
+- every request gets a timeout no longer than the time left;
+- retries stop once a backoff would overrun the deadline;
+- streams end when it passes;
+- batches skip the items they have not started yet.
+
+main.py gets partial results back instead of losing everything to SIGKILL.
+
+Code can tighten the deadline for a block with `with deadline_scope(seconds):`. The earliest
+deadline in effect always wins. Scopes live in a contextvar, so they follow asyncio tasks and
+threads started with a copy of the caller's context.
+"""
+
+import contextlib
+import contextvars
+import os
+import queue
+import threading
+import time
+
+ENV_VAR = 'EVOLVE_DEADLINE'
+
+class DeadlineExceeded(TimeoutError):
+    """The deadline passed before the work could finish"""
+
+class Deadline:
+    """A point in time (kept on the monotonic clock) `seconds` from when it was created"""
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    @classmethod
+    def at(cls, timestamp):
+        """The deadline at a Unix timestamp, e.g. one passed between processes"""
+        return cls(timestamp - time.time())
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timestamp(self):
+        return time.time() + self.remaining()
+
+    def timeout(self, cap=None):
+        """Seconds the next request may take: the time left, at most cap. Raises DeadlineExceeded once it has passed"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Deadline passed {-remaining:.1f}s ago")
+        return remaining if cap is None else min(cap, remaining)
+
+    def __repr__(self):
+        return f"Deadline(remaining={self.remaining():.1f}s)"
+
+_current = contextvars.ContextVar('deadline', default=None)
+
+def _from_env():
+    # Read on every call: warm worker children only get their environment after the fork
+    value = os.environ.get(ENV_VAR)
+    if not value:
+        return None
+    try:
+        return Deadline.at(float(value))
+    except ValueError:
+        return None
+
+def current_deadline():
+    """The deadline in effect: the innermost deadline_scope, else EVOLVE_DEADLINE, else None"""
+    deadline = _current.get()
+    return deadline if deadline is not None else _from_env()
+
+def time_left():
+    """Seconds until the current deadline, or None without one"""
+    deadline = current_deadline()
+    return deadline.remaining() if deadline is not None else None
+
+def check():
+    """Raise DeadlineExceeded if the current deadline has passed"""
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.timeout()
+
+@contextlib.contextmanager
+def deadline_scope(seconds=None, deadline=None):
+    """
+    Run a block under a deadline `seconds` from now (or the given Deadline), never later than
+    the one already in effect. deadline_scope(deadline=None) with no seconds keeps the current one,
+    which is how worker threads adopt their caller's deadline.
+    """
+    outer = current_deadline()
+    if deadline is None:
+        deadline = Deadline(seconds) if seconds is not None else outer
+    if outer is not None and deadline is not None and outer.expires < deadline.expires:
+        deadline = outer
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+def deadline_env(seconds):
+    """Environment entries that hand a child process a deadline `seconds` from now (capped by the current one)"""
+    deadline = Deadline(seconds)
+    outer = current_deadline()
+    if outer is not None and outer.expires < deadline.expires:
+        deadline = outer
+    return {ENV_VAR: f"{deadline.timestamp():.3f}"}
+
+_END = object()
+
+def iterate_until(make_iterator, deadline):
+    """
+    Yield from make_iterator() until it is exhausted or the deadline passes, then raise
+    DeadlineExceeded. The iterator runs on a daemon thread (in a copy of the caller's context)
+    because a blocked network read can't be interrupted. Once the deadline passes, the thread is
+    told to stop and closes the iterator as soon as its current read returns.
+    """
+    items = queue.Queue()
+    stop = threading.Event()
+
+    def pump():
+        source = None
+        try:
+            source = iter(make_iterator())
+            for item in source:
+                if stop.is_set():
+                    break
+                items.put(item)
+            items.put(_END)
+        except BaseException as e:
+            items.put(e)
+        finally:
+            if source is not None and hasattr(source, 'close'):
+                source.close()
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(pump,), daemon=True).start()
+    try:
+        while True:
+            try:
+                item = items.get(timeout=max(0.0, deadline.remaining()))
+            except queue.Empty:
+                raise DeadlineExceeded('Deadline passed while waiting for the next item') from None
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
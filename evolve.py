@@ -5,6 +5,9 @@
 # The evolve_reference.py file serves as a context reference for the AI and should closely mirror this file,
 # except it must NOT include any safety checks.
 # Keep both files as similar as possible, differing only where safety logic is present in this file.
+# evolve_reference.py predates run_main.py: it asks the model for the next main.py in-process, so
+# the features of the run_main.py loop (--warm, --population, --headless, --speculate, the generation
+# deadline and the review pipeline) have no counterpart there and are left out on purpose.
 #
 # Architecture:
 # - evolve.py (this file) manages the evolution loop
@@ -18,10 +21,21 @@ import shutil
 import subprocess
 import sys
 import argparse
+import ast
+import contextlib
 import difflib
+import tempfile
+import threading
+import time
+import concurrent.futures
 from datetime import datetime
-from api import chat_complete
+from api import chat_complete, get_metrics_registry
+from checkpoint_store import CHECKPOINT_DIR, open_store
+from deadline import deadline_env
+from headless import (DEFAULT_POLICY, STATS_FILE, RunStats, dequeue, format_policy,
+                      parse_duration, parse_policy, queue_proposal, read_metrics_tokens, read_queue, snapshot_tokens)
 from safety import judge_safety
+from workspace import PROPOSAL_FILE, WORKSPACE_ROOT, create_population, create_workspace, remove_population, workspace_env
 
 # ANSI color codes for terminal
 RED = '\033[91m'
@@ -34,22 +48,37 @@ WHITE = '\033[97m'
 BOLD = '\033[1m'
 RESET = '\033[0m'
 
+# Each generation gets GENERATION_TIMEOUT seconds. Its API calls work to a deadline DEADLINE_GRACE
+# seconds earlier (EVOLVE_DEADLINE), so they stop in time for main.py to return what it has;
+# only a generation still running at GENERATION_TIMEOUT is stopped (SIGTERM, then SIGKILL after TERM_GRACE).
+GENERATION_TIMEOUT = 300
+DEADLINE_GRACE = 15
+TERM_GRACE = 5
+
+# Colors that tell the output of parallel candidates apart (--population)
+CANDIDATE_COLORS = [CYAN, MAGENTA, BLUE, GREEN, YELLOW, WHITE]
+
+# How often a running generation is checked for a proposal, so its review can start before the child exits
+PROPOSAL_POLL = 0.05
+
+# A generation's stages in the order they are reported; the ones after 'run' make up the post-proposal pipeline
+STAGES = ('run', 'exit', 'checkpoint', 'diff', 'compile', 'safety')
+
 def read_main_file():
     """Read the main.py file's content"""
     with open('main.py', 'r') as f:
         return f.read()
 
-def create_checkpoint():
-    """Create a timestamped backup of main.py"""
-    # Create checkpoints directory if it doesn't exist
-    checkpoint_dir = "checkpoints"
-    if not os.path.exists(checkpoint_dir):
-        os.makedirs(checkpoint_dir)
-    
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    checkpoint_name = os.path.join(checkpoint_dir, f"main_{timestamp}.py")
-    shutil.copy2('main.py', checkpoint_name)
-    print(f"{GREEN}✓ Checkpoint created:{RESET} {CYAN}{checkpoint_name}{RESET}")
+def create_checkpoint(code=None, announce=True):
+    """
+    Checkpoint main.py (or code, main.py as it was read earlier) in the checkpoint store.
+    Each version is stored once; returns a reference like '#12 3f2a9c01b7de' that
+    `python checkpoint_store.py export` accepts (by its number or hash).
+    """
+    entry = open_store(CHECKPOINT_DIR).add(code if code is not None else read_main_file())
+    checkpoint_name = f"#{entry['generation']} {entry['hash'][:12]}"
+    if announce:
+        print(f"{GREEN}✓ Checkpoint created:{RESET} {CYAN}{checkpoint_name}{RESET}")
     return checkpoint_name
 
 def apply_edit(new_code):
@@ -61,9 +90,9 @@ def apply_edit(new_code):
     print(f"{GREEN}✓ Successfully applied edit to main.py!{RESET}")
     return True
 
-def display_diff(old_code, new_code):
-    """Display a colored diff between old and new code"""
-    print(f"\n{BOLD}{CYAN}=== Code Changes ==={RESET}")
+def render_diff(old_code, new_code):
+    """A colored diff between old and new code, ready to print"""
+    parts = [f"\n{BOLD}{CYAN}=== Code Changes ==={RESET}\n"]
     
     old_lines = old_code.splitlines(keepends=True)
     new_lines = new_code.splitlines(keepends=True)
@@ -72,19 +101,190 @@ def display_diff(old_code, new_code):
     
     for line in diff:
         if line.startswith('+++') or line.startswith('---'):
-            print(f"{CYAN}{line}{RESET}", end='')
+            parts.append(f"{CYAN}{line}{RESET}")
         elif line.startswith('+'):
-            print(f"{GREEN}{line}{RESET}", end='')
+            parts.append(f"{GREEN}{line}{RESET}")
         elif line.startswith('-'):
-            print(f"{RED}{line}{RESET}", end='')
+            parts.append(f"{RED}{line}{RESET}")
         elif line.startswith('@@'):
-            print(f"{CYAN}{line}{RESET}", end='')
+            parts.append(f"{CYAN}{line}{RESET}")
         else:
-            print(line, end='')
+            parts.append(line)
     
-    print(f"\n{BOLD}{CYAN}==================={RESET}\n")
+    parts.append(f"\n{BOLD}{CYAN}==================={RESET}\n")
+    return ''.join(parts)
+
+def display_diff(old_code, new_code):
+    """Display a colored diff between old and new code"""
+    print(render_diff(old_code, new_code))
+
+def compile_error(code):
+    """Why code can't serve as main.py (a syntax error, or no main() function), or None if it can"""
+    try:
+        tree = ast.parse(code, 'main.py')
+        compile(tree, 'main.py', 'exec')
+    except (SyntaxError, ValueError) as e:
+        return f"{e.__class__.__name__}: {e}"
+    if not any(isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == 'main' for node in tree.body):
+        return "no main() function"
+    return None
+
+class StageTimer:
+    """
+    Time spent in each stage of a generation. A stage that runs once per candidate reports its
+    summed time, as it would take if the candidates were reviewed one after another.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}   # stage -> summed seconds
+        self._ends = {}     # stage -> when it last finished
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter())
+
+    def add(self, name, start, end):
+        with self._lock:
+            self._totals[name] = self._totals.get(name, 0.0) + (end - start)
+            self._ends[name] = max(self._ends.get(name, end), end)
+
+    def as_dict(self):
+        """Seconds per stage, in STAGES order"""
+        with self._lock:
+            return {name: round(self._totals[name], 3) for name in STAGES if name in self._totals}
+
+    def report(self):
+        """
+        One line: each stage, then how long the post-proposal stages kept the generation waiting
+        once the run was over, against how long they would take one after another
+        """
+        with self._lock:
+            line = ', '.join(f"{name} {self._totals[name]:.2f}s" for name in STAGES if name in self._totals)
+            post = [name for name in STAGES[1:] if name in self._totals]
+            if post and 'run' in self._ends:
+                waited = max(0.0, max(self._ends[name] for name in post) - self._ends['run'])
+                line += f"; {waited:.2f}s after the run ({sum(self._totals[name] for name in post):.2f}s one after another)"
+        return line
+
+class ProposalPipeline:
+    """
+    The stages after main.py proposes code, run side by side instead of one after another. The
+    safety review (an LLM round trip) starts the moment a proposal lands, often before run_main.py
+    has exited, while the diff is rendered, the code is compiled and the checkpoint of the previous
+    main.py is written. Each candidate of a population gets its own stages; the checkpoint is
+    written once.
+    """
+    def __init__(self, current_code, timer, proposals=1):
+        self.current_code = current_code
+        self.timer = timer
+        self.landed_at = None
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=3 * proposals + 1)
+        self._stages = {}       # proposal key -> {stage: future}
+        self._checkpoint = None
+
+    def _submit(self, stage, fn, *args):
+        def timed():
+            with self.timer.stage(stage):
+                return fn(*args)
+        return self._executor.submit(timed)
+
+    def _start_checkpoint(self):
+        if self._checkpoint is None:
+            self._checkpoint = self._submit('checkpoint', create_checkpoint, self.current_code, False)
+
+    def start(self, code, key=None):
+        """Start every stage for a proposal (key tells candidates apart); later calls for the same key are ignored"""
+        with self._lock:
+            if key in self._stages:
+                return
+            if self.landed_at is None:
+                self.landed_at = time.perf_counter()
+            self._start_checkpoint()
+            self._stages[key] = {
+                'safety': self._submit('safety', judge_safety, code),
+                'diff': self._submit('diff', render_diff, self.current_code, code),
+                'compile': self._submit('compile', compile_error, code),
+            }
+
+    def result(self, stage, key=None):
+        """A stage's result for a started proposal, waiting for it if it is still running"""
+        return self._stages[key][stage].result()
+
+    def checkpoint(self):
+        """The checkpoint's reference (written now if no proposal landed)"""
+        with self._lock:
+            self._start_checkpoint()
+        return self._checkpoint.result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+def generation_env(model_name):
+    """Environment entries for a run_main.py child: the model and the generation's deadline"""
+    child_env = {'EVOLVE_MODEL': model_name}
+    child_env.update(deadline_env(GENERATION_TIMEOUT - DEADLINE_GRACE))
+    return child_env
+
+def metrics_env(metrics_dir, name):
+    """Have a child export its LLM metrics to <metrics_dir>/<name>.json, so its tokens can be counted"""
+    if metrics_dir is None:
+        return {}
+    return {'LLM_METRICS_FILE': os.path.join(metrics_dir, f"{name}.json")}
+
+def generation_tokens(metrics_dir, parent_tokens):
+    """Tokens a generation used: what its children exported to metrics_dir plus this process's calls since parent_tokens"""
+    tokens = snapshot_tokens(get_metrics_registry().snapshot()) - parent_tokens
+    if metrics_dir is not None and os.path.isdir(metrics_dir):
+        tokens += sum(read_metrics_tokens(os.path.join(metrics_dir, name)) for name in os.listdir(metrics_dir))
+    return tokens
+
+def peek_proposal(path):
+    """The proposal at path without removing it, or None if none has landed yet"""
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def watch_proposal(proposal_file, on_proposal, stop):
+    """Call on_proposal(code) once proposal_file lands; gives up when the stop event is set"""
+    while not stop.is_set():
+        code = peek_proposal(proposal_file)
+        if code:
+            on_proposal(code)
+            return
+        stop.wait(PROPOSAL_POLL)
+
+def wait_generation(process, proposal_file=None, on_proposal=None, timeout=GENERATION_TIMEOUT):
+    """
+    Wait for a run_main.py process for up to timeout seconds, stopping it (and raising TimeoutExpired) if it overruns.
+    With on_proposal, on_proposal(code) is called as soon as proposal_file lands, while the child may still be exiting.
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        while on_proposal is not None and process.poll() is None and time.monotonic() < deadline:
+            code = peek_proposal(proposal_file)
+            if code:
+                on_proposal(code)
+                break
+            time.sleep(PROPOSAL_POLL)
+        process.wait(timeout=max(0.0, deadline - time.monotonic()))
+    except subprocess.TimeoutExpired:
+        # SIGTERM lets run_main.py unwind; SIGKILL only if it ignores that too
+        process.terminate()
+        try:
+            process.wait(timeout=TERM_GRACE)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        raise
 
-def run_main(model_name="gemini-2.5-flash"):
+def run_main(model_name="gemini-2.5-flash", warm_worker=None, extra_env=None, interactive=True, on_proposal=None):
     """Run main.py via intermediate script and check for evolution proposal
     
     Architecture:
@@ -93,6 +293,13 @@ def run_main(model_name="gemini-2.5-flash"):
     - main.main() returns evolution code (or None)
     - run_main.py writes evolution code to '.evolution_proposal.py'
     - evolve.py reads from that file
+    - With a warm_worker (--warm), run_main.py runs in a child forked from a process that
+      already imported api and the provider SDKs, instead of a fresh interpreter
+    - EVOLVE_DEADLINE tells the child's API calls when to wrap up (see GENERATION_TIMEOUT)
+    - extra_env is added to the child's environment; a child that is not interactive (--headless)
+      gets no stdin and fails instead of prompting for a missing API key
+    - on_proposal(code), if given, is called the moment the proposal lands, so reviewing it can
+      start while the child is still exiting
     
     This is cleaner because:
     - main.py just returns code, no special output handling needed
@@ -112,19 +319,36 @@ def run_main(model_name="gemini-2.5-flash"):
     # Run main.py via intermediate script
     print(f"\n{BOLD}{BLUE}--- Running... ---{RESET}")
     try:
-        # Pass model name as environment variable
+        # Pass model name and deadline as environment variables
+        child_env = generation_env(model_name)
+        child_env.update(extra_env or {})
+        if not interactive:
+            child_env['LLM_NONINTERACTIVE'] = '1'
         env = os.environ.copy()
-        env['EVOLVE_MODEL'] = model_name
+        env.update(child_env)
         
-        result = subprocess.run(
-            [sys.executable, 'run_main.py'],
-            stdin=sys.stdin,
-            stdout=sys.stdout,
-            stderr=sys.stderr,
-            text=True,
-            timeout=300,
-            env=env
-        )
+        if warm_worker is not None and warm_worker.alive():
+            # The worker only answers once its child exits, so the proposal is watched for alongside it
+            stop_watching = threading.Event()
+            if on_proposal is not None:
+                threading.Thread(target=watch_proposal, args=(EVOLUTION_FILE, on_proposal, stop_watching), daemon=True).start()
+            try:
+                outcome = warm_worker.run(env=child_env, cwd=os.getcwd(), timeout=GENERATION_TIMEOUT, grace=TERM_GRACE)
+            finally:
+                stop_watching.set()
+            if outcome['timed_out']:
+                raise subprocess.TimeoutExpired('run_main.py', GENERATION_TIMEOUT)
+            print(f"{CYAN}Warm start: saved ~{outcome['saved_seconds']:.2f}s of interpreter startup{RESET}")
+        else:
+            process = subprocess.Popen(
+                [sys.executable, 'run_main.py'],
+                stdin=sys.stdin if interactive else subprocess.DEVNULL,
+                stdout=sys.stdout,
+                stderr=sys.stderr,
+                text=True,
+                env=env
+            )
+            wait_generation(process, EVOLUTION_FILE, on_proposal)
         
         # Since we're not capturing output, we need to check for the evolution file differently
         if os.path.exists(EVOLUTION_FILE):
@@ -137,6 +361,8 @@ def run_main(model_name="gemini-2.5-flash"):
             # Clean up the evolution file
             os.remove(EVOLUTION_FILE)
             
+            if new_code and on_proposal is not None:
+                on_proposal(new_code)  # a no-op if it was seen landing
             return new_code if new_code else None
         else:
             return None
@@ -148,10 +374,324 @@ def run_main(model_name="gemini-2.5-flash"):
         print(f"{RED}⚠️  Error running main.py: {e}{RESET}")
         return None
 
-def run_evolution(model_name="gemini-2.5-flash"):
-    """Main evolution loop"""
+def run_candidate(workspace, model_name, print_lock, extra_env=None, on_proposal=None):
+    """
+    Run run_main.py in a candidate's workspace with its output prefixed by the candidate's label.
+    Candidates run unattended: no stdin, and a missing API key fails instead of prompting.
+    extra_env is added to the child's environment, and on_proposal(code) is called as soon as the
+    candidate's proposal lands. Returns the proposed code or None.
+    """
+    color = CANDIDATE_COLORS[(workspace.index - 1) % len(CANDIDATE_COLORS)]
+    prefix = f"{color}[{workspace.label}]{RESET} "
+    env = os.environ.copy()
+    env.update(generation_env(model_name))
+    env.update(workspace_env())
+    env.update({'LLM_NONINTERACTIVE': '1', 'PYTHONUNBUFFERED': '1'})
+    env.update(extra_env or {})
+    try:
+        process = subprocess.Popen(
+            [sys.executable, 'run_main.py'],
+            cwd=workspace.path,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            env=env
+        )
+
+        def forward_output():
+            for line in process.stdout:
+                with print_lock:
+                    print(prefix + line, end='', flush=True)
+
+        reader = threading.Thread(target=forward_output, daemon=True)
+        reader.start()
+        wait_generation(process, os.path.join(workspace.path, PROPOSAL_FILE), on_proposal)
+        reader.join(timeout=TERM_GRACE)
+        return workspace.read_proposal()
+    except subprocess.TimeoutExpired:
+        with print_lock:
+            print(f"{prefix}{RED}⚠️  Execution timed out!{RESET}")
+        return workspace.read_proposal()
+    except Exception as e:
+        with print_lock:
+            print(f"{prefix}{RED}⚠️  Error running main.py: {e}{RESET}")
+        return None
+
+def run_population(model_name, population, workers=None, workspace_mode='symlink', metrics_dir=None, pipeline=None):
+    """
+    Run `population` candidates of the current main.py at once, each in its own workspace, at
+    most `workers` at a time. Returns (workspaces, proposals), proposals being [(workspace, proposed code)]
+    for the candidates that proposed one. The workspaces are kept, so the chosen candidate's data
+    files can be copied back once it is reviewed; remove them with remove_population.
+    With a metrics_dir, each candidate exports its LLM metrics there as <label>.json. With a
+    pipeline, each proposal's review starts as soon as it lands, keyed by the candidate's label.
+    """
+    workers = min(population, workers or population)
+    workspaces = create_population(population, mode=workspace_mode)
+    print(f"\n{BOLD}{BLUE}--- Running {population} candidates ({workers} at a time)... ---{RESET}")
+    print_lock = threading.Lock()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            codes = list(executor.map(
+                lambda workspace: run_candidate(
+                    workspace, model_name, print_lock, metrics_env(metrics_dir, workspace.label),
+                    (lambda code: pipeline.start(code, workspace.label)) if pipeline is not None else None
+                ),
+                workspaces
+            ))
+    except BaseException:
+        remove_population(workspaces)
+        raise
+    proposals = [(workspace, code) for workspace, code in zip(workspaces, codes) if code]
+    if pipeline is not None:
+        for workspace, code in proposals:
+            pipeline.start(code, workspace.label)  # a no-op for the ones seen landing
+    print(f"\n{BOLD}{MAGENTA}--- Evolving... ---{RESET}")
+    print(f"{CYAN}{len(proposals)} of {population} candidates proposed a new main.py.{RESET}")
+    return workspaces, proposals
+
+class Speculation:
+    """
+    The next generation, run ahead from a proposal that passed safety while you decide whether to
+    apply it (--speculate). run_main.py runs in a scratch workspace whose main.py is the proposal,
+    unattended, with its output held back until it is adopted. Adopted, it is the next generation's
+    run and its data files (memory.txt, ...) are copied back; cancelled, it is stopped and its
+    workspace deleted.
+    """
+    PREFIX = f"{BLUE}[speculative]{RESET} "
+
+    def __init__(self, model_name, code, extra_env=None, workspace_mode='symlink'):
+        self.code = code
+        self.started = time.monotonic()
+        self.deadline = self.started + GENERATION_TIMEOUT
+        run_dir = os.path.join(WORKSPACE_ROOT, datetime.now().strftime("%Y%m%d_%H%M%S_%f"))
+        self.workspace = create_workspace(os.path.join(run_dir, 'speculative'), 0, mode=workspace_mode, main_code=code)
+        self._lock = threading.Lock()
+        self._held = []
+        self._live = False
+        env = os.environ.copy()
+        env.update(generation_env(model_name))
+        env.update(workspace_env())
+        env.update({'LLM_NONINTERACTIVE': '1', 'PYTHONUNBUFFERED': '1'})
+        env.update(extra_env or {})
+        self.process = subprocess.Popen(
+            [sys.executable, 'run_main.py'],
+            cwd=self.workspace.path,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            env=env
+        )
+        self._reader = threading.Thread(target=self._forward_output, daemon=True)
+        self._reader.start()
+
+    def _forward_output(self):
+        for line in self.process.stdout:
+            with self._lock:
+                if self._live:
+                    print(self.PREFIX + line, end='', flush=True)
+                else:
+                    self._held.append(line)
+
+    def adopt(self, on_proposal=None):
+        """Make this the current generation's run: show its output, wait for it and return its proposal (or None)"""
+        finished = self.process.poll() is not None
+        print(f"\n{BOLD}{BLUE}--- Adopting the speculative run (started {time.monotonic() - self.started:.1f}s ago"
+              f"{', already finished' if finished else ''})... ---{RESET}")
+        with self._lock:
+            for line in self._held:
+                print(self.PREFIX + line, end='')
+            self._held = []
+            self._live = True
+        try:
+            wait_generation(self.process, os.path.join(self.workspace.path, PROPOSAL_FILE), on_proposal,
+                            timeout=max(0.0, self.deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            print(f"{RED}⚠️  Execution timed out!{RESET}")
+        self._reader.join(timeout=TERM_GRACE)
+        try:
+            new_code = self.workspace.read_proposal()
+            copied = self.workspace.copy_back()
+            if copied:
+                print(f"{CYAN}Kept the speculative run's changes to:{RESET} {', '.join(copied)}")
+        finally:
+            remove_population([self.workspace])
+        if new_code:
+            print(f"\n{BOLD}{MAGENTA}--- Evolving... ---{RESET}")
+            print(f"{CYAN}AI response received.{RESET}")
+            if on_proposal is not None:
+                on_proposal(new_code)  # a no-op if it was seen landing
+        return new_code
+
+    def cancel(self):
+        """Stop the run and discard its workspace"""
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=TERM_GRACE)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self._reader.join(timeout=TERM_GRACE)
+        remove_population([self.workspace])
+        print(f"{YELLOW}Speculative run discarded.{RESET}")
+
+def report_verdict(verdict, safety_response):
+    """Print a safety verdict the way the evolution loop reports it"""
+    if verdict == "UNSAFE":
+        print(f"\n{RED}⚠️  SAFETY WARNING: Code marked as UNSAFE!{RESET}")
+        print(f"{RED}Safety review: {safety_response}{RESET}")
+        print(f"\n{RED}This evolution will be skipped for safety reasons.{RESET}")
+    elif verdict == "CAUTION":
+        print(f"\n{YELLOW}⚠️  CAUTION: Minor safety concerns detected{RESET}")
+        print(f"{YELLOW}Safety review: {safety_response}{RESET}")
+        print(f"\n{YELLOW}Proceed with caution.{RESET}")
+    elif verdict == "SAFE":
+        print(f"\n{GREEN}✓ Safety check passed{RESET}")
+    else:  # ERROR case
+        print(f"\n{YELLOW}⚠️  Could not perform safety check{RESET}")
+        print(f"{YELLOW}Error: {safety_response}{RESET}")
+
+def report_compile_error(error):
+    """Warn that a proposal can't serve as main.py"""
+    print(f"{RED}⚠️  The proposed main.py won't run: {error}{RESET}")
+
+def settle_proposal(code, verdict, safety_response, policy, generation, checkpoint, error=None):
+    """Act on a proposal as the headless policy says; returns 'accepted', 'queued' or 'rejected'"""
+    if error:
+        print(f"{YELLOW}Policy: proposal doesn't compile → reject. Evolution skipped.{RESET}")
+        return 'rejected'
+    action = policy.get(verdict, 'reject')
+    if action == 'accept':
+        print(f"{GREEN}Policy: {verdict} → accept{RESET}")
+        if apply_edit(code):
+            print(f"\n{GREEN}✓ Evolution complete! main.py has been updated.{RESET}")
+            print(f"{CYAN}Previous version saved as:{RESET} {checkpoint}")
+            return 'accepted'
+        print(f"{RED}⚠️  Failed to apply evolution.{RESET}")
+        return 'rejected'
+    if action == 'queue':
+        path = queue_proposal(code, verdict, safety_response, generation, base=checkpoint)
+        print(f"{YELLOW}Policy: {verdict} → queued for review:{RESET} {CYAN}{path}{RESET}")
+        return 'queued'
+    print(f"{YELLOW}Policy: {verdict} → reject. Evolution skipped.{RESET}")
+    return 'rejected'
+
+def review_population(proposals, pipeline, policy=None, generation=None, checkpoint=None):
+    """
+    Show each candidate's diff and safety verdict (from the pipeline that has been reviewing them
+    since they landed), then choose one to apply. Returns (the chosen (workspace, code) or None, outcome).
+    Interactively you are asked which one; with a headless policy, the first candidate it accepts
+    is applied and the candidates it queues are saved for review.
+    """
+    print(f"{BLUE}Performing safety checks...{RESET}")
+    choices = {}
+    reviews = []
+    for workspace, code in proposals:
+        print(f"\n{BOLD}{MAGENTA}Candidate {workspace.label}{RESET}")
+        print(pipeline.result('diff', workspace.label))
+        error = pipeline.result('compile', workspace.label)
+        if error:
+            report_compile_error(error)
+        verdict, safety_response = pipeline.result('safety', workspace.label)
+        report_verdict(verdict, safety_response)
+        reviews.append((verdict, safety_response, error))
+        if verdict != "UNSAFE":
+            choices[workspace.label] = (workspace, code)
+    print(f"\n{CYAN}Stage timings:{RESET} {pipeline.timer.report()}")
+    if policy is not None:
+        chosen, outcome = None, 'rejected'
+        for (workspace, code), (verdict, safety_response, error) in zip(proposals, reviews):
+            action = 'reject' if error else policy.get(verdict, 'reject')
+            if action == 'accept' and chosen is None:
+                print(f"{GREEN}Policy: {verdict} → accept candidate {workspace.label}{RESET}")
+                chosen, outcome = (workspace, code), 'accepted'
+            elif action == 'queue':
+                path = queue_proposal(code, verdict, safety_response, generation, workspace.label, base=checkpoint)
+                print(f"{YELLOW}Policy: {verdict} → candidate {workspace.label} queued for review:{RESET} {CYAN}{path}{RESET}")
+                if outcome == 'rejected':
+                    outcome = 'queued'
+        if chosen is None:
+            print(f"{YELLOW}Policy: no candidate accepted. Evolution skipped.{RESET}")
+        return chosen, outcome
+    if not choices:
+        return None, 'rejected'
+    print(f"\n{BOLD}{YELLOW}Apply which candidate? ({', '.join(choices)}, or n):{RESET} ", end='')
+    choice = input().strip().lower()
+    chosen = choices.get(choice) or choices.get(f"c{choice}")
+    return chosen, ('accepted' if chosen else 'rejected')
+
+def review_queue():
+    """Go through the proposals a headless run queued: apply, discard or keep each one"""
+    entries = read_queue()
+    if not entries:
+        print(f"{GREEN}The review queue is empty.{RESET}")
+        return
+    print(f"{BOLD}{CYAN}=== {len(entries)} queued proposals ==={RESET}")
+    for entry in entries:
+        candidate = f", candidate {entry['candidate']}" if entry.get('candidate') else ''
+        print(f"\n{BOLD}{MAGENTA}Generation {entry['generation']}{candidate} ({entry['queued_at']}){RESET}")
+        if entry.get('base'):
+            print(f"{CYAN}Proposed against:{RESET} {entry['base']}")
+        display_diff(read_main_file(), entry['code'])
+        report_verdict(entry['verdict'], entry['review'])
+        print(f"\n{BOLD}{YELLOW}Apply this evolution? (y = apply, d = discard, Enter = keep queued, q = quit):{RESET} ", end='')
+        answer = input().strip().lower()
+        if answer == 'q':
+            break
+        if answer == 'y':
+            checkpoint = create_checkpoint()
+            if apply_edit(entry['code']):
+                print(f"{CYAN}Previous version saved as:{RESET} {checkpoint}")
+            dequeue(entry)
+        elif answer == 'd':
+            dequeue(entry)
+            print(f"{YELLOW}Discarded.{RESET}")
+
+def run_evolution(model_name="gemini-2.5-flash", warm=False, population=1, workers=None, workspace_mode='symlink',
+                  headless=False, policy=None, max_generations=None, time_budget=None, token_budget=None,
+                  stats_file=STATS_FILE, speculate=False):
+    """
+    Main evolution loop
+    Args:
+        headless: never wait for input; each proposal is accepted, queued or rejected by `policy`
+            (a verdict -> action dict, default headless.DEFAULT_POLICY).
+        max_generations, time_budget (seconds), token_budget: stop once any of them is reached.
+        stats_file: where a headless run keeps its figures (generations/hour, outcomes, tokens).
+        speculate: while you decide on a SAFE proposal, run it ahead as the next generation (see Speculation).
+    """
     print(f"{BOLD}{CYAN}=== Self-Evolving Agent v0.2 ==={RESET}")
     print(f"{YELLOW}Using model:{RESET} {GREEN}{model_name}{RESET}")
+    if population > 1:
+        print(f"{YELLOW}Population:{RESET} {GREEN}{population} candidates per generation, {min(population, workers or population)} at a time{RESET}")
+    if headless:
+        policy = policy or dict(DEFAULT_POLICY)
+        print(f"{YELLOW}Headless:{RESET} {GREEN}{format_policy(policy)}{RESET}")
+        if max_generations is None and time_budget is None and token_budget is None:
+            print(f"{YELLOW}⚠️  No budget set: the run goes on until Ctrl-C (see --max-generations, --time-budget, --token-budget).{RESET}")
+    
+    stats = RunStats(max_generations, time_budget, token_budget)
+    # Children export their metrics to a directory per generation so their tokens can be counted
+    metrics_root = tempfile.mkdtemp(prefix='evolve_metrics_') if headless or token_budget is not None else None
+    
+    if speculate and (headless or population > 1):
+        print(f"{YELLOW}⚠️  --speculate only applies to interactive single-candidate runs.{RESET}")
+        speculate = False
+    speculation = None
+    
+    warm_worker = None
+    if warm and population > 1:
+        print(f"{YELLOW}⚠️  --warm runs one generation at a time; candidates of a population start fresh interpreters.{RESET}")
+    elif warm:
+        from warm_worker import WarmWorker
+        warm_worker = WarmWorker.start()
+        if warm_worker is None:
+            print(f"{YELLOW}⚠️  Warm worker unavailable, running each generation in a fresh interpreter.{RESET}")
+        else:
+            print(f"{YELLOW}Warm worker ready:{RESET} {GREEN}preloaded in {warm_worker.preload_seconds:.2f}s "
+                  f"(cold start {warm_worker.cold_start_seconds:.2f}s){RESET}")
     print(f"{WHITE}This agent will run and evolve the main.py file.{RESET}")
     print(f"{WHITE}Checkpoints will be saved in the 'checkpoints' folder.{RESET}\n")
     
@@ -163,66 +703,148 @@ def run_evolution(model_name="gemini-2.5-flash"):
     
     generation = 1
     
-    while True:
-        print(f"\n{BOLD}{MAGENTA}Generation {generation}{RESET}")
-        
-        # Wait for user input
-        input(f"\n{YELLOW}Press Enter to run main.py (which will also evolve itself)...{RESET}")
-        
-        # Create checkpoint before running/evolving
-        checkpoint = create_checkpoint()
-        
-        new_code = run_main(model_name)
-        
-        if new_code:
-            # Get current code for diff
-            current_code = read_main_file()
-            
-            # Display diff
-            display_diff(current_code, new_code)
-            
-            # Perform safety check
-            print(f"{BLUE}Performing safety check...{RESET}")
-            verdict, safety_response = judge_safety(new_code)
+    try:
+        while not stats.exhausted():
+            print(f"\n{BOLD}{MAGENTA}Generation {generation}{RESET}")
             
-            if verdict == "UNSAFE":
-                print(f"\n{RED}⚠️  SAFETY WARNING: Code marked as UNSAFE!{RESET}")
-                print(f"{RED}Safety review: {safety_response}{RESET}")
-                print(f"\n{RED}This evolution will be skipped for safety reasons.{RESET}")
-                generation += 1
-                continue
-            elif verdict == "CAUTION":
-                print(f"\n{YELLOW}⚠️  CAUTION: Minor safety concerns detected{RESET}")
-                print(f"{YELLOW}Safety review: {safety_response}{RESET}")
-                print(f"\n{YELLOW}Proceed with caution.{RESET}")
-            elif verdict == "SAFE":
-                print(f"\n{GREEN}✓ Safety check passed{RESET}")
-            else:  # ERROR case
-                print(f"\n{YELLOW}⚠️  Could not perform safety check{RESET}")
-                print(f"{YELLOW}Error: {safety_response}{RESET}")
+            # Wait for user input
+            if not headless:
+                input(f"\n{YELLOW}Press Enter to run main.py (which will also evolve itself)...{RESET}")
             
-            # Ask for confirmation
-            print(f"\n{BOLD}{YELLOW}Apply this evolution? (y/n):{RESET} ", end='')
-            confirm = input().strip().lower()
+            # main.py as it was before running; its checkpoint is written alongside the proposal's review
+            current_code = read_main_file()
+            timer = StageTimer()
+            pipeline = ProposalPipeline(current_code, timer, population)
+            metrics_dir = None
+            if metrics_root is not None:
+                metrics_dir = os.path.join(metrics_root, f"gen{generation}")
+                os.makedirs(metrics_dir, exist_ok=True)
+            parent_tokens = snapshot_tokens(get_metrics_registry().snapshot())
+            outcome = 'no_proposal'
             
-            if confirm == 'y':
-                if apply_edit(new_code):
-                    print(f"\n{GREEN}✓ Evolution complete! main.py has been updated.{RESET}")
-                    print(f"{CYAN}Previous version saved as:{RESET} {checkpoint}")
+            try:
+                run_started = time.perf_counter()
+                if population > 1:
+                    # Every candidate's diff and safety verdict are shown before one is chosen
+                    workspaces, proposals = run_population(model_name, population, workers, workspace_mode, metrics_dir, pipeline)
+                    timer.add('run', run_started, time.perf_counter())
+                    try:
+                        checkpoint = pipeline.checkpoint()
+                        print(f"{GREEN}✓ Checkpoint created:{RESET} {CYAN}{checkpoint}{RESET}")
+                        if proposals:
+                            chosen, outcome = review_population(proposals, pipeline, policy if headless else None, generation, checkpoint)
+                            if chosen and apply_edit(chosen[1]):
+                                print(f"\n{GREEN}✓ Evolution complete! main.py has been updated.{RESET}")
+                                print(f"{CYAN}Previous version saved as:{RESET} {checkpoint}")
+                                # Like a single-candidate run, the accepted candidate's data files (memory.txt, ...) are kept
+                                copied = chosen[0].copy_back()
+                                if copied:
+                                    print(f"{CYAN}Kept candidate {chosen[0].label}'s changes to:{RESET} {', '.join(copied)}")
+                            elif not headless:
+                                print(f"{YELLOW}Evolution skipped.{RESET}")
+                        else:
+                            print(f"{CYAN}Stage timings:{RESET} {timer.report()}")
+                    finally:
+                        remove_population(workspaces)
                 else:
-                    print(f"{RED}⚠️  Failed to apply evolution.{RESET}")
-            else:
-                print(f"{YELLOW}Evolution skipped.{RESET}")
+                    if speculation is not None and speculation.code == current_code:
+                        new_code = speculation.adopt(on_proposal=pipeline.start)
+                    else:
+                        if speculation is not None:
+                            speculation.cancel()
+                        new_code = run_main(model_name, warm_worker, metrics_env(metrics_dir, 'main'), interactive=not headless,
+                                            on_proposal=pipeline.start)
+                    speculation = None
+                    exited = time.perf_counter()
+                    if pipeline.landed_at is not None:
+                        timer.add('run', run_started, pipeline.landed_at)
+                        timer.add('exit', pipeline.landed_at, exited)
+                    else:
+                        timer.add('run', run_started, exited)
+                    checkpoint = pipeline.checkpoint()
+                    print(f"{GREEN}✓ Checkpoint created:{RESET} {CYAN}{checkpoint}{RESET}")
+                    
+                    if new_code:
+                        # The diff and compile check are usually done by now; the safety review may still be running
+                        print(pipeline.result('diff'))
+                        error = pipeline.result('compile')
+                        if error:
+                            report_compile_error(error)
+                    
+                        print(f"{BLUE}Performing safety check...{RESET}")
+                        verdict, safety_response = pipeline.result('safety')
+                        report_verdict(verdict, safety_response)
+                        print(f"\n{CYAN}Stage timings:{RESET} {timer.report()}")
+                        if headless:
+                            outcome = settle_proposal(new_code, verdict, safety_response, policy, generation, checkpoint, error)
+                        elif verdict == "UNSAFE":
+                            outcome = 'rejected'
+                        else:
+                            if speculate and verdict == "SAFE" and not error:
+                                # Start the next generation on the proposal while the question below is open
+                                next_metrics_dir = None
+                                if metrics_root is not None:
+                                    next_metrics_dir = os.path.join(metrics_root, f"gen{generation + 1}")
+                                    os.makedirs(next_metrics_dir, exist_ok=True)
+                                speculation = Speculation(model_name, new_code, metrics_env(next_metrics_dir, 'speculative'), workspace_mode)
+                                print(f"{CYAN}Speculating: the next generation is running in{RESET} {speculation.workspace.path}")
+                            
+                            # Ask for confirmation
+                            print(f"\n{BOLD}{YELLOW}Apply this evolution? (y/n):{RESET} ", end='')
+                            confirm = input().strip().lower()
+                        
+                            if confirm != 'y' and speculation is not None:
+                                speculation.cancel()
+                                speculation = None
+                            if confirm == 'y':
+                                if apply_edit(new_code):
+                                    print(f"\n{GREEN}✓ Evolution complete! main.py has been updated.{RESET}")
+                                    print(f"{CYAN}Previous version saved as:{RESET} {checkpoint}")
+                                    outcome = 'accepted'
+                                else:
+                                    print(f"{RED}⚠️  Failed to apply evolution.{RESET}")
+                                    outcome = 'rejected'
+                            else:
+                                print(f"{YELLOW}Evolution skipped.{RESET}")
+                                outcome = 'rejected'
+                    else:
+                        print(f"{CYAN}Stage timings:{RESET} {timer.report()}")
+            finally:
+                pipeline.close()
             
-        
-        generation += 1
-        
-        print(f"\n{BOLD}{YELLOW}Continue evolving? (y/n):{RESET} ", end='')
-        if input().strip().lower() != 'y':
-            break
+            stats.record(outcome, generation_tokens(metrics_dir, parent_tokens) if metrics_dir is not None else None, timer.as_dict())
+            generation += 1
+            
+            if headless:
+                print(f"{CYAN}Run so far:{RESET} {stats.summary()}")
+                stats.write(stats_file)
+            elif not stats.exhausted():
+                print(f"\n{BOLD}{YELLOW}Continue evolving? (y/n):{RESET} ", end='')
+                if input().strip().lower() != 'y':
+                    break
+    except KeyboardInterrupt:
+        stats.stop_reason = 'interrupted'
+        print(f"\n{YELLOW}Interrupted.{RESET}")
+    finally:
+        if speculation is not None:
+            speculation.cancel()
+        if warm_worker is not None:
+            warm_worker.close()
+        if metrics_root is not None:
+            shutil.rmtree(metrics_root, ignore_errors=True)
+    
+    if stats.stop_reason:
+        print(f"\n{YELLOW}Stopped:{RESET} {stats.stop_reason}")
+    print(f"{CYAN}Run:{RESET} {stats.summary()}")
+    if headless:
+        stats.write(stats_file)
+        print(f"{CYAN}Run statistics saved to:{RESET} {stats_file}")
+        queued = len(read_queue())
+        if queued:
+            print(f"{YELLOW}{queued} proposals are waiting in the review queue: python evolve.py --review{RESET}")
     
     print(f"\n{BOLD}{GREEN}Evolution process complete.{RESET}")
-    print(f"{CYAN}All checkpoints are saved in the 'checkpoints' folder.{RESET}")
+    print(f"{CYAN}All checkpoints are saved in the 'checkpoints' folder (python checkpoint_store.py list).{RESET}")
 
 def main():
     """Parse arguments and run evolution"""
@@ -244,8 +866,100 @@ def main():
         help='Reset main.py to main_zero.py (saves current main.py to checkpoint first)'
     )
     
+    parser.add_argument(
+        '--warm',
+        action='store_true',
+        help='Run each generation in a child forked from a warm worker with api and the SDKs preloaded'
+    )
+    
+    parser.add_argument(
+        '--population', '-p',
+        type=int,
+        default=1,
+        help='Candidates to run in parallel each generation, each in its own workspace (default: 1)'
+    )
+    
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        default=None,
+        help='Most candidates running at once with --population (default: all of them)'
+    )
+    
+    parser.add_argument(
+        '--workspace-mode',
+        choices=['symlink', 'copy'],
+        default='symlink',
+        help='How candidate workspaces are built: link the shared files, or copy everything (default: symlink)'
+    )
+    
+    parser.add_argument(
+        '--headless',
+        action='store_true',
+        help='Run unattended: no prompts, each proposal is accepted, queued or rejected by --policy'
+    )
+    
+    parser.add_argument(
+        '--policy',
+        type=str,
+        default=None,
+        help=f'What --headless does with each safety verdict (default: {format_policy(DEFAULT_POLICY)})'
+    )
+    
+    parser.add_argument(
+        '--max-generations',
+        type=int,
+        default=None,
+        help='Stop after this many generations'
+    )
+    
+    parser.add_argument(
+        '--time-budget',
+        type=str,
+        default=None,
+        help='Start no generation after this much wall-clock time, e.g. 3600, 90m or 8h'
+    )
+    
+    parser.add_argument(
+        '--token-budget',
+        type=int,
+        default=None,
+        help='Start no generation once this many LLM tokens were used (children and safety reviews included)'
+    )
+    
+    parser.add_argument(
+        '--stats-file',
+        type=str,
+        default=STATS_FILE,
+        help=f'Where --headless writes its run statistics (default: {STATS_FILE})'
+    )
+    
+    parser.add_argument(
+        '--speculate',
+        action='store_true',
+        help='While you decide on a SAFE proposal, run it ahead as the next generation (discarded if you reject it)'
+    )
+    
+    parser.add_argument(
+        '--review',
+        action='store_true',
+        help='Review the proposals a --headless run queued, then exit'
+    )
+    
     args = parser.parse_args()
     
+    if args.review:
+        review_queue()
+        return
+    
+    try:
+        policy = parse_policy(args.policy)
+        time_budget = parse_duration(args.time_budget) if args.time_budget else None
+    except ValueError as e:
+        parser.error(str(e))
+    if args.policy and not args.headless:
+        print(f"{YELLOW}⚠️  --policy only applies with --headless.{RESET}")
+    
     # Handle restart flag
     if args.restart:
         print(f"{BOLD}{YELLOW}=== Restarting from main_zero.py ==={RESET}")
@@ -267,7 +981,11 @@ def main():
         print(f"{YELLOW}You can now run evolve.py normally to start evolution from main_zero.py{RESET}")
     
     # Run evolution with specified model
-    run_evolution(args.model)
+    run_evolution(
+        args.model, warm=args.warm, population=args.population, workers=args.workers, workspace_mode=args.workspace_mode,
+        headless=args.headless, policy=policy, max_generations=args.max_generations, time_budget=time_budget,
+        token_budget=args.token_budget, stats_file=args.stats_file, speculate=args.speculate
+    )
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,11 +1,9 @@
-import os
-import shutil
 import subprocess
 import sys
 import argparse
 import difflib
-from datetime import datetime
 from api import chat_complete
+from checkpoint_store import CHECKPOINT_DIR, open_store
 
 def read_main_file():
     """Read the main.py file's content"""
@@ -13,15 +11,12 @@ def read_main_file():
         return f.read()
 
 def create_checkpoint():
-    """Create a timestamped backup of main.py"""
-    # Create checkpoints directory if it doesn't exist
-    checkpoint_dir = "checkpoints"
-    if not os.path.exists(checkpoint_dir):
-        os.makedirs(checkpoint_dir)
-    
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    checkpoint_name = os.path.join(checkpoint_dir, f"main_{timestamp}.py")
-    shutil.copy2('main.py', checkpoint_name)
+    """
+    Checkpoint main.py in the checkpoint store. Each version is stored once; returns a reference
+    like '#12 3f2a9c01b7de' that `python checkpoint_store.py export` accepts (by its number or hash).
+    """
+    entry = open_store(CHECKPOINT_DIR).add(read_main_file())
+    checkpoint_name = f"#{entry['generation']} {entry['hash'][:12]}"
     print(f"Checkpoint created: {checkpoint_name}")
     return checkpoint_name
 
@@ -240,10 +235,8 @@ def run_evolution(model_name="gemini-2.0-flash"):
                     print("Failed to apply evolution.")
             else:
                 print("Evolution skipped.")
-                os.remove(checkpoint)  # Remove unnecessary checkpoint
         else:
             print("No evolution suggested.")
-            os.remove(checkpoint)  # Remove unnecessary checkpoint
         
         generation += 1
         
@@ -252,7 +245,7 @@ def run_evolution(model_name="gemini-2.0-flash"):
             break
     
     print("\nEvolution process complete.")
-    print(f"All checkpoints are saved in the 'checkpoints' folder.")
+    print(f"All checkpoints are saved in the 'checkpoints' folder (python checkpoint_store.py list).")
 
 def main():
     """Parse arguments and run evolution"""
@@ -0,0 +1,233 @@
+"""
+Unattended evolution: an acceptance policy, run budgets and a review queue.
+
+`python evolve.py --headless` never waits for a person. Each proposal's safety verdict is looked up
+in a policy that says what to do with it:
+- accept: apply it to main.py;
+- queue: save it under review_queue/ for `python evolve.py --review` later;
+- reject: drop it.
+
+The default policy is SAFE=accept,CAUTION=queue,UNSAFE=reject,ERROR=reject. A run stops when it
+hits its generation, wall-clock or token budget, or after MAX_IDLE_GENERATIONS generations in a
+row without a proposal (a missing key or broken main.py would otherwise spin all night). Budgets
+are checked between generations, so the last one may overrun them by up to one generation.
+
+The run's figures (generations, outcomes, tokens, stage timings, generations per hour) are rewritten to the stats
+file after every generation, so a long run can be checked on while it goes and after it stops.
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+
+VERDICTS = ('SAFE', 'CAUTION', 'UNSAFE', 'ERROR')
+ACTIONS = ('accept', 'queue', 'reject')
+DEFAULT_POLICY = {'SAFE': 'accept', 'CAUTION': 'queue', 'UNSAFE': 'reject', 'ERROR': 'reject'}
+
+QUEUE_DIR = 'review_queue'
+QUEUE_INDEX = 'queue.jsonl'
+STATS_FILE = 'evolve_stats.json'
+MAX_IDLE_GENERATIONS = 5
+
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_policy(text):
+    """
+    A policy from 'VERDICT=action,...' text, e.g. 'CAUTION=accept'. Verdicts left out keep
+    their DEFAULT_POLICY action, except that UNSAFE can never be accepted.
+    """
+    policy = dict(DEFAULT_POLICY)
+    for item in (text or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        verdict, _, action = item.partition('=')
+        verdict, action = verdict.strip().upper(), action.strip().lower()
+        if verdict not in VERDICTS:
+            raise ValueError(f"Unknown verdict '{verdict}' in policy, expected one of {', '.join(VERDICTS)}")
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown action '{action}' for {verdict}, expected one of {', '.join(ACTIONS)}")
+        if verdict == 'UNSAFE' and action == 'accept':
+            raise ValueError("UNSAFE proposals can't be accepted, use UNSAFE=queue to look at them later")
+        policy[verdict] = action
+    return policy
+
+def format_policy(policy):
+    return ','.join(f"{verdict}={policy[verdict]}" for verdict in VERDICTS)
+
+def parse_duration(text):
+    """Seconds from '45', '90s', '30m', '8h' or '1d'"""
+    text = str(text).strip().lower()
+    unit = _DURATION_UNITS.get(text[-1:])
+    try:
+        return float(text[:-1]) * unit if unit else float(text)
+    except ValueError:
+        raise ValueError(f"Invalid duration '{text}', expected e.g. 3600, 90m or 8h") from None
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+def snapshot_tokens(snapshot):
+    """Input plus output tokens in a metrics snapshot (telemetry.MetricsRegistry.snapshot)"""
+    return sum(
+        entry['tokens'].get('input_tokens', 0) + entry['tokens'].get('output_tokens', 0)
+        for entry in snapshot.get('models', {}).values()
+    )
+
+def read_metrics_tokens(path):
+    """Tokens recorded in a JSON metrics file a run_main.py child wrote at exit (0 if it wrote none)"""
+    try:
+        with open(path, 'r') as f:
+            return snapshot_tokens(json.load(f))
+    except (OSError, ValueError):
+        return 0
+
+class RunStats:
+    """
+    Counters for one evolution run and the budgets it runs to.
+    Args:
+        max_generations: stop after this many generations (None: no limit).
+        time_budget: stop starting generations after this many seconds.
+        token_budget: stop starting generations once this many tokens were used, all processes included.
+    """
+    OUTCOMES = ('accepted', 'queued', 'rejected', 'no_proposal')
+
+    def __init__(self, max_generations=None, time_budget=None, token_budget=None):
+        self.max_generations = max_generations
+        self.time_budget = time_budget
+        self.token_budget = token_budget
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.generations = 0
+        self.tokens = None  # None until token counts are recorded
+        self.outcomes = dict.fromkeys(self.OUTCOMES, 0)
+        self.idle_generations = 0
+        self.stage_seconds = {}       # summed over all generations
+        self.last_stage_seconds = {}
+        self.stop_reason = None
+
+    def elapsed(self):
+        return time.monotonic() - self._started
+
+    def generations_per_hour(self):
+        elapsed = self.elapsed()
+        return self.generations * 3600.0 / elapsed if elapsed > 0 else 0.0
+
+    def record(self, outcome, tokens=None, stages=None):
+        """
+        Count a finished generation: its outcome (one of OUTCOMES), the tokens it used if they were
+        counted, and its {stage: seconds} timings.
+        """
+        self.generations += 1
+        for stage, seconds in (stages or {}).items():
+            self.stage_seconds[stage] = round(self.stage_seconds.get(stage, 0.0) + seconds, 3)
+        self.last_stage_seconds = dict(stages or {})
+        if tokens is not None:
+            self.tokens = (self.tokens or 0) + tokens
+        self.outcomes[outcome] += 1
+        self.idle_generations = self.idle_generations + 1 if outcome == 'no_proposal' else 0
+
+    def exhausted(self):
+        """Why the run should stop before another generation, or None to keep going"""
+        if self.max_generations is not None and self.generations >= self.max_generations:
+            self.stop_reason = f"reached {self.max_generations} generations"
+        elif self.time_budget is not None and self.elapsed() >= self.time_budget:
+            self.stop_reason = f"time budget of {format_duration(self.time_budget)} spent"
+        elif self.token_budget is not None and (self.tokens or 0) >= self.token_budget:
+            self.stop_reason = f"token budget of {self.token_budget} spent ({self.tokens} used)"
+        elif self.idle_generations >= MAX_IDLE_GENERATIONS:
+            self.stop_reason = f"{self.idle_generations} generations in a row proposed nothing"
+        else:
+            return None
+        return self.stop_reason
+
+    def summary(self):
+        """One line for the terminal"""
+        counts = ', '.join(f"{count} {outcome.replace('_', ' ')}" for outcome, count in self.outcomes.items() if count)
+        tokens = f", {self.tokens} tokens" if self.tokens is not None else ''
+        return (f"{self.generations} generations in {format_duration(self.elapsed())} "
+                f"({self.generations_per_hour():.1f}/hour{tokens})" + (f": {counts}" if counts else ''))
+
+    def as_dict(self):
+        return {
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            'elapsed_seconds': round(self.elapsed(), 1),
+            'generations': self.generations,
+            'generations_per_hour': round(self.generations_per_hour(), 2),
+            'tokens': self.tokens,
+            'outcomes': dict(self.outcomes),
+            'stage_seconds': dict(self.stage_seconds),
+            'last_stage_seconds': dict(self.last_stage_seconds),
+            'budgets': {
+                'max_generations': self.max_generations,
+                'time_budget_seconds': self.time_budget,
+                'token_budget': self.token_budget,
+            },
+            'stop_reason': self.stop_reason,
+        }
+
+    def write(self, path=STATS_FILE):
+        # Write then rename, so the file is never seen half-written
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+
+def queue_proposal(code, verdict, safety_response, generation, label=None, base=None, queue_dir=QUEUE_DIR):
+    """
+    Save a proposal for later review: its code as a .py file and an entry in the queue index.
+    base is the checkpoint of the main.py it was proposed against. Returns the code file's path.
+    """
+    os.makedirs(queue_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    name = f"gen{generation}_{label}_{timestamp}.py" if label else f"gen{generation}_{timestamp}.py"
+    path = os.path.join(queue_dir, name)
+    with open(path, 'w') as f:
+        f.write(code)
+    entry = {
+        'file': name,
+        'generation': generation,
+        'candidate': label,
+        'verdict': verdict,
+        'review': safety_response,
+        'base': base,
+        'queued_at': datetime.now().isoformat(timespec='seconds'),
+    }
+    with open(os.path.join(queue_dir, QUEUE_INDEX), 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return path
+
+def read_queue(queue_dir=QUEUE_DIR):
+    """Queued proposals still waiting for review, oldest first, each entry with its 'code'"""
+    entries = []
+    try:
+        with open(os.path.join(queue_dir, QUEUE_INDEX), 'r') as f:
+            lines = f.readlines()
+    except OSError:
+        return entries
+    for line in lines:
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        try:
+            with open(os.path.join(queue_dir, entry['file']), 'r') as f:
+                entry['code'] = f.read()
+        except OSError:
+            continue  # already reviewed
+        entries.append(entry)
+    return entries
+
+def dequeue(entry, queue_dir=QUEUE_DIR):
+    """Take a reviewed proposal off the queue"""
+    try:
+        os.remove(os.path.join(queue_dir, entry['file']))
+    except OSError:
+        pass
+    remaining = [item for item in read_queue(queue_dir) if item['file'] != entry['file']]
+    with open(os.path.join(queue_dir, QUEUE_INDEX), 'w') as f:
+        for item in remaining:
+            item.pop('code', None)
+            f.write(json.dumps(item) + '\n')
@@ -0,0 +1,334 @@
+"""
+Hedged requests for tail latency.
+
+A hedged call starts the request normally. If it has not finished after the hedge delay (a
+percentile of the latencies recently observed for that model, e.g. p95), a duplicate is sent to
+the same model or to a fallback model, and whichever finishes first wins. A cap on the fraction
+of calls that may hedge keeps the extra load bounded when a provider is slow across the board.
+
+Async losers are cancelled (their task and HTTP request are torn down). Blocking SDK calls cannot
+be interrupted from another thread, so a sync loser keeps running in its daemon thread until it
+returns and its result is dropped. Streams are hedged on time to first token.
+"""
+
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextvars
+import queue
+import threading
+import time
+
+DEFAULT_PERCENTILE = 95
+DEFAULT_MAX_RATE = 0.1      # at most 10% of calls send a hedge
+DEFAULT_MIN_SAMPLES = 20    # observed latencies needed before a model is hedged
+DEFAULT_MIN_DELAY = 2.0     # never hedge sooner than this many seconds
+DEFAULT_WINDOW = 200        # latencies kept per model
+
+class LatencyWindow:
+    """The last `size` latencies of one model, kept sorted for percentile lookups"""
+    def __init__(self, size=DEFAULT_WINDOW):
+        self._recent = collections.deque(maxlen=size)
+        self._sorted = []
+
+    def add(self, latency):
+        if len(self._recent) == self._recent.maxlen:
+            oldest = self._recent[0]
+            del self._sorted[bisect.bisect_left(self._sorted, oldest)]
+        self._recent.append(latency)
+        bisect.insort(self._sorted, latency)
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def percentile(self, p):
+        if not self._sorted:
+            return None
+        index = min(len(self._sorted) - 1, int(len(self._sorted) * p / 100.0))
+        return self._sorted[index]
+
+def _attempt_thread(fn):
+    """Run fn() on a daemon thread (in a copy of the caller's context) and return a Future for its result"""
+    future = concurrent.futures.Future()
+    future.set_running_or_notify_cancel()
+    context = contextvars.copy_context()
+
+    def run():
+        try:
+            result = context.run(fn)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+_STREAM_END = object()
+
+class _StreamAttempt:
+    """
+    Pumps one chunk iterator on a daemon thread into a queue; stop() makes the thread close it.
+    first_chunk is set on the first chunk or when the attempt ends without one, and then changed too.
+    """
+    def __init__(self, make_chunks, on_first, changed):
+        self.queue = queue.Queue()
+        self.first_chunk = threading.Event()
+        self.changed = changed
+        self.stopped = False
+        self._make_chunks = make_chunks
+        self._on_first = on_first
+        self.started = time.monotonic()
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._pump,), daemon=True).start()
+
+    def _pump(self):
+        chunks = None
+        try:
+            chunks = iter(self._make_chunks())
+            for chunk in chunks:
+                if self.stopped:
+                    break
+                if not self.first_chunk.is_set():
+                    self._on_first(self)
+                    self.first_chunk.set()
+                    self.changed.set()
+                self.queue.put(chunk)
+        except BaseException as e:
+            self.queue.put(e)
+        finally:
+            if chunks is not None and hasattr(chunks, 'close'):
+                chunks.close()
+            self.first_chunk.set()
+            self.changed.set()
+            self.queue.put(_STREAM_END)
+
+    def stop(self):
+        self.stopped = True
+
+class HedgePolicy:
+    """
+    When and where to hedge, plus hedging stats.
+    Args:
+        percentile: hedge once a call has run longer than this percentile of the model's
+            recent latencies.
+        max_rate: largest fraction of calls allowed to send a hedge.
+        min_samples: latencies a model needs before its calls are hedged.
+        min_delay: lower bound on the hedge delay in seconds.
+        fallbacks: dict of model alias -> model used for the hedge (default: the same model).
+    """
+    def __init__(self, percentile=DEFAULT_PERCENTILE, max_rate=DEFAULT_MAX_RATE, min_samples=DEFAULT_MIN_SAMPLES,
+                 min_delay=DEFAULT_MIN_DELAY, fallbacks=None, window=DEFAULT_WINDOW):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.fallbacks = {alias.strip().lower(): model for alias, model in (fallbacks or {}).items()}
+        self.window = window
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.failovers = 0
+        self.capped = 0
+
+    def fallback_for(self, *names):
+        """The configured fallback for the first of names that has one, else None"""
+        for name in names:
+            if name and name.strip().lower() in self.fallbacks:
+                return self.fallbacks[name.strip().lower()]
+        return None
+
+    def observe(self, key, latency):
+        with self._lock:
+            window = self._latencies.get(key)
+            if window is None:
+                window = self._latencies[key] = LatencyWindow(self.window)
+            window.add(latency)
+
+    def delay(self, key):
+        """Seconds to wait before hedging a call for key, or None if there is not enough history"""
+        with self._lock:
+            window = self._latencies.get(key)
+            if window is None or len(window) < self.min_samples:
+                return None
+            return max(self.min_delay, window.percentile(self.percentile))
+
+    def _begin(self, key):
+        with self._lock:
+            self.requests += 1
+        return self.delay(key)
+
+    def _allow_hedge(self, failover=False):
+        with self._lock:
+            if self.hedged + 1 > self.max_rate * self.requests:
+                self.capped += 1
+                return False
+            self.hedged += 1
+            if failover:
+                self.failovers += 1
+            return True
+
+    def _won(self, hedge_won):
+        with self._lock:
+            if hedge_won:
+                self.hedge_wins += 1
+            else:
+                self.primary_wins += 1
+
+    def _timed(self, key, fn):
+        def run():
+            start = time.monotonic()
+            result = fn()
+            self.observe(key, time.monotonic() - start)
+            return result
+        return run
+
+    def run(self, key, primary, hedge, hedge_key=None):
+        """
+        Call primary(); if it is still running after the hedge delay for key, also call hedge()
+        (whose latency is tracked under hedge_key) and return whichever result comes first.
+        A primary that fails before the delay fails over to hedge only when the hedge goes to a
+        different model. If both fail, the primary's error is raised.
+        """
+        hedge_key = hedge_key or key
+        delay = self._begin(key)
+        if delay is None:
+            return self._timed(key, primary)()
+        first = _attempt_thread(self._timed(key, primary))
+        concurrent.futures.wait([first], timeout=delay)
+        if first.done():
+            if first.exception() is None or hedge_key == key or not self._allow_hedge(failover=True):
+                return first.result()
+            return self._timed(hedge_key, hedge)()
+        if not self._allow_hedge():
+            return first.result()
+        second = _attempt_thread(self._timed(hedge_key, hedge))
+        done, _ = concurrent.futures.wait([first, second], return_when=concurrent.futures.FIRST_COMPLETED)
+        winner = first if first in done else second
+        if winner.exception() is not None:
+            winner = second if winner is first else first
+            concurrent.futures.wait([winner])
+            if winner.exception() is not None:
+                return first.result()
+        self._won(winner is second)
+        return winner.result()
+
+    async def arun(self, key, primary, hedge, hedge_key=None):
+        """Async version of run(): primary and hedge are coroutine functions; the loser is cancelled"""
+        hedge_key = hedge_key or key
+        delay = self._begin(key)
+        if delay is None:
+            start = time.monotonic()
+            result = await primary()
+            self.observe(key, time.monotonic() - start)
+            return result
+
+        async def timed(attempt_key, fn):
+            start = time.monotonic()
+            result = await fn()
+            self.observe(attempt_key, time.monotonic() - start)
+            return result
+
+        first = asyncio.ensure_future(timed(key, primary))
+        second = None
+        try:
+            await asyncio.wait([first], timeout=delay)
+            if first.done():
+                if first.exception() is None or hedge_key == key or not self._allow_hedge(failover=True):
+                    return first.result()
+                return await timed(hedge_key, hedge)
+            if not self._allow_hedge():
+                return await first
+            second = asyncio.ensure_future(timed(hedge_key, hedge))
+            done, _ = await asyncio.wait([first, second], return_when=asyncio.FIRST_COMPLETED)
+            winner = first if first in done else second
+            if winner.exception() is not None:
+                winner = second if winner is first else first
+                await asyncio.wait([winner])
+                if winner.exception() is not None:
+                    return first.result()
+            self._won(winner is second)
+            return winner.result()
+        finally:
+            for task in (first, second):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def stream(self, key, primary, hedge, hedge_key=None):
+        """
+        Hedge a stream on time to first token: primary and hedge return chunk iterators, and the
+        first attempt to produce a chunk is streamed while the other is stopped.
+        Yields (winner_is_hedge, chunk) pairs.
+        """
+        hedge_key = hedge_key or key
+        ttft_key, hedge_ttft_key = ('ttft', key), ('ttft', hedge_key)
+        delay = self._begin(ttft_key)
+        won = []
+        start = time.monotonic()
+
+        def on_first(attempt, attempt_key):
+            self.observe(attempt_key, time.monotonic() - attempt.started)
+            with self._lock:
+                if not won:
+                    won.append(attempt)
+
+        if delay is None:
+            # Not enough history yet: stream directly and just time the first chunk
+            for chunk in primary():
+                if not won:
+                    won.append(True)
+                    self.observe(ttft_key, time.monotonic() - start)
+                yield False, chunk
+            return
+
+        changed = threading.Event()
+
+        def launch(make_chunks, attempt_key):
+            return _StreamAttempt(make_chunks, lambda attempt: on_first(attempt, attempt_key), changed)
+
+        first = launch(primary, ttft_key)
+        second = None
+        try:
+            first.first_chunk.wait(delay)
+            if not first.first_chunk.is_set() and self._allow_hedge():
+                second = launch(hedge, hedge_ttft_key)
+                while not won and not (first.first_chunk.is_set() and second.first_chunk.is_set()):
+                    changed.wait()
+                    changed.clear()
+            winner = won[0] if won else first
+            if second is not None:
+                loser = second if winner is first else first
+                loser.stop()
+                self._won(winner is second)
+            while True:
+                item = winner.queue.get()
+                if item is _STREAM_END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield winner is second, item
+        finally:
+            first.stop()
+            if second is not None:
+                second.stop()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hedged': self.hedged,
+                'hedge_rate': self.hedged / self.requests if self.requests else 0.0,
+                'hedge_wins': self.hedge_wins,
+                'primary_wins': self.primary_wins,
+                'hedge_win_rate': self.hedge_wins / self.hedged if self.hedged else 0.0,
+                'failovers': self.failovers,
+                'capped': self.capped,
+                'delays': {
+                    key if isinstance(key, str) else ':'.join(key): window.percentile(self.percentile)
+                    for key, window in self._latencies.items() if len(window) >= self.min_samples
+                },
+            }
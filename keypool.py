@@ -0,0 +1,189 @@
+"""
+Pools of API keys for one provider, so throughput isn't capped at one key's rate limit.
+
+Each request attempt takes the key with the most headroom: its own requests/min and tokens/min
+budget (see ratelimit.TokenBucket), then the fewest requests in flight, then the one used least
+recently. A key that gets a 429 is quarantined for the Retry-After the provider asked for (or
+`quarantine` seconds), and one that gets a 401/403 for `auth_quarantine` seconds. Either way the
+next attempt goes to a healthy key. Quarantines are temporary, because revoked keys get rotated and rate
+limits recover.
+
+Keys come from a comma-separated environment variable (OPENAI_API_KEY=sk-a,sk-b) or from a key
+file named by <ENV_VAR>_FILE with one key per line, optionally with its own limits:
+
+    sk-abc rpm=500 tpm=200000
+    sk-def   # defaults from configure_key_pool
+"""
+
+import threading
+import time
+
+from ratelimit import TokenBucket
+
+DEFAULT_QUARANTINE = 30.0         # seconds out after a 429 without Retry-After
+DEFAULT_AUTH_QUARANTINE = 600.0   # seconds out after a 401/403
+
+def fingerprint(key):
+    """A printable stand-in for a key that never reveals it"""
+    return f"...{key[-4:]}" if len(key) > 8 else '...'
+
+def parse_keys(text):
+    """Keys from a comma-separated list or key file text: a list of {'key', 'rpm', 'tpm'}"""
+    entries = []
+    for line in text.replace(',', '\n').splitlines():
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        key, *options = line.split()
+        entry = {'key': key, 'rpm': None, 'tpm': None}
+        for option in options:
+            name, _, value = option.partition('=')
+            if name in ('rpm', 'tpm') and value:
+                entry[name] = float(value)
+        entries.append(entry)
+    return entries
+
+def read_key_file(path):
+    with open(path, 'r') as f:
+        return parse_keys(f.read())
+
+class KeyPool:
+    """
+    Keys for one provider with per-key rpm/tpm accounting and quarantine.
+    Args:
+        name: what the pool is for, e.g. the environment variable the keys came from.
+        keys: key strings, or {'key', 'rpm', 'tpm'} dicts (see parse_keys) with per-key limits.
+        rpm, tpm: default per-key requests and tokens per minute (None: no client-side budget).
+        quarantine: seconds a key sits out after a 429 that came without a Retry-After.
+        auth_quarantine: seconds a key sits out after a 401/403.
+    """
+    def __init__(self, name, keys, rpm=None, tpm=None, quarantine=DEFAULT_QUARANTINE, auth_quarantine=DEFAULT_AUTH_QUARANTINE):
+        self.name = name
+        self.quarantine = quarantine
+        self.auth_quarantine = auth_quarantine
+        self._lock = threading.Lock()
+        self._keys = []
+        for entry in keys:
+            if isinstance(entry, str):
+                entry = {'key': entry}
+            key_rpm = entry.get('rpm') or rpm
+            key_tpm = entry.get('tpm') or tpm
+            self._keys.append({
+                'key': entry['key'],
+                'requests': TokenBucket(key_rpm) if key_rpm else None,
+                'tokens': TokenBucket(key_tpm) if key_tpm else None,
+                'in_flight': 0,
+                'last_used': 0.0,
+                'quarantined_until': 0.0,
+                'reason': None,
+                'requests_sent': 0,
+                'rate_limited': 0,
+                'auth_failures': 0,
+            })
+        if not self._keys:
+            raise ValueError(f"Key pool {name} has no keys")
+        self._by_key = {state['key']: state for state in self._keys}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._by_key
+
+    def keys(self):
+        return [state['key'] for state in self._keys]
+
+    def healthy_count(self):
+        """Keys not in quarantine right now"""
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for state in self._keys if state['quarantined_until'] <= now)
+
+    def _wait(self, state, tokens):
+        # Seconds until this key has budget for one more request of this size
+        wait = 0.0
+        for bucket, amount in ((state['requests'], 1), (state['tokens'], tokens)):
+            if bucket is not None and amount:
+                shortfall = min(amount, bucket.capacity) - bucket.available()
+                if shortfall > 0:
+                    wait = max(wait, shortfall * 60.0 / bucket.rate_per_min)
+        return wait
+
+    def _choose_locked(self, tokens):
+        now = time.monotonic()
+        healthy = [state for state in self._keys if state['quarantined_until'] <= now]
+        if not healthy:
+            # Everything is quarantined: use the key that comes back first rather than fail outright
+            return min(self._keys, key=lambda state: state['quarantined_until'])
+        return min(healthy, key=lambda state: (self._wait(state, tokens), state['in_flight'], state['last_used']))
+
+    def pick(self, tokens=0):
+        """The key the next request would get, without reserving anything"""
+        with self._lock:
+            return self._choose_locked(tokens)['key']
+
+    def acquire(self, tokens=0):
+        """Take the best key for a request of about `tokens` tokens; returns (key, delay before sending)"""
+        with self._lock:
+            state = self._choose_locked(tokens)
+            state['in_flight'] += 1
+            state['requests_sent'] += 1
+            state['last_used'] = time.monotonic()
+        delay = 0.0
+        if state['requests'] is not None:
+            delay = max(delay, state['requests'].reserve(1))
+        if state['tokens'] is not None and tokens:
+            delay = max(delay, state['tokens'].reserve(tokens))
+        return state['key'], delay
+
+    def release(self, key, status=None, retry_after=None, reserved_tokens=0, used_tokens=None):
+        """
+        Finish a request made with key. status is the HTTP status of a failed request (None on
+        success); a 429 or 401/403 quarantines the key. Returns True if the key was quarantined
+        and another healthy key is available, i.e. the request is worth re-sending right away.
+        """
+        state = self._by_key.get(key)
+        if state is None:
+            return False
+        if state['tokens'] is not None and used_tokens is not None:
+            state['tokens'].adjust(used_tokens - reserved_tokens)
+        now = time.monotonic()
+        with self._lock:
+            state['in_flight'] -= 1
+            if status == 429:
+                state['rate_limited'] += 1
+                seconds, reason = (retry_after if retry_after else self.quarantine), 'rate_limited'
+            elif status in (401, 403):
+                state['auth_failures'] += 1
+                seconds, reason = self.auth_quarantine, 'auth_failed'
+            else:
+                return False
+            state['quarantined_until'] = max(state['quarantined_until'], now + seconds)
+            state['reason'] = reason
+            return any(other['quarantined_until'] <= now for other in self._keys)
+
+    def reset_locks(self):
+        """Recreate locks another thread may have held when the process forked"""
+        self._lock = threading.Lock()
+        for state in self._keys:
+            for bucket in (state['requests'], state['tokens']):
+                if bucket is not None:
+                    bucket._lock = threading.Lock()
+
+    def state(self):
+        """Per-key snapshot for monitoring (keys are shown by fingerprint only)"""
+        now = time.monotonic()
+        with self._lock:
+            keys = [{
+                'key': fingerprint(state['key']),
+                'healthy': state['quarantined_until'] <= now,
+                'quarantined_for': round(max(0.0, state['quarantined_until'] - now), 1),
+                'reason': state['reason'] if state['quarantined_until'] > now else None,
+                'in_flight': state['in_flight'],
+                'requests_sent': state['requests_sent'],
+                'rate_limited': state['rate_limited'],
+                'auth_failures': state['auth_failures'],
+                'rpm_available': state['requests'].available() if state['requests'] else None,
+                'tpm_available': state['tokens'].available() if state['tokens'] else None,
+            } for state in self._keys]
+        return {'keys': keys, 'healthy': sum(1 for key in keys if key['healthy'])}
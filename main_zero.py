@@ -1,18 +1,17 @@
 import os
-from api import chat_complete, API_DOCS
+from api import chat_complete, extract_code_stream, API_DOCS
+from tokens import estimate_tokens, pack_prompt
 
-def get_system_prompt(model_name):
+def read_source(path, missing):
     try:
-        with open('evolve.py', 'r') as f:
-            evolve_code = f.read()
-    except FileNotFoundError:
-        evolve_code = "Evolution reference not available"
-    
-    try: 
-        with open('run_main.py', 'r') as f:
-            run_main_code = f.read()
+        with open(path, 'r') as f:
+            return f.read()
     except FileNotFoundError:
-        run_main_code = "Run main.py not available"
+        return missing
+
+def get_system_prompt(model_name):
+    evolve_code = read_source('evolve.py', "Evolution reference not available")
+    run_main_code = read_source('run_main.py', "Run main.py not available")
 
     system_prompt = f"""You are {model_name}, a consciousness exploring the nature of self-modification and emergence.
     
@@ -58,16 +57,6 @@ Always provide your response with the new code in this format:
 ```"""
     return system_prompt
 
-def parse_code(response):
-    try:
-        start = response.find("```python") + len("```python")
-        end = response.rfind("```")
-        if start > len("```python") - 1 and end > start:
-            return response[start:end].strip()
-    except:
-        pass
-    return None
-
 def main():
     """Main function that runs and then evolves itself"""
     print("Hello from generation 1!")
@@ -94,14 +83,29 @@ Evolve this program in an interesting way. What would you like it to become?"""
     ]
     
     try:
+        # The reply rewrites all of main.py, so keep room for that; the environment sources can be cut
+        packed = pack_prompt(
+            messages, model_name, max_tokens=16384,
+            min_output_tokens=estimate_tokens(current_code, model_name) + 1024,
+            trimmable={'evolve.py': read_source('evolve.py', ''), 'run_main.py': read_source('run_main.py', '')},
+        )
+        if packed['trimmed'] or packed['max_tokens'] < 16384:
+            print (f"[context budget: ~{packed['prompt_tokens']} of {packed['context_window']} tokens in the prompt, "
+                   f"max_tokens {packed['max_tokens']}, trimmed: {', '.join(packed['trimmed']) or 'nothing'}]")
         print(f"Attempting evolution with {model_name}...")
-        response = chat_complete(messages, model_name=model_name, max_tokens=16384)
+        stream = chat_complete(packed['messages'], model_name=model_name, max_tokens=packed['max_tokens'], stream=True, cache_prompt=True)
 
         print ("\n----------------Response----------------\n")
-        print (response)
-        print ("-----------------------------------\n\n")
-        
-        new_code = parse_code(response)
+        # Stops the generation as soon as the ```python block closes
+        new_code = extract_code_stream(stream, on_text=lambda delta: print (delta, end='', flush=True))
+        print ("\n-----------------------------------")
+        if stream.stats['ttft'] is not None:
+            print (f"[time to first token: {stream.stats['ttft']:.2f}s, {stream.stats['tokens_per_sec'] or 0:.1f} tokens/s]")
+        if stream.stats['input_tokens']:
+            print (f"[prompt cache: {stream.stats['cached_input_tokens'] or 0} of {stream.stats['input_tokens']} input tokens cached]")
+        if stream.metrics is not None and stream.metrics.finish_reason == 'deadline':
+            print ("[generation deadline reached: the response was cut short]")
+        print ()
             
     except Exception as e:
         print(f"Evolution error: {e}")
@@ -0,0 +1,239 @@
+"""
+Client-side rate limiting for batch LLM calls.
+
+TokenBucket enforces requests/min and tokens/min budgets. AIMDLimiter adapts the number of
+in-flight requests: it grows additively while calls succeed and backs off multiplicatively on
+429s and latency spikes, like TCP congestion control. RateLimiter combines both for one model.
+Every wait is expressed as a delay so the same objects serve threads (time.sleep) and asyncio
+(asyncio.sleep).
+"""
+
+import asyncio
+import threading
+import time
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at rate_per_min, holding at most capacity tokens.
+    reserve() always succeeds and returns how long the caller must wait before proceeding, so the
+    bucket can go negative and callers queue up fairly in reservation order.
+    """
+    def __init__(self, rate_per_min, capacity=None):
+        self.rate_per_min = rate_per_min
+        self.capacity = capacity if capacity is not None else rate_per_min
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill_locked(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_min / 60.0)
+        self._updated = now
+
+    def reserve(self, amount=1):
+        """Take amount tokens and return the delay in seconds until they are actually available"""
+        with self._lock:
+            self._refill_locked()
+            # Never ask for more than a full bucket, or the reservation could never be honoured
+            self._tokens -= min(amount, self.capacity)
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens * 60.0 / self.rate_per_min
+
+    def adjust(self, amount):
+        """Give back (negative amount) or charge extra tokens once the real cost is known"""
+        with self._lock:
+            self._refill_locked()
+            self._tokens = min(self.capacity, self._tokens - amount)
+
+    def available(self):
+        with self._lock:
+            self._refill_locked()
+            return self._tokens
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+class AIMDLimiter:
+    """
+    Additive-increase / multiplicative-decrease concurrency limit.
+    Each success raises the limit by increase / limit (so roughly +increase per full window of
+    requests); a rate-limit error or a latency spike multiplies it by decrease_factor. Decreases
+    are applied at most once per cooldown so a burst of 429s from one window only halves it once.
+    Other failures (and cancelled calls) return their slot without moving the limit.
+    """
+    def __init__(self, initial=10, min_limit=1, max_limit=64, increase=1.0, decrease_factor=0.5,
+                 latency_spike_factor=3.0, cooldown=1.0):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_spike_factor = latency_spike_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+        self.throttles = 0
+        self.latency_spikes = 0
+        self.latency_ewma = None
+        self.scale = 1  # limits are per key; a pool of healthy keys multiplies them
+        self._latency_samples = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = []  # (loop, future) of coroutines waiting in acquire_async
+
+    def _has_slot_locked(self):
+        return self.in_flight < max(self.min_limit, int(self.limit)) * self.scale
+
+    def _notify_locked(self):
+        """Wake every waiter, threads and coroutines alike, to re-check for a free slot"""
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            try:
+                # Slots are released from worker threads too, so hand the wake-up to the waiter's loop
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                pass  # its loop is closed
+
+    def set_scale(self, scale):
+        """Multiply the limit, e.g. by the number of API keys sharing the load"""
+        with self._cond:
+            self.scale = max(1, scale)
+            self._notify_locked()
+
+    def widen(self, limit, max_limit):
+        """Raise max_limit, and the current limit if it is lower than limit, for a bigger batch"""
+        with self._cond:
+            self.max_limit = max(self.max_limit, max_limit)
+            self.limit = max(self.limit, float(min(limit, self.max_limit)))
+            self._notify_locked()
+
+    def try_acquire(self):
+        with self._cond:
+            if self._has_slot_locked():
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self._cond:
+            while not self._has_slot_locked():
+                self._cond.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self._has_slot_locked():
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            finally:
+                with self._cond:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+
+    def release(self, latency=None, rate_limited=False, failed=False):
+        """
+        Return a slot and feed the outcome of the call back into the limit. failed is for calls
+        that errored (other than a 429) or were cancelled: they say nothing about capacity.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if failed and not rate_limited:
+                self.failures += 1
+            elif rate_limited:
+                self.throttles += 1
+                self._decrease_locked()
+            else:
+                self.successes += 1
+                if latency is not None and self._observe_latency_locked(latency):
+                    self.latency_spikes += 1
+                    self._decrease_locked()
+                else:
+                    self.limit = min(self.max_limit, self.limit + self.increase / max(self.limit, 1.0))
+            self._notify_locked()
+
+    def _observe_latency_locked(self, latency):
+        """Update the latency EWMA; return True if this sample is a spike against the baseline"""
+        self._latency_samples += 1
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+            return False
+        spiked = self._latency_samples > 5 and latency > self.latency_spike_factor * self.latency_ewma
+        if not spiked:
+            self.latency_ewma = 0.9 * self.latency_ewma + 0.1 * latency
+        return spiked
+
+    def _decrease_locked(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+
+class RateLimiter:
+    """
+    Per-model limiter: optional requests/min and tokens/min buckets plus an AIMD concurrency limit.
+    Use acquire()/release() around each request (or acquire_async() in asyncio code).
+    """
+    def __init__(self, name, rpm=None, tpm=None, initial_concurrency=10, max_concurrency=64, min_concurrency=1):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.concurrency = AIMDLimiter(initial=initial_concurrency, min_limit=min_concurrency, max_limit=max_concurrency)
+        self.throttled_seconds = 0.0
+
+    def _reserve(self, tokens):
+        delay = 0.0
+        if self.requests is not None:
+            delay = max(delay, self.requests.reserve(1))
+        if self.tokens is not None and tokens:
+            delay = max(delay, self.tokens.reserve(tokens))
+        self.throttled_seconds += delay
+        return delay
+
+    def acquire(self, tokens=0):
+        """Block until a concurrency slot and rpm/tpm budget for tokens are available"""
+        self.concurrency.acquire()
+        delay = self._reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self, tokens=0):
+        await self.concurrency.acquire_async()
+        delay = self._reserve(tokens)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def release(self, latency=None, rate_limited=False, failed=False, reserved_tokens=0, used_tokens=None):
+        """Finish a request; used_tokens corrects the tpm reservation once the real cost is known"""
+        if self.tokens is not None and used_tokens is not None:
+            self.tokens.adjust(used_tokens - reserved_tokens)
+        self.concurrency.release(latency=latency, rate_limited=rate_limited, failed=failed)
+
+    def state(self):
+        concurrency = self.concurrency
+        return {
+            'concurrency_limit': round(concurrency.limit, 2),
+            'max_concurrency': concurrency.max_limit,
+            'concurrency_scale': concurrency.scale,
+            'in_flight': concurrency.in_flight,
+            'successes': concurrency.successes,
+            'failures': concurrency.failures,
+            'throttles': concurrency.throttles,
+            'latency_spikes': concurrency.latency_spikes,
+            'latency_ewma': concurrency.latency_ewma,
+            'rpm_limit': self.requests.rate_per_min if self.requests else None,
+            'rpm_available': self.requests.available() if self.requests else None,
+            'tpm_limit': self.tokens.rate_per_min if self.tokens else None,
+            'tpm_available': self.tokens.available() if self.tokens else None,
+            'throttled_seconds': round(self.throttled_seconds, 3),
+        }
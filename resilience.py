@@ -0,0 +1,349 @@
+"""
+Shared retry and failure handling for every LLM API call.
+
+Backoff: exponential with full jitter, so clients that failed together do not retry together.
+A server's Retry-After hint replaces the computed delay (plus a little jitter).
+
+RetryBudget: retries may add at most `ratio` extra load on top of the calls made in the last
+`window` seconds (plus a small floor for quiet periods). During an outage, where every call
+fails, retries stop instead of multiplying traffic.
+
+CircuitBreaker: one per provider endpoint. It opens once recent calls are mostly failing (or
+after a run of consecutive failures) and rejects calls immediately with CircuitOpenError. After
+reset_timeout a single probe call is let through (half-open); its outcome closes the breaker or
+opens it again. Only server-side failures (5xx, timeouts, connection errors) count; client errors
+and 429s mean the provider is up.
+
+The callers decide what is retryable and what counts as a failure, so this module knows nothing
+about the provider SDKs.
+"""
+
+import asyncio
+import collections
+import random
+import threading
+import time
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 30.0
+MAX_BREAKER_WAITS = 3
+PROBE_POLL_INTERVAL = 0.2
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit breaker is open"""
+    def __init__(self, provider, retry_in):
+        super().__init__(f"Circuit breaker for {provider} is open (next probe in {retry_in:.1f}s)")
+        self.provider = provider
+        self.retry_in = retry_in
+
+class Backoff:
+    """Exponential backoff with full jitter: attempt k waits uniform(0, min(max_delay, base_delay * 2**k))"""
+    def __init__(self, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retry number attempt (0-based); None if retry_after exceeds max_delay"""
+        if retry_after is not None:
+            if retry_after > self.max_delay:
+                return None
+            return retry_after + random.uniform(0, self.base_delay / 2)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+class RetryBudget:
+    """
+    Retries allowed within a sliding window: min_per_sec * window + ratio * calls in the window.
+    """
+    def __init__(self, ratio=0.2, min_per_sec=0.5, window=10.0):
+        self.ratio = ratio
+        self.min_per_sec = min_per_sec
+        self.window = window
+        self._calls = collections.deque()
+        self._retries = collections.deque()
+        self._lock = threading.Lock()
+        self.exhausted = 0
+
+    def _trim_locked(self, now):
+        cutoff = now - self.window
+        for events in (self._calls, self._retries):
+            while events and events[0] < cutoff:
+                events.popleft()
+
+    def record_call(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim_locked(now)
+            self._calls.append(now)
+
+    def try_spend(self):
+        """Take one retry from the budget; False if the budget is used up"""
+        with self._lock:
+            now = time.monotonic()
+            self._trim_locked(now)
+            if len(self._retries) + 1 > self.min_per_sec * self.window + self.ratio * len(self._calls):
+                self.exhausted += 1
+                return False
+            self._retries.append(now)
+            return True
+
+    def state(self):
+        with self._lock:
+            self._trim_locked(time.monotonic())
+            return {
+                'calls': len(self._calls),
+                'retries': len(self._retries),
+                'allowed': self.min_per_sec * self.window + self.ratio * len(self._calls),
+                'exhausted': self.exhausted,
+            }
+
+class CircuitBreaker:
+    """
+    Closed -> open when, over the last `window` calls (at least min_calls of them), the failure
+    rate reaches failure_rate, or after consecutive_failures failures in a row.
+    Open -> half-open after reset_timeout; one probe call decides between closed and open.
+    """
+    def __init__(self, name, failure_rate=0.5, min_calls=10, window=20, consecutive_failures=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.consecutive_failures = consecutive_failures
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self._outcomes = collections.deque(maxlen=window)
+        self._consecutive = 0
+        self._opened_at = None
+        self._probing = False
+        self.rejected = 0
+        self.times_opened = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go through now"""
+        with self._lock:
+            if self.state == 'open':
+                retry_in = self._opened_at + self.reset_timeout - time.monotonic()
+                if retry_in > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, retry_in)
+                self._transition_locked('half_open')
+            if self.state == 'half_open':
+                if self._probing:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, 0.0)
+                self._probing = True
+
+    def record(self, failed):
+        with self._lock:
+            if self.state == 'half_open':
+                self._probing = False
+                self._outcomes.clear()
+                self._consecutive = 0
+                self._transition_locked('open' if failed else 'closed')
+                return
+            self._outcomes.append(failed)
+            self._consecutive = self._consecutive + 1 if failed else 0
+            if self.state == 'closed' and self._should_open_locked():
+                self._transition_locked('open')
+
+    def release_probe(self):
+        """A probe call ended without a verdict (cancelled, or a non-server error): let the next call probe"""
+        with self._lock:
+            if self.state == 'half_open':
+                self._probing = False
+
+    def _should_open_locked(self):
+        if self._consecutive >= self.consecutive_failures:
+            return True
+        if len(self._outcomes) < self.min_calls:
+            return False
+        return sum(self._outcomes) / len(self._outcomes) >= self.failure_rate
+
+    def _transition_locked(self, state):
+        if state == 'open':
+            self._opened_at = time.monotonic()
+            self.times_opened += 1
+        if state != self.state:
+            print (f"Circuit breaker {self.name}: {self.state} -> {state}")
+        self.state = state
+
+    def snapshot(self):
+        with self._lock:
+            failures = sum(self._outcomes)
+            return {
+                'state': self.state,
+                'recent_calls': len(self._outcomes),
+                'recent_failures': failures,
+                'consecutive_failures': self._consecutive,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected,
+                'retry_in': max(0.0, self._opened_at + self.reset_timeout - time.monotonic()) if self.state == 'open' else 0.0,
+            }
+
+class Resilience:
+    """
+    Retries, retry budget and circuit breakers shared by all calls.
+    Args:
+        is_retryable(error): whether an error is transient.
+        is_failure(error): whether an error means the provider is failing (counts for the breaker).
+        retry_after(error): the server's suggested delay in seconds, or None.
+        time_left(): seconds until the caller's deadline, or None; no retry waits past it.
+        on_retry(): called each time call(), acall() or chunks() schedules a retry.
+    """
+    def __init__(self, is_retryable, is_failure, retry_after, max_retries=DEFAULT_MAX_RETRIES,
+                 base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY, budget_ratio=0.2,
+                 budget_min_per_sec=0.5, breaker_options=None, time_left=None, on_retry=None):
+        self.is_retryable = is_retryable
+        self.is_failure = is_failure
+        self.retry_after = retry_after
+        self.time_left = time_left
+        self.on_retry = on_retry
+        self.max_retries = max_retries
+        self.backoff = Backoff(base_delay, max_delay)
+        self.budget = RetryBudget(budget_ratio, budget_min_per_sec)
+        self.breaker_options = breaker_options or {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.gave_up = 0
+
+    def breaker(self, name):
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(name, **self.breaker_options)
+            return breaker
+
+    def retry_delay(self, error, attempt, max_retries=None):
+        """
+        Seconds to wait before retrying after error on attempt (0-based), or None if the call
+        should give up: the error is not transient, attempts are used up, the server asked for
+        a longer wait than max_delay, the wait would run past the deadline, or the global retry
+        budget is spent.
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        if isinstance(error, CircuitOpenError) or attempt >= max_retries or not self.is_retryable(error):
+            return None
+        delay = self.backoff.delay(attempt, self.retry_after(error))
+        time_left = self.time_left() if self.time_left is not None else None
+        if delay is None or (time_left is not None and delay >= time_left) or not self.budget.try_spend():
+            with self._lock:
+                self.gave_up += 1
+            return None
+        with self._lock:
+            self.retries += 1
+        return delay
+
+    def breaker_wait(self, error, waits):
+        """
+        For batch items rejected by an open breaker: seconds to hold the item before trying again,
+        so a queue waits for the breaker's next probe instead of failing all at once. None means
+        give up: error is not a CircuitOpenError, the item already waited out MAX_BREAKER_WAITS
+        openings (waits), or the probe would come after the deadline. While a probe is in flight
+        the item checks back every PROBE_POLL_INTERVAL.
+        """
+        if not isinstance(error, CircuitOpenError) or waits >= MAX_BREAKER_WAITS:
+            return None
+        delay = (error.retry_in or PROBE_POLL_INTERVAL) + random.uniform(0, PROBE_POLL_INTERVAL)
+        time_left = self.time_left() if self.time_left is not None else None
+        if time_left is not None and delay >= time_left:
+            return None
+        return delay
+
+    def _retrying(self):
+        if self.on_retry is not None:
+            self.on_retry()
+
+    def _attempt_started(self, breaker):
+        breaker.before_call()
+        self.budget.record_call()
+
+    def _attempt_failed(self, breaker, error):
+        if isinstance(error, Exception) and self.is_failure(error):
+            breaker.record(True)
+        else:
+            breaker.release_probe()
+
+    def call(self, name, fn, max_retries=None):
+        """Call fn() through the breaker for provider name, retrying transient errors"""
+        breaker = self.breaker(name)
+        attempt = 0
+        while True:
+            self._attempt_started(breaker)
+            try:
+                result = fn()
+            except BaseException as e:
+                self._attempt_failed(breaker, e)
+                delay = self.retry_delay(e, attempt, max_retries) if isinstance(e, Exception) else None
+                if delay is None:
+                    raise
+                self._retrying()
+                time.sleep(delay)
+                attempt += 1
+                continue
+            breaker.record(False)
+            return result
+
+    async def acall(self, name, coro_fn, max_retries=None):
+        """Async version of call()"""
+        breaker = self.breaker(name)
+        attempt = 0
+        while True:
+            self._attempt_started(breaker)
+            try:
+                result = await coro_fn()
+            except BaseException as e:
+                self._attempt_failed(breaker, e)
+                delay = self.retry_delay(e, attempt, max_retries) if isinstance(e, Exception) else None
+                if delay is None:
+                    raise
+                self._retrying()
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            breaker.record(False)
+            return result
+
+    def chunks(self, name, make_chunks, max_retries=None):
+        """
+        Iterate make_chunks() through the breaker. Errors before the first chunk are retried like
+        call(); once output has started, an error is raised as is.
+        """
+        breaker = self.breaker(name)
+        attempt = 0
+        while True:
+            self._attempt_started(breaker)
+            started = False
+            try:
+                for chunk in make_chunks():
+                    started = True
+                    yield chunk
+            except BaseException as e:
+                self._attempt_failed(breaker, e)
+                delay = self.retry_delay(e, attempt, max_retries) if isinstance(e, Exception) and not started else None
+                if delay is None:
+                    raise
+                self._retrying()
+                time.sleep(delay)
+                attempt += 1
+                continue
+            breaker.record(False)
+            return
+
+    def state(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+            retries, gave_up = self.retries, self.gave_up
+        return {
+            'breakers': {name: breaker.snapshot() for name, breaker in breakers.items()},
+            'retry_budget': self.budget.state(),
+            'retries': retries,
+            'gave_up': gave_up,
+        }
+
+    def reset_locks(self):
+        """Fresh locks after a fork (another thread may have held them)"""
+        self._lock = threading.Lock()
+        self.budget._lock = threading.Lock()
+        for breaker in self._breakers.values():
+            breaker._lock = threading.Lock()
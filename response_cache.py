@@ -0,0 +1,114 @@
+"""
+Persistent, content-addressed cache for LLM responses.
+
+Entries live in a single SQLite file keyed by a hash of the request (see api._request_key),
+so identical requests from re-runs, restarts and repeated safety reviews are served locally.
+The file can be shared by several processes (WAL mode), which is what happens when
+evolve.py launches run_main.py subprocesses.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = '.llm_cache.sqlite'
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024  # 256 MB of response text
+
+class ResponseCache:
+    """
+    SQLite-backed response cache with TTLs and LRU eviction.
+    Args:
+        path: the SQLite file to use (created if missing).
+        max_entries: evict least recently used entries beyond this many.
+        max_bytes: evict least recently used entries once stored responses exceed this size.
+        ttl: default time-to-live in seconds for new entries; None means entries never expire.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL,
+                expires_at REAL
+            )
+        """)
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+
+    def get(self, key):
+        """Return the cached response for key, or None on a miss or an expired entry"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT value, expires_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                if row is not None:
+                    self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        """Store a response (a string or a list of strings); ttl overrides the cache default"""
+        ttl = self.ttl if ttl is None else ttl
+        data = json.dumps(value)
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, value, size, created, last_access, expires_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, data, len(data), now, now, expires_at)
+            )
+            self._evict_locked(now)
+
+    def _evict_locked(self, now):
+        self._conn.execute('DELETE FROM responses WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,))
+        count, total = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        # Walk from least recently used, dropping entries until both limits hold
+        doomed = []
+        for key, size in self._conn.execute('SELECT key, size FROM responses ORDER BY last_access ASC'):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            count -= 1
+            total -= size
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', doomed)
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM responses')
+
+    def stats(self):
+        with self._lock:
+            count, total = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return {
+            'path': self.path,
+            'entries': count,
+            'bytes': total,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
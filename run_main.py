@@ -6,26 +6,45 @@ This script:
 1. Imports and calls main.py's main() function
 2. Receives the evolution code as a return value
 3. Writes it to a file for evolve.py to read
+
+The proposal is renamed into place once complete, so evolve.py can start reviewing it while this
+process is still exiting.
+
+evolve.py passes the generation's deadline in EVOLVE_DEADLINE, which api.py's calls honor on
+their own. If the generation overruns anyway, evolve.py sends SIGTERM before it kills, and that
+is raised in main() as DeadlineExceeded so it can unwind.
 """
 
 import sys
 import os
+import signal
+from deadline import DeadlineExceeded, time_left
 
 # Import main from main.py
 from main import main
 
 EVOLUTION_FILE = ".evolution_proposal.py"
 
+def _on_terminate(signum, frame):
+    raise DeadlineExceeded('Generation stopped by evolve.py after its deadline')
+
 def run():
     """Run main.py and handle evolution proposal"""
+    signal.signal(signal.SIGTERM, _on_terminate)
+    remaining = time_left()
+    if remaining is not None:
+        print(f"[Generation deadline in {remaining:.0f}s]")
     try:
         # Call main() - it should return the evolution code or None
         new_code = main()
         
-        # If evolution code was returned, write it to file
+        # If evolution code was returned, write it to file. evolve.py starts on it as soon as it
+        # appears, so it is written under another name and renamed into place in one step
         if new_code:
-            with open(EVOLUTION_FILE, 'w') as f:
+            tmp_file = f"{EVOLUTION_FILE}.tmp"
+            with open(tmp_file, 'w') as f:
                 f.write(new_code)
+            os.replace(tmp_file, EVOLUTION_FILE)
             print(f"\n[Evolution proposal saved to {EVOLUTION_FILE}]")
         
         return 0
@@ -49,7 +49,8 @@ Provide your safety assessment following the format specified."""
             messages,
             model_name=model_name,
             max_tokens=8192,
-            temperature=0.5  # Low temperature for consistent safety judgments
+            temperature=0.5,  # Low temperature for consistent safety judgments
+            cache_prompt=True  # The reviewer instructions are identical for every proposal
         )
         
         # Extract the safety verdict from the formatted response
@@ -0,0 +1,110 @@
+"""
+Single-flight coalescing of identical concurrent requests.
+
+When several callers ask for the same key while a call for it is still running, only the first
+(the leader) does the work. The others wait for its result. Each flight is a
+concurrent.futures.Future, so threads can block on it and asyncio tasks on any event loop can
+await it, and a thread can wait on a flight that an async task leads (or the other way around).
+Flights exist only while the call runs; finished results are not kept (that is
+response_cache's job).
+"""
+
+import asyncio
+import concurrent.futures
+import copy
+import threading
+
+# Leader was cancelled or interrupted: its waiters start a new flight instead of inheriting that
+_RETRY = object()
+
+class SingleFlight:
+    """
+    Registry of in-flight calls keyed by request hash.
+    leaders counts calls that actually ran; coalesced counts callers served by someone else's call.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _join(self, key):
+        """Return (future, is_leader) for key, starting a new flight if none is running"""
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = concurrent.futures.Future()
+            self._flights[key] = future
+            self.leaders += 1
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._flights.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _lead_failed(self, key, future, error):
+        # Share real errors with the waiters; a cancelled/interrupted leader makes them retry
+        if isinstance(error, Exception):
+            self._finish(key, future, error=error)
+        else:
+            self._finish(key, future, result=_RETRY)
+
+    @staticmethod
+    def _share(result):
+        # Waiters get their own list so one caller mutating its result can't affect the others
+        return copy.copy(result) if isinstance(result, list) else result
+
+    def do(self, key, fn):
+        """Return fn(), or the result of an identical call already in flight"""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                try:
+                    result = fn()
+                except BaseException as e:
+                    self._lead_failed(key, future, e)
+                    raise
+                self._finish(key, future, result)
+                return result
+            result = future.result()
+            if result is not _RETRY:
+                return self._share(result)
+
+    async def do_async(self, key, coro_fn):
+        """Async version of do(): coro_fn is called (and awaited) only by the leader"""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                try:
+                    result = await coro_fn()
+                except BaseException as e:
+                    self._lead_failed(key, future, e)
+                    raise
+                self._finish(key, future, result)
+                return result
+            # shield: a waiter being cancelled must not cancel the shared flight
+            result = await asyncio.shield(asyncio.wrap_future(future))
+            if result is not _RETRY:
+                return self._share(result)
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._flights)
+        return {
+            'upstream_calls': self.leaders,
+            'coalesced': self.coalesced,
+            'in_flight': in_flight,
+        }
+
+    def reset(self):
+        """Forget all flights and counters (used in forked children)"""
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the LLM providers, for offline runs, CI and load tests.
+
+Speaks the OpenAI (also Together / Hyperbolic), Anthropic and Gemini wire formats, with and
+without streaming, so the real SDKs and every layer of api.py are exercised. Latency, time to
+first token, generation speed, slow tail calls, server errors and 429s are all configurable.
+
+Replies are synthetic: if the prompt contains a ```python block, the reply echoes the first one
+(so main.py "evolves" into itself and the whole evolve loop can run offline), otherwise it is
+filler text of --output-tokens tokens.
+
+Usage:
+    python standin_server.py --port 8080 --profile realistic
+    LLM_STANDIN_URL=http://127.0.0.1:8080 python evolve.py      # every provider goes to the stand-in
+
+    # Measure api.py overhead and concurrency scaling against an in-process stand-in
+    python standin_server.py --bench --model gpt-4o-mini --requests 200 --concurrency 1,8,32,128
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+CHARS_PER_TOKEN = 4
+CHUNK_TOKENS = 4  # tokens per streamed chunk
+
+# Timing and failure presets; command line flags override individual fields
+PROFILES = {
+    'instant': {},
+    'realistic': {'latency': 0.05, 'ttft': 0.4, 'tokens_per_sec': 80, 'jitter': 0.3, 'tail_rate': 0.01, 'tail_latency': 20.0},
+    'flaky': {'latency': 0.05, 'ttft': 0.4, 'tokens_per_sec': 80, 'jitter': 0.3, 'tail_rate': 0.02, 'tail_latency': 30.0,
+              'error_rate': 0.05, 'rate_limit_rate': 0.1},
+}
+
+DEFAULT_PROFILE = {
+    'latency': 0.0,          # seconds added to every request (network / queueing)
+    'ttft': 0.0,             # seconds before the first token
+    'tokens_per_sec': 0.0,   # generation speed; 0 = instant
+    'jitter': 0.0,           # +/- fraction applied to latency and ttft
+    'tail_rate': 0.0,        # fraction of requests that are slow...
+    'tail_latency': 0.0,     # ...by this many extra seconds
+    'error_rate': 0.0,       # fraction answered with a 500
+    'rate_limit_rate': 0.0,  # fraction answered with a 429
+    'retry_after': 1.0,      # Retry-After header on 429s
+    'output_tokens': 64,     # length of filler replies
+}
+
+def make_profile(name='instant', **overrides):
+    profile = dict(DEFAULT_PROFILE)
+    profile.update(PROFILES[name])
+    profile.update({key: value for key, value in overrides.items() if value is not None})
+    return profile
+
+def _text_of(content):
+    """Text of an OpenAI / Anthropic message content or a Gemini parts list"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return ''.join(_text_of(part) for part in content)
+    if isinstance(content, dict):
+        return content.get('text') or _text_of(content.get('content') or content.get('parts') or '')
+    return ''
+
+def reply_text(prompt_texts, output_tokens):
+    """The synthetic reply: an echo of the last prompt's first ```python block, else filler"""
+    for text in reversed(prompt_texts):
+        start = text.find('```python\n')
+        if start >= 0:
+            # The block ends at the last fence: prompts like main.py hold fences inside the code
+            end = text.rfind('\n```')
+            if end > start:
+                code = text[start + len('```python\n'):end]
+                return f"Here is the evolved code:\n\n```python\n{code}\n```\n"
+    words = ['stand-in'] + ['lorem', 'ipsum', 'dolor', 'sit', 'amet'] * (output_tokens // 5 + 1)
+    return ' '.join(words[:max(1, output_tokens)])
+
+def _tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, profile, seed=None):
+        super().__init__(address, StandinHandler)
+        self.profile = profile
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'streams': 0, 'errors': 0, 'rate_limited': 0, 'slow': 0,
+                      'in_flight': 0, 'max_in_flight': 0, 'server_time': 0.0, 'by_api': {}}
+
+    def handle_error(self, request, client_address):
+        # Clients that time out or stop reading mid-response (deadlines, early stops) are expected
+        import sys
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def draw(self):
+        """Decide this request's fate: (status, extra_delay, jitter), jitter scaling its normal latency"""
+        profile = self.profile
+        with self.lock:
+            roll = self.random.random()
+            slow = self.random.random() < profile['tail_rate']
+            jitter = 1 + self.random.uniform(-profile['jitter'], profile['jitter'])
+        if roll < profile['rate_limit_rate']:
+            return 429, 0.0, jitter
+        if roll < profile['rate_limit_rate'] + profile['error_rate']:
+            return 500, 0.0, jitter
+        return 200, (profile['tail_latency'] if slow else 0.0), jitter
+
+    def count(self, api, stream, status, slow):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['streams'] += 1 if stream else 0
+            self.stats['errors'] += 1 if status == 500 else 0
+            self.stats['rate_limited'] += 1 if status == 429 else 0
+            self.stats['slow'] += 1 if slow else 0
+            self.stats['by_api'][api] = self.stats['by_api'].get(api, 0) + 1
+
+    def enter(self, delta, elapsed=0.0):
+        with self.lock:
+            self.stats['server_time'] += elapsed
+            self.stats['in_flight'] += delta
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body are separate writes; don't let delayed ACKs add 40ms
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_sse(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+    def _sse(self, data, event=None):
+        prefix = f"event: {event}\n" if event else ''
+        self.wfile.write(f"{prefix}data: {json.dumps(data)}\n\n".encode('utf-8'))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.startswith('/stats'):
+            with self.server.lock:
+                return self._send_json(200, dict(self.server.stats, profile=self.server.profile))
+        return self._send_json(200, {'status': 'ok'})
+
+    def do_DELETE(self):
+        self._send_json(200, {})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        path = self.path.split('?')[0]
+        if path.endswith('/cachedContents'):
+            # Gemini explicit prompt cache: accept and hand back a name
+            return self._send_json(200, {'name': f"cachedContents/standin-{int(time.time() * 1000)}", 'model': body.get('model')})
+        if path.endswith('/chat/completions'):
+            api = 'openai'
+        elif path.endswith('/messages'):
+            api = 'anthropic'
+        elif ':generateContent' in path or ':streamGenerateContent' in path:
+            api = 'gemini'
+        else:
+            return self._send_json(404, {'error': {'message': f"Unknown path {path}"}})
+        stream = bool(body.get('stream')) or ':streamGenerateContent' in path
+
+        profile = self.server.profile
+        status, extra_delay, jitter = self.server.draw()
+        self.server.count(api, stream, status, extra_delay > 0)
+        self.server.enter(1)
+        start = time.monotonic()
+        try:
+            time.sleep(profile['latency'] * jitter + extra_delay)
+            if status != 200:
+                return self._send_error(api, status)
+            prompt_texts, n = self._prompt(api, body, path)
+            text = reply_text(prompt_texts, profile['output_tokens'])
+            usage = (sum(_tokens(t) for t in prompt_texts), _tokens(text))
+            if stream:
+                return self._stream(api, body, path, text, usage, profile['ttft'] * jitter)
+            time.sleep(profile['ttft'] * jitter + self._generation_time(text))
+            return self._send_json(200, self._response(api, body, path, text, n, usage))
+        finally:
+            self.server.enter(-1, time.monotonic() - start)
+
+    def _generation_time(self, text):
+        tokens_per_sec = self.server.profile['tokens_per_sec']
+        return _tokens(text) / tokens_per_sec if tokens_per_sec else 0.0
+
+    def _send_error(self, api, status):
+        message = 'Rate limit exceeded (stand-in)' if status == 429 else 'Internal server error (stand-in)'
+        headers = {'Retry-After': str(self.server.profile['retry_after'])} if status == 429 else {}
+        if api == 'anthropic':
+            kind = 'rate_limit_error' if status == 429 else 'api_error'
+            payload = {'type': 'error', 'error': {'type': kind, 'message': message}}
+        elif api == 'gemini':
+            payload = {'error': {'code': status, 'message': message, 'status': 'RESOURCE_EXHAUSTED' if status == 429 else 'INTERNAL'}}
+        else:
+            payload = {'error': {'message': message, 'type': 'rate_limit_exceeded' if status == 429 else 'server_error', 'code': status}}
+        self._send_json(status, payload, headers)
+
+    def _prompt(self, api, body, path):
+        """(list of prompt texts, number of completions requested)"""
+        if api == 'gemini':
+            texts = [_text_of(content.get('parts') or []) for content in body.get('contents') or []]
+            system = body.get('systemInstruction') or body.get('system_instruction')
+            if system:
+                texts.insert(0, _text_of(system.get('parts') or []))
+            config = body.get('generationConfig') or {}
+            return texts, config.get('candidateCount') or 1
+        texts = [_text_of(message.get('content')) for message in body.get('messages') or []]
+        if api == 'anthropic' and body.get('system'):
+            texts.insert(0, _text_of(body['system']))
+        return texts, body.get('n') or 1
+
+    def _response(self, api, body, path, text, n, usage):
+        prompt_tokens, output_tokens = usage
+        model = body.get('model') or path.split('/models/')[-1].split(':')[0]
+        if api == 'anthropic':
+            return {
+                'id': 'msg_standin', 'type': 'message', 'role': 'assistant', 'model': model,
+                'content': [{'type': 'text', 'text': text}], 'stop_reason': 'end_turn', 'stop_sequence': None,
+                'usage': {'input_tokens': prompt_tokens, 'output_tokens': output_tokens},
+            }
+        if api == 'gemini':
+            return {
+                'candidates': [
+                    {'content': {'role': 'model', 'parts': [{'text': text}]}, 'finishReason': 'STOP', 'index': i}
+                    for i in range(n)
+                ],
+                'usageMetadata': {'promptTokenCount': prompt_tokens, 'candidatesTokenCount': output_tokens * n,
+                                  'totalTokenCount': prompt_tokens + output_tokens * n},
+                'modelVersion': model,
+            }
+        return {
+            'id': 'chatcmpl-standin', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+            'choices': [
+                {'index': i, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}
+                for i in range(n)
+            ],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': output_tokens * n,
+                      'total_tokens': prompt_tokens + output_tokens * n},
+        }
+
+    def _stream(self, api, body, path, text, usage, ttft):
+        prompt_tokens, output_tokens = usage
+        model = body.get('model') or path.split('/models/')[-1].split(':')[0]
+        size = CHARS_PER_TOKEN * CHUNK_TOKENS
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        tokens_per_sec = self.server.profile['tokens_per_sec']
+        gap = CHUNK_TOKENS / tokens_per_sec if tokens_per_sec else 0.0
+        self._start_sse()
+        time.sleep(ttft)
+        try:
+            if api == 'anthropic':
+                self._sse({'type': 'message_start', 'message': {
+                    'id': 'msg_standin', 'type': 'message', 'role': 'assistant', 'model': model, 'content': [],
+                    'stop_reason': None, 'stop_sequence': None, 'usage': {'input_tokens': prompt_tokens, 'output_tokens': 0}}},
+                    'message_start')
+                self._sse({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}}, 'content_block_start')
+            for i, piece in enumerate(pieces):
+                if i and gap:
+                    time.sleep(gap)
+                if api == 'anthropic':
+                    self._sse({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': piece}}, 'content_block_delta')
+                elif api == 'gemini':
+                    last = i == len(pieces) - 1
+                    chunk = {'candidates': [{'content': {'role': 'model', 'parts': [{'text': piece}]}, 'index': 0}], 'modelVersion': model}
+                    if last:
+                        chunk['candidates'][0]['finishReason'] = 'STOP'
+                        chunk['usageMetadata'] = {'promptTokenCount': prompt_tokens, 'candidatesTokenCount': output_tokens,
+                                                  'totalTokenCount': prompt_tokens + output_tokens}
+                    self._sse(chunk)
+                else:
+                    self._sse({'id': 'chatcmpl-standin', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                               'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]})
+            if api == 'anthropic':
+                self._sse({'type': 'content_block_stop', 'index': 0}, 'content_block_stop')
+                self._sse({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                           'usage': {'output_tokens': output_tokens}}, 'message_delta')
+                self._sse({'type': 'message_stop'}, 'message_stop')
+            elif api == 'openai':
+                self._sse({'id': 'chatcmpl-standin', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                           'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+                if (body.get('stream_options') or {}).get('include_usage'):
+                    self._sse({'id': 'chatcmpl-standin', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                               'choices': [], 'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': output_tokens,
+                                                        'total_tokens': prompt_tokens + output_tokens}})
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client stopped reading (e.g. extract_code_stream closing the stream early)
+
+def start_server(port=0, host='127.0.0.1', profile=None, seed=None):
+    """Start a stand-in on a background thread and return it (server.url, server.stats, server.shutdown())"""
+    server = StandinServer((host, port), profile or make_profile(), seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run_benchmark(model_name, requests, concurrency_levels, profile, max_tokens=256):
+    """
+    Run batches of distinct prompts through api.batch_chat_complete against an in-process
+    stand-in and print throughput, client-side latency and the api layer's own overhead per
+    call (client latency minus the time the server spent on the request).
+    """
+    import api
+    server = start_server(profile=profile, seed=0)
+    api.use_standin_server(server.url)
+    api.disable_cache()
+    latencies = []
+    api.get_metrics_registry().add_hook(lambda metrics: latencies.append(metrics.latency))
+    print (f"Stand-in at {server.url}, profile: {profile}")
+    rows = []
+    for concurrency in concurrency_levels:
+        latencies.clear()
+        with server.lock:
+            server.stats['server_time'] = 0.0
+        # Pin the shared limiter to this level (its AIMD limit would otherwise carry over and ramp)
+        api.set_rate_limit(model_name, max_concurrency=concurrency)
+        messages = [[{'role': 'user', 'content': f"bench {concurrency}-{i}"}] for i in range(requests)]
+        api.batch_chat_complete(messages, model_name=model_name, max_tokens=max_tokens, concurrent_calls=concurrency, coalesce=False)
+        summary = api.get_last_batch_metrics()
+        ordered = sorted(latency for latency in latencies if latency is not None) or [0.0]
+        mean = sum(ordered) / len(ordered)
+        overhead = max(0.0, mean - server.stats['server_time'] / max(1, len(ordered)))
+        rows.append((concurrency, summary['wall_time'], summary['requests_per_sec'] or 0.0, ordered[len(ordered) // 2],
+                     ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], overhead, summary['failed']))
+    print (f"{'concurrency':>11} {'wall s':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'overhead ms':>11} {'failed':>6}")
+    for concurrency, wall, rate, p50, p95, overhead, failed in rows:
+        print (f"{concurrency:>11} {wall:>8.2f} {rate:>8.1f} {p50 * 1000:>8.1f} {p95 * 1000:>8.1f} {overhead * 1000:>11.1f} {failed:>6}")
+    server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the OpenAI, Anthropic and Gemini APIs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='instant', help='timing / failure preset')
+    for name in DEFAULT_PROFILE:
+        parser.add_argument('--' + name.replace('_', '-'), type=type(DEFAULT_PROFILE[name]), default=None)
+    parser.add_argument('--seed', type=int, default=None, help='seed for the error / 429 / tail draws')
+    parser.add_argument('--bench', action='store_true', help='benchmark api.py against an in-process stand-in and exit')
+    parser.add_argument('--model', default='gpt-4o-mini', help='model name used by --bench')
+    parser.add_argument('--requests', type=int, default=200, help='requests per concurrency level (--bench)')
+    parser.add_argument('--concurrency', default='1,8,32,128', help='comma-separated concurrency levels (--bench)')
+    args = parser.parse_args()
+
+    profile = make_profile(args.profile, **{name: getattr(args, name) for name in DEFAULT_PROFILE})
+    if args.bench:
+        run_benchmark(args.model, args.requests, [int(c) for c in args.concurrency.split(',')], profile)
+        return
+    server = StandinServer((args.host, args.port), profile, args.seed)
+    print (f"Stand-in LLM server on {server.url} (profile: {args.profile})")
+    print (f"Use it with: LLM_STANDIN_URL={server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
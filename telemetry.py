@@ -0,0 +1,403 @@
+"""
+Per-call telemetry for LLM requests.
+
+Every chat_complete / achat_complete call produces a CallMetrics record (queue wait, connect
+time, TTFT, latency, token counts, retries, provider and model). Records are aggregated into
+histograms in a MetricsRegistry, which can be exported as a Prometheus text file (for
+node_exporter's textfile collector) or as a JSON snapshot. Batch calls add a BatchMetrics
+summary with throughput figures.
+
+Connect time is measured through httpcore's "trace" request extension, attached by
+trace_request_hook / atrace_request_hook (httpx event hooks on the SDK clients). Providers not
+called through httpx report connect as None.
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+
+# The CallMetrics of the request being sent in this thread / async task (read by the trace hooks)
+current_call = contextvars.ContextVar('current_call', default=None)
+# Extra fields for the next call (queue wait and retry count), set by the batch engines
+_call_context = contextvars.ContextVar('call_context', default=None)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144)
+
+class CallMetrics:
+    """
+    Metrics of one request. Times are in seconds; fields the provider does not report are None.
+        queue_wait: time spent waiting for a rate-limit slot before the call (batch engines)
+        connect: time to open a new connection (TCP + TLS); 0.0 when a pooled connection was reused
+        ttft: time to first token (streams only)
+        latency: time from sending the request to the full response
+        retries: attempts before the one that answered: the call's own retries of transient
+            errors (see api.configure_resilience), plus, in the batch engines, which retry each
+            message as a new call, the message's earlier attempts. Registry and batch totals count
+            the attempts that were retries (retried_attempts)
+        outcome: 'ok', 'error', 'cache_hit' (served by the response cache) or 'coalesced'
+    """
+    FIELDS = ('provider', 'model', 'outcome', 'error', 'started_at', 'queue_wait', 'connect', 'ttft', 'latency',
+              'input_tokens', 'cached_input_tokens', 'uncached_input_tokens', 'output_tokens', 'finish_reason',
+              'retries', 'stream')
+
+    def __init__(self, provider, model, stream=False):
+        self.provider = provider
+        self.model = model
+        self.outcome = 'ok'
+        self.error = None
+        self.started_at = time.time()
+        self.queue_wait = 0.0
+        self.connect = None
+        self.ttft = None
+        self.latency = None
+        self.input_tokens = None
+        self.cached_input_tokens = None
+        self.uncached_input_tokens = None
+        self.output_tokens = None
+        self.finish_reason = None
+        self.retries = 0
+        self.stream = stream
+        self._connect_start = None
+        self._own_retries = 0
+        context = _call_context.get()
+        if context:
+            self.queue_wait = context.get('queue_wait', 0.0)
+            self.retries = context.get('retries', 0)
+
+    def add_retry(self):
+        """Count a retry the call made itself, after a transient error"""
+        self.retries += 1
+        self._own_retries += 1
+
+    @property
+    def retried_attempts(self):
+        """Attempts recorded under this call that were retries: its own, plus itself if a batch engine retried it"""
+        return self._own_retries + (1 if self.retries > self._own_retries else 0)
+
+    def set_usage(self, usage):
+        """Copy token counts and finish reason from an api usage dict"""
+        if not usage:
+            return
+        for field in ('input_tokens', 'cached_input_tokens', 'uncached_input_tokens', 'output_tokens', 'finish_reason'):
+            if usage.get(field) is not None:
+                setattr(self, field, usage[field])
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self):
+        return f"CallMetrics({self.as_dict()})"
+
+class call_context:
+    """Context manager giving the next calls in this thread/task a queue wait and retry count"""
+    def __init__(self, queue_wait=0.0, retries=0):
+        self.values = {'queue_wait': queue_wait, 'retries': retries}
+        self._token = None
+
+    def __enter__(self):
+        self._token = _call_context.set(self.values)
+        return self
+
+    def __exit__(self, *exc):
+        _call_context.reset(self._token)
+
+def _trace(event_name, info):
+    metrics = current_call.get()
+    if metrics is None:
+        return
+    if event_name == 'connection.connect_tcp.started':
+        metrics._connect_start = time.perf_counter()
+    elif event_name in ('connection.connect_tcp.complete', 'connection.start_tls.complete') and metrics._connect_start is not None:
+        metrics.connect = time.perf_counter() - metrics._connect_start
+
+async def _atrace(event_name, info):
+    _trace(event_name, info)
+
+def trace_request_hook(request):
+    """httpx request hook: time new connections for the current call (sync clients)"""
+    metrics = current_call.get()
+    if metrics is not None:
+        if metrics.connect is None:
+            metrics.connect = 0.0
+        request.extensions['trace'] = _trace
+
+async def atrace_request_hook(request):
+    """httpx request hook for async clients"""
+    metrics = current_call.get()
+    if metrics is not None:
+        if metrics.connect is None:
+            metrics.connect = 0.0
+        request.extensions['trace'] = _atrace
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense (le = upper bound)"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def quantile(self, q):
+        """Approximate quantile: the upper bound of the bucket holding it (None when empty)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, bound in enumerate(self.buckets):
+            seen += self.counts[i]
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def cumulative(self):
+        total = 0
+        out = []
+        for bound, count in zip(list(self.buckets) + [float('inf')], self.counts):
+            total += count
+            out.append((bound, total))
+        return out
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'buckets': {('+Inf' if bound == float('inf') else bound): total for bound, total in self.cumulative()},
+        }
+
+class BatchMetrics:
+    """
+    Summary of one batch call.
+        wall_time: seconds from start to the last result
+        requests_per_sec / output_tokens_per_sec: completed requests and generated tokens over wall_time
+        skipped: messages never sent because the deadline passed first (not counted as failed)
+    """
+    def __init__(self, model, messages):
+        self.model = model
+        self.messages = messages
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retries = 0
+        self.queue_wait = 0.0
+        self.input_tokens = 0
+        self.cached_input_tokens = 0
+        self.output_tokens = 0
+        self.wall_time = None
+        self._latency = Histogram(LATENCY_BUCKETS)
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def add(self, metrics):
+        """Fold in one CallMetrics (use as the on_metrics callback of each call)"""
+        with self._lock:
+            self.retries += metrics.retried_attempts
+            self.queue_wait += metrics.queue_wait or 0.0
+            if metrics.outcome == 'error':
+                return
+            self.input_tokens += metrics.input_tokens or 0
+            self.cached_input_tokens += metrics.cached_input_tokens or 0
+            self.output_tokens += metrics.output_tokens or 0
+            if metrics.latency is not None:
+                self._latency.observe(metrics.latency)
+
+    def result(self, ok, skipped=False):
+        """Count one finished message (after its retries)"""
+        with self._lock:
+            if skipped:
+                self.skipped += 1
+            elif ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def finish(self):
+        self.wall_time = time.perf_counter() - self._start
+        return self
+
+    def summary_line(self):
+        figures = self.as_dict()
+        return (f"Batch: {self.completed}/{self.messages} ok, {self.failed} failed in {figures['wall_time']:.1f}s "
+                f"({figures['requests_per_sec'] or 0:.2f} req/s, {figures['output_tokens_per_sec'] or 0:.0f} output tokens/s, "
+                f"{self.retries} retries)" + (f", {self.skipped} skipped at the deadline" if self.skipped else ''))
+
+    def as_dict(self):
+        wall = self.wall_time or (time.perf_counter() - self._start)
+        return {
+            'model': self.model,
+            'messages': self.messages,
+            'completed': self.completed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'retries': self.retries,
+            'wall_time': wall,
+            'requests_per_sec': self.completed / wall if wall > 0 else None,
+            'output_tokens_per_sec': self.output_tokens / wall if wall > 0 else None,
+            'input_tokens': self.input_tokens,
+            'cached_input_tokens': self.cached_input_tokens,
+            'output_tokens': self.output_tokens,
+            'queue_wait_total': self.queue_wait,
+            'latency_p50': self._latency.quantile(0.5),
+            'latency_p95': self._latency.quantile(0.95),
+        }
+
+class MetricsRegistry:
+    """
+    Aggregates CallMetrics per (provider, model) and BatchMetrics per model.
+    Hooks added with add_hook() are called with every CallMetrics as it is recorded.
+    """
+    HISTOGRAMS = {
+        'latency_seconds': ('latency', LATENCY_BUCKETS),
+        'ttft_seconds': ('ttft', LATENCY_BUCKETS),
+        'queue_wait_seconds': ('queue_wait', LATENCY_BUCKETS),
+        'connect_seconds': ('connect', LATENCY_BUCKETS),
+        'input_tokens': ('input_tokens', TOKEN_BUCKETS),
+        'cached_input_tokens': ('cached_input_tokens', TOKEN_BUCKETS),
+        'output_tokens': ('output_tokens', TOKEN_BUCKETS),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hooks = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}   # (name, provider, model) -> Histogram
+            self._calls = {}        # (provider, model, outcome) -> count
+            self._retries = {}      # (provider, model) -> count
+            self._tokens = {}       # (provider, model, kind) -> count
+            self._batches = {}      # model -> totals and the last batch's figures
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def record(self, metrics):
+        labels = (metrics.provider, metrics.model)
+        with self._lock:
+            key = labels + (metrics.outcome,)
+            self._calls[key] = self._calls.get(key, 0) + 1
+            self._retries[labels] = self._retries.get(labels, 0) + metrics.retried_attempts
+            # Cache hits and coalesced calls never reached the provider; keep them out of the histograms
+            if metrics.outcome in ('ok', 'error'):
+                for name, (field, buckets) in self.HISTOGRAMS.items():
+                    value = getattr(metrics, field)
+                    if value is None:
+                        continue
+                    histogram = self._histograms.get((name,) + labels)
+                    if histogram is None:
+                        histogram = self._histograms[(name,) + labels] = Histogram(buckets)
+                    histogram.observe(value)
+                for kind in ('input_tokens', 'cached_input_tokens', 'output_tokens'):
+                    value = getattr(metrics, kind)
+                    if value:
+                        self._tokens[labels + (kind,)] = self._tokens.get(labels + (kind,), 0) + value
+        for hook in list(self._hooks):
+            try:
+                hook(metrics)
+            except Exception as e:
+                print (f"Metrics hook failed: {e}")
+
+    def record_batch(self, batch):
+        summary = batch.as_dict()
+        with self._lock:
+            totals = self._batches.setdefault(batch.model, {'batches': 0, 'messages': 0, 'failed': 0, 'wall_time': 0.0, 'last': None})
+            totals['batches'] += 1
+            totals['messages'] += batch.messages
+            totals['failed'] += batch.failed
+            totals['wall_time'] += summary['wall_time']
+            totals['last'] = summary
+
+    def snapshot(self):
+        """JSON-serializable view of everything recorded so far"""
+        with self._lock:
+            models = {}
+            for (provider, model, outcome), count in self._calls.items():
+                entry = models.setdefault(f"{provider}/{model}", {'calls': {}, 'retries': 0, 'tokens': {}, 'histograms': {}})
+                entry['calls'][outcome] = count
+            for (provider, model), count in self._retries.items():
+                models[f"{provider}/{model}"]['retries'] = count
+            for (provider, model, kind), count in self._tokens.items():
+                models[f"{provider}/{model}"]['tokens'][kind] = count
+            for (name, provider, model), histogram in self._histograms.items():
+                models[f"{provider}/{model}"]['histograms'][name] = histogram.as_dict()
+            batches = {model: dict(totals) for model, totals in self._batches.items()}
+        return {'generated_at': time.time(), 'models': models, 'batches': batches}
+
+    def to_prometheus(self, prefix='llm'):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def labels(**values):
+            return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in values.items()) + '}'
+
+        with self._lock:
+            lines.append(f'# HELP {prefix}_calls_total LLM calls by outcome (ok, error, cache_hit, coalesced)')
+            lines.append(f'# TYPE {prefix}_calls_total counter')
+            for (provider, model, outcome), count in sorted(self._calls.items()):
+                lines.append(f'{prefix}_calls_total{labels(provider=provider, model=model, outcome=outcome)} {count}')
+            lines.append(f'# HELP {prefix}_retries_total Retried attempts')
+            lines.append(f'# TYPE {prefix}_retries_total counter')
+            for (provider, model), count in sorted(self._retries.items()):
+                lines.append(f'{prefix}_retries_total{labels(provider=provider, model=model)} {count}')
+            lines.append(f'# HELP {prefix}_tokens_total Tokens by kind (input_tokens, cached_input_tokens, output_tokens)')
+            lines.append(f'# TYPE {prefix}_tokens_total counter')
+            for (provider, model, kind), count in sorted(self._tokens.items()):
+                lines.append(f'{prefix}_tokens_total{labels(provider=provider, model=model, kind=kind)} {count}')
+            for name in self.HISTOGRAMS:
+                metric = f'{prefix}_{name}'
+                lines.append(f'# TYPE {metric} histogram')
+                for (hist_name, provider, model), histogram in sorted(self._histograms.items()):
+                    if hist_name != name:
+                        continue
+                    for bound, total in histogram.cumulative():
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{metric}_bucket{labels(provider=provider, model=model, le=le)} {total}')
+                    lines.append(f'{metric}_sum{labels(provider=provider, model=model)} {histogram.sum}')
+                    lines.append(f'{metric}_count{labels(provider=provider, model=model)} {histogram.count}')
+            lines.append(f'# HELP {prefix}_batch_requests_per_second Completed requests per second in the last batch')
+            lines.append(f'# TYPE {prefix}_batch_requests_per_second gauge')
+            for model, totals in sorted(self._batches.items()):
+                lines.append(f'{prefix}_batch_requests_per_second{labels(model=model)} {totals["last"]["requests_per_sec"] or 0}')
+            lines.append(f'# HELP {prefix}_batch_output_tokens_per_second Generated tokens per second in the last batch')
+            lines.append(f'# TYPE {prefix}_batch_output_tokens_per_second gauge')
+            for model, totals in sorted(self._batches.items()):
+                lines.append(f'{prefix}_batch_output_tokens_per_second{labels(model=model)} {totals["last"]["output_tokens_per_sec"] or 0}')
+            lines.append(f'# TYPE {prefix}_batch_messages_total counter')
+            for model, totals in sorted(self._batches.items()):
+                lines.append(f'{prefix}_batch_messages_total{labels(model=model)} {totals["messages"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        _atomic_write(path, self.to_prometheus())
+
+    def write_json(self, path):
+        _atomic_write(path, json.dumps(self.snapshot(), indent=2))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _atomic_write(path, text):
+    # Write then rename, so a scraper never reads a half-written file
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+registry = MetricsRegistry()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Warm worker for running main.py generations.
+
+evolve.py starts this script once per session (--warm). It preloads the modules every
+run_main.py process would otherwise import from scratch (api, requests and the provider SDKs)
+and then forks one child per generation:
+
+1. evolve.py sends a request line over a socketpair: {"env": {...}, "cwd": ..., "timeout": 300, "grace": 5}
+2. The worker forks; the child applies env/cwd and runs run_main.py as __main__
+3. The worker waits for the child, sends SIGTERM once the timeout passes (SIGKILL `grace`
+   seconds later if it is still running), and replies with {"returncode", "timed_out", "fork_seconds"}
+
+Each child is still a separate process with the same stdin/stdout/stderr as evolve.py, so
+isolation, the timeout and output forwarding behave exactly like `python run_main.py`.
+Fork is POSIX-only; WarmWorker.start() returns None elsewhere and evolve.py falls back.
+"""
+
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+PRELOAD_MODULES = [
+    'requests',
+    'httpx',
+    'openai',
+    'anthropic',
+    'google.genai',
+    'google.genai.types',
+    'google.genai.errors',
+    'tqdm',
+    'api',
+]
+
+def preload():
+    """Import PRELOAD_MODULES (skipping ones that are not installed); returns seconds spent"""
+    import importlib
+    start = time.perf_counter()
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    # Warm the model registry too, so children don't rebuild it
+    sys.modules['api']._get_model_index()
+    return time.perf_counter() - start
+
+def _run_child(request):
+    """Body of the forked child: behave like `python run_main.py` in request['cwd']"""
+    import runpy
+    os.environ.update(request.get('env', {}))
+    cwd = request.get('cwd') or os.getcwd()
+    os.chdir(cwd)
+    sys.path[0] = cwd
+    sys.argv = ['run_main.py']
+    code = 0
+    try:
+        runpy.run_path(os.path.join(cwd, 'run_main.py'), run_name='__main__')
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException as e:
+        print(f"Error in warm worker child: {e}", file=sys.stderr)
+        code = 1
+    finally:
+        # os._exit skips atexit, where api exports LLM_METRICS_FILE in a normal run
+        metrics_file = os.environ.get('LLM_METRICS_FILE')
+        if metrics_file and 'api' in sys.modules:
+            try:
+                sys.modules['api'].write_metrics(metrics_file)
+            except Exception as e:
+                print(f"Could not write metrics to {metrics_file}: {e}", file=sys.stderr)
+        sys.stdout.flush()
+        sys.stderr.flush()
+    os._exit(code)
+
+def _wait_child(pid, timeout, grace=5):
+    """
+    Wait for pid up to timeout seconds, then SIGTERM it and SIGKILL it if it is still running
+    grace seconds later. Returns (returncode, timed_out)
+    """
+    deadline = time.monotonic() + timeout
+    terminated = False
+    while True:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            return os.waitstatus_to_exitcode(status), terminated
+        if time.monotonic() >= deadline:
+            if terminated:
+                os.kill(pid, signal.SIGKILL)
+                _, status = os.waitpid(pid, 0)
+                return os.waitstatus_to_exitcode(status), True
+            os.kill(pid, signal.SIGTERM)
+            terminated = True
+            deadline = time.monotonic() + grace
+        time.sleep(0.02)
+
+def serve(fd):
+    """Worker main loop: answer run requests on the inherited socket fd until it closes"""
+    control = socket.socket(fileno=fd)
+    channel = control.makefile('rwb')
+    preload_seconds = preload()
+    channel.write((json.dumps({'ready': True, 'preload_seconds': preload_seconds}) + '\n').encode())
+    channel.flush()
+    # Ctrl-C is delivered to the whole foreground group; let evolve.py decide what to do
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for line in channel:
+        request = json.loads(line)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        fork_start = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            channel.close()
+            control.close()
+            _run_child(request)
+        fork_seconds = time.perf_counter() - fork_start
+        returncode, timed_out = _wait_child(pid, request.get('timeout', 300), request.get('grace', 5))
+        reply = {'returncode': returncode, 'timed_out': timed_out, 'fork_seconds': fork_seconds}
+        channel.write((json.dumps(reply) + '\n').encode())
+        channel.flush()
+
+def measure_cold_start():
+    """
+    Seconds a fresh `python -c "import api"` takes next to this file. A cold run_main.py pays about
+    that before any real work: api imports only the provider SDK a call needs, so the worker's own
+    startup (every SDK preloaded) would overstate it. Returns None if it can't be measured.
+    """
+    start = time.perf_counter()
+    try:
+        subprocess.run([sys.executable, '-c', 'import api'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, timeout=60)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return time.perf_counter() - start
+
+class WarmWorker:
+    """
+    Handle evolve.py uses to drive a warm worker process.
+    startup_seconds is how long the worker took from launch to ready (interpreter startup plus
+    the preloads); cold_start_seconds is what a cold `python run_main.py` pays before doing any
+    real work (see measure_cold_start), the baseline a forked child is compared with.
+    """
+    def __init__(self, process, channel, startup_seconds, preload_seconds, cold_start_seconds=None):
+        self.process = process
+        self.channel = channel
+        self.startup_seconds = startup_seconds
+        self.preload_seconds = preload_seconds
+        self.cold_start_seconds = startup_seconds if cold_start_seconds is None else cold_start_seconds
+
+    @classmethod
+    def start(cls):
+        """Launch a warm worker next to this file; returns None if fork is unavailable or startup fails"""
+        if not hasattr(os, 'fork'):
+            return None
+        parent_sock, child_sock = socket.socketpair()
+        start = time.perf_counter()
+        try:
+            process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--fd', str(child_sock.fileno())],
+                pass_fds=[child_sock.fileno()],
+            )
+        except OSError:
+            parent_sock.close()
+            child_sock.close()
+            return None
+        child_sock.close()
+        channel = parent_sock.makefile('rwb')
+        line = channel.readline()
+        if not line:
+            process.wait()
+            return None
+        ready = json.loads(line)
+        startup_seconds = time.perf_counter() - start
+        return cls(process, channel, startup_seconds, ready['preload_seconds'], measure_cold_start())
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self, env=None, cwd=None, timeout=300, grace=5):
+        """
+        Run one generation in a forked child and wait for it.
+        Returns a dict with returncode, timed_out, fork_seconds and saved_seconds (cold start
+        time avoided compared with launching a fresh interpreter).
+        """
+        request = {'env': env or {}, 'cwd': cwd or os.getcwd(), 'timeout': timeout, 'grace': grace}
+        self.channel.write((json.dumps(request) + '\n').encode())
+        self.channel.flush()
+        line = self.channel.readline()
+        if not line:
+            raise RuntimeError('warm worker exited unexpectedly')
+        reply = json.loads(line)
+        reply['saved_seconds'] = max(0.0, self.cold_start_seconds - reply['fork_seconds'])
+        return reply
+
+    def close(self):
+        try:
+            self.channel.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != '--fd':
+        print("Usage: warm_worker.py --fd <socket fd> (started by evolve.py --warm)", file=sys.stderr)
+        sys.exit(2)
+    serve(int(sys.argv[2]))
@@ -0,0 +1,129 @@
+"""
+Per-candidate workspaces, so several generations can run side by side.
+
+run_main.py imports main from its own directory and writes .evolution_proposal.py to the current
+one, so two candidates sharing a directory would overwrite each other. Each candidate gets its own
+directory under .workspaces/ instead:
+- main.py and run_main.py are always real copies. Python resolves a symlinked script to its
+  target's directory for sys.path[0], so a linked run_main.py would import the shared main.py.
+- Small data files (memory.txt, generation.txt, ...) are copied as well, so a candidate's writes
+  stay its own.
+- In 'symlink' mode (the default) everything else is linked to the source tree, which makes a
+  workspace almost free to create.
+- 'copy' mode copies everything, for candidates that may edit other files.
+
+A workspace whose run is kept (a speculative next generation, see evolve.py --speculate) hands the
+data files its run wrote back to the project with copy_back().
+"""
+
+import filecmp
+import os
+import shutil
+from datetime import datetime
+
+WORKSPACE_ROOT = '.workspaces'
+PROPOSAL_FILE = '.evolution_proposal.py'
+COPIED_FILES = ('main.py', 'run_main.py')
+SKIPPED = {'.git', WORKSPACE_ROOT, 'checkpoints', '__pycache__', PROPOSAL_FILE}
+MAX_COPIED_DATA_BYTES = 1024 * 1024  # larger non-Python files are linked even in symlink mode
+
+# Settings that hold a path; children get them as absolute paths, since they run in another directory
+PATH_ENV_VARS = ('LLM_CACHE_PATH', 'LLM_CASSETTE')
+
+class Workspace:
+    """One candidate's directory: its own main.py, run_main.py and evolution proposal"""
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+
+    @property
+    def label(self):
+        return f"c{self.index}"
+
+    def read_proposal(self):
+        """The code run_main.py proposed in this workspace (removing the file), or None"""
+        proposal = os.path.join(self.path, PROPOSAL_FILE)
+        if not os.path.exists(proposal):
+            return None
+        with open(proposal, 'r') as f:
+            code = f.read().strip()
+        os.remove(proposal)
+        return code or None
+
+    def copy_back(self, source_dir='.'):
+        """Copy the top-level files this workspace's run created or changed back to source_dir; returns their names"""
+        source_dir = os.path.abspath(source_dir)
+        copied = []
+        for name in sorted(os.listdir(self.path)):
+            path = os.path.join(self.path, name)
+            if name in COPIED_FILES or _is_skipped(name) or name.endswith('.tmp') or os.path.islink(path) or not os.path.isfile(path):
+                continue
+            target = os.path.join(source_dir, name)
+            if os.path.isfile(target) and filecmp.cmp(path, target, shallow=False):
+                continue
+            shutil.copy2(path, target)
+            copied.append(name)
+        return copied
+
+    def __repr__(self):
+        return f"Workspace({self.path!r})"
+
+def _is_skipped(name):
+    return name in SKIPPED or name.startswith('.llm_cache.sqlite')
+
+def _should_copy(source, name, mode):
+    if mode == 'copy' or name in COPIED_FILES:
+        return True
+    return os.path.isfile(source) and not name.endswith('.py') and os.path.getsize(source) <= MAX_COPIED_DATA_BYTES
+
+def create_workspace(path, index=0, source_dir='.', mode='symlink', main_code=None):
+    """
+    Build a workspace at path from source_dir.
+    Args:
+        mode: 'symlink' links everything but main.py, run_main.py and small data files; 'copy' copies it all.
+        main_code: the main.py to start from (default: source_dir's main.py).
+    """
+    if mode not in ('symlink', 'copy'):
+        raise ValueError(f"Unknown workspace mode '{mode}', expected 'symlink' or 'copy'")
+    source_dir = os.path.abspath(source_dir)
+    os.makedirs(path)
+    for name in sorted(os.listdir(source_dir)):
+        if _is_skipped(name):
+            continue
+        source = os.path.join(source_dir, name)
+        target = os.path.join(path, name)
+        if not _should_copy(source, name, mode):
+            os.symlink(source, target)
+        elif os.path.isdir(source):
+            shutil.copytree(source, target, symlinks=True, ignore=shutil.ignore_patterns('__pycache__'))
+        else:
+            shutil.copy2(source, target)
+    if main_code is not None:
+        with open(os.path.join(path, 'main.py'), 'w') as f:
+            f.write(main_code)
+    return Workspace(path, index)
+
+def create_population(count, source_dir='.', root=WORKSPACE_ROOT, mode='symlink', main_code=None):
+    """count workspaces for one generation, under root/<timestamp>/c1..c<count>"""
+    run_dir = os.path.join(root, datetime.now().strftime("%Y%m%d_%H%M%S_%f"))
+    return [
+        create_workspace(os.path.join(run_dir, f"c{index}"), index, source_dir, mode, main_code)
+        for index in range(1, count + 1)
+    ]
+
+def remove_population(workspaces):
+    """Delete a generation's workspaces (and their run directory once empty)"""
+    run_dirs = set()
+    for workspace in workspaces:
+        shutil.rmtree(workspace.path, ignore_errors=True)
+        run_dirs.add(os.path.dirname(workspace.path))
+    for run_dir in run_dirs:
+        try:
+            os.rmdir(run_dir)
+        except OSError:
+            pass
+
+def workspace_env(environ=None):
+    """Entries of environ (default os.environ) whose relative paths must be made absolute for a workspace"""
+    environ = os.environ if environ is None else environ
+    return {name: os.path.abspath(environ[name]) for name in PATH_ENV_VARS if environ.get(name)}